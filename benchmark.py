@@ -0,0 +1,1153 @@
+"""
+Бенчмарки чата.
+
+Запуск:
+    python benchmark.py codec --messages 100000
+    python benchmark.py compression --messages 100000 --level 6
+    python benchmark.py search --messages 1000000
+    python benchmark.py memory --messages 1000000
+    python benchmark.py logging --delay 0.001
+    python benchmark.py http --senders 10 --messages 200 --pipeline 8
+    python benchmark.py transport --senders 10 --receivers 50
+    python benchmark.py load broadcast --users 1000 --senders 20
+    python benchmark.py load mesh --users 1000 --workers 4
+    python benchmark.py load reconnect --users 1000 --wave 0.5
+    python benchmark.py load delay --users 200 --delay 1
+    python benchmark.py --json codec
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import AsyncExitStack, asynccontextmanager
+from datetime import datetime, timedelta
+from itertools import accumulate
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterator,
+    Optional,
+)
+
+from client import Client
+from logs import TEXT_FORMAT, BoundedQueueHandler, BoundedQueueListener
+from message import (
+    Message,
+    message_object_to_str,
+    message_record_to_object,
+    message_str_to_object,
+)
+from protocol import FRAME_COMPRESSED, FRAME_HEADER, FrameCodec
+from search import parse_query
+from store import MessageStore
+
+
+def measure(func: Callable[[], object], count: int) -> float:
+    """
+    Возвращает время выполнения func в наносекундах на одно сообщение.
+    """
+    started = time.perf_counter_ns()
+    func()
+    return (time.perf_counter_ns() - started) / count
+
+
+def bench_codec(args: argparse.Namespace) -> dict:
+    """
+    Сравнивает текстовый протокол с бинарными кадрами на кодировании
+    и декодировании сообщений.
+    """
+    now = datetime.now()
+    messages = [
+        Message(f'user{i % 100}', f'сообщение номер {i}', created_at=now)
+        for i in range(args.messages)
+    ]
+    count = len(messages)
+    codec = FrameCodec()
+    batch = args.batch
+
+    lines = [message_object_to_str(m).encode() for m in messages]
+    single_frames = [codec.encode([m]) for m in messages]
+    batch_frames = [
+        codec.encode(messages[i:i + batch]) for i in range(0, count, batch)
+    ]
+    header = FRAME_HEADER.size
+
+    return {
+        'messages': count,
+        'batch': batch,
+        'legacy': {
+            'encode_ns': measure(lambda: [
+                message_object_to_str(m).encode() for m in messages
+            ], count),
+            'decode_ns': measure(lambda: [
+                message_str_to_object(line.decode().strip())
+                for line in lines
+            ], count),
+            'bytes': sum(map(len, lines)) / count,
+        },
+        'frame': {
+            'encode_ns': measure(
+                lambda: [codec.encode([m]) for m in messages], count),
+            'decode_ns': measure(lambda: [
+                codec.decode_payload(frame[header:])
+                for frame in single_frames
+            ], count),
+            'bytes': sum(map(len, single_frames)) / count,
+        },
+        'frame_batch': {
+            'encode_ns': measure(lambda: [
+                codec.encode(messages[i:i + batch])
+                for i in range(0, count, batch)
+            ], count),
+            'decode_ns': measure(lambda: [
+                codec.decode_payload(frame[header:])
+                for frame in batch_frames
+            ], count),
+            'bytes': sum(map(len, batch_frames)) / count,
+        },
+    }
+
+
+def run_compression(
+        batches: list[list[Message]], single: bool, compression: bool,
+        args: argparse.Namespace) -> dict:
+    """
+    Кодирует пачки сообщений так же, как их отправляет подключение
+    (single - каждое сообщение своим кадром, как при рассылке), и
+    разбирает полученный поток на стороне клиента.
+    """
+    sender = FrameCodec()
+    receiver = FrameCodec()
+    receiver.enable_decompression()
+    if compression:
+        sender.enable_compression(args.threshold, args.level)
+    count = sum(map(len, batches))
+    wire: list[bytes] = []
+
+    def send() -> None:
+        for batch in batches:
+            if single:
+                chunks = [sender.encode([m]) for m in batch]
+            else:
+                chunks = [sender.encode(batch)]
+            wire.extend(sender.compress(chunks))
+
+    encode_ns = measure(send, count)
+    data = memoryview(b''.join(wire))
+
+    def receive() -> None:
+        offset = 0
+        while offset < len(data):
+            frame_type, length = FRAME_HEADER.unpack_from(data, offset)
+            offset += FRAME_HEADER.size
+            payload = data[offset:offset + length]
+            if frame_type == FRAME_COMPRESSED:
+                receiver.decompress(payload)
+            else:
+                receiver.decode_frame(frame_type, payload)
+            offset += length
+
+    return {
+        'bytes': len(data) / count,
+        'encode_ns': encode_ns,
+        'decode_ns': measure(receive, count),
+    }
+
+
+def bench_compression(args: argparse.Namespace) -> dict:
+    """
+    Сравнивает трафик и процессорное время на сообщение без сжатия
+    и со сжатием: для догрузки истории страницами и для живой рассылки
+    одиночных сообщений, склеенных писателем в пачки по --batch.
+    """
+    started = time.time()
+    messages = [
+        Message(
+            f'user{i % 50}', f'сообщение номер {i} в общем чате',
+            created_at=datetime.fromtimestamp(started + i * 0.37))
+        for i in range(args.messages)
+    ]
+    workloads = {
+        'history': ([
+            messages[i:i + args.page]
+            for i in range(0, len(messages), args.page)
+        ], False),
+        'live': ([
+            messages[i:i + args.batch]
+            for i in range(0, len(messages), args.batch)
+        ], True),
+    }
+    report: dict = {
+        'messages': len(messages),
+        'threshold': args.threshold,
+        'level': args.level,
+    }
+    for name, (batches, single) in workloads.items():
+        raw = run_compression(batches, single, False, args)
+        packed = run_compression(batches, single, True, args)
+        report[name] = {
+            'raw': raw,
+            'zlib': packed,
+            'ratio': raw['bytes'] / packed['bytes'],
+        }
+    return report
+
+
+def bench_search(args: argparse.Namespace) -> dict:
+    """
+    Индексирует --messages сообщений общего чата и личных сообщений
+    и замеряет задержку запросов /search: по частому и редкому слову,
+    по нескольким словам, с фильтрами по автору и времени.
+    """
+    rng = random.Random(args.seed)
+    # Частоты слов убывают по закону Ципфа, как в живой речи
+    vocabulary = [f'слово{i}' for i in range(args.vocabulary)]
+    weights = list(accumulate(
+        1 / (rank + 1) for rank in range(args.vocabulary)))
+    started = datetime.now() - timedelta(seconds=args.messages)
+    messages = []
+    for i in range(args.messages):
+        words = rng.choices(
+            vocabulary, cum_weights=weights, k=args.words)
+        to_username = f'user{i % 100}' if i % 10 == 0 else ''
+        messages.append(Message(
+            f'user{i % 1000}', ' '.join(words),
+            created_at=started + timedelta(seconds=i), to=to_username))
+
+    store = MessageStore(
+        timedelta(seconds=args.messages * 2), args.messages)
+    build_ns = measure(
+        lambda: [store.add(message) for message in messages], len(messages))
+
+    middle = (started + timedelta(seconds=args.messages // 2)).isoformat()
+    queries = {
+        'frequent': vocabulary[0],
+        'rare': vocabulary[-1],
+        'two_words': f'{vocabulary[1]} {vocabulary[50]}',
+        'author': f'{vocabulary[0]} from:user7',
+        'time_range': f'{vocabulary[10]} until:{middle}',
+        'no_results': 'несуществующее',
+    }
+    scopes = ['', 'user7']
+    report: dict = {
+        'messages': len(messages),
+        'build_ns': build_ns,
+        'tokens': sum(map(len, store.index.scopes.values())),
+    }
+    for name, text in queries.items():
+        query = parse_query(text)
+        latencies = []
+        for _ in range(args.repeat):
+            begin = time.perf_counter_ns()
+            store.search(scopes, query, args.page)
+            latencies.append(time.perf_counter_ns() - begin)
+        report[name] = percentiles(latencies)
+    return report
+
+
+class DictMessage:
+    """
+    Сообщение в прежнем представлении (для сравнения): атрибуты
+    в словаре экземпляра, время - объект datetime, у каждого сообщения
+    своя копия имени автора.
+    """
+
+    def __init__(self, record: dict):
+        self.author = record['author']
+        self.text = record['text']
+        self.datetime = datetime.fromtimestamp(record['datetime'])
+        self.sep = record['sep']
+        self.to_username = record['to_username']
+        self.send_after = 0
+        self.seq = record['seq']
+
+
+def traced_bytes(build: Callable[[], Any]) -> tuple[Any, int]:
+    """
+    Возвращает результат build и объем памяти, который он занимает.
+    """
+    tracemalloc.start()
+    try:
+        result = build()
+        return result, tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_memory(args: argparse.Namespace) -> dict:
+    """
+    Сравнивает память на одно сообщение истории: прежнее представление
+    Message, компактное и хранилище целиком (ленты и поисковый индекс).
+    Сообщения строятся из записей шины, как на сервере.
+    """
+    started = time.time() - args.messages
+    count = args.messages
+
+    def records() -> Iterator[dict]:
+        for i in range(count):
+            yield {
+                'seq': i + 1,
+                'author': f'user{i % args.users}',
+                'text': f'сообщение номер {i} в общем чате',
+                'datetime': started + i,
+                'sep': ':',
+                'to_username': f'user{i % args.users}' if i % 10 == 0 else '',
+            }
+
+    report: dict = {'messages': count}
+    legacy, size = traced_bytes(
+        lambda: [DictMessage(record) for record in records()])
+    report['dict_bytes'] = size / count
+    del legacy
+
+    messages, size = traced_bytes(
+        lambda: [message_record_to_object(record) for record in records()])
+    report['slots_bytes'] = size / count
+    del messages
+
+    def build_store() -> MessageStore:
+        store = MessageStore(timedelta(seconds=count * 2), count)
+        for record in records():
+            store.add(message_record_to_object(record))
+        return store
+
+    _, size = traced_bytes(build_store)
+    report['store_bytes'] = size / count
+    report['saving'] = report['dict_bytes'] / report['slots_bytes']
+    return report
+
+
+class SlowSink(io.TextIOBase):
+    """
+    Вывод, запись в который занимает delay секунд: медленный терминал
+    или отстающий потребитель лога на другом конце конвейера.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.lines: int = 0
+
+    def write(self, text: str) -> int:
+        time.sleep(self.delay)
+        self.lines += 1
+        return len(text)
+
+
+async def run_logging(
+        handler: logging.Handler, args: argparse.Namespace) -> dict:
+    """
+    Пишет в лог --records записей эха чата пачками по --burst и замеряет
+    время вызова logger.info и задержку таймера цикла событий.
+    """
+    log = logging.getLogger('benchmark.logging')
+    log.propagate = False
+    log.handlers = [handler]
+    log.setLevel(logging.INFO)
+    loop = asyncio.get_running_loop()
+    calls: list[int] = []
+    lags: list[int] = []
+    done = asyncio.Event()
+
+    async def probe() -> None:
+        while not done.is_set():
+            started = loop.time()
+            await asyncio.sleep(args.interval)
+            lag = loop.time() - started - args.interval
+            lags.append(int(max(0.0, lag) * 1_000_000_000))
+
+    probe_task = asyncio.create_task(probe())
+    for i in range(args.records):
+        started = time.perf_counter_ns()
+        log.info(f'user{i % 100}: сообщение номер {i}', extra={
+            'category': 'chat', 'message_id': i})
+        calls.append(time.perf_counter_ns() - started)
+        if i % args.burst == args.burst - 1:
+            await asyncio.sleep(args.interval)
+    done.set()
+    await probe_task
+    return {'call': percentiles(calls), 'loop_lag': percentiles(lags)}
+
+
+def bench_logging(args: argparse.Namespace) -> dict:
+    """
+    Сравнивает синхронный вывод лога (как logging.basicConfig) с выводом
+    через ограниченную очередь и отдельный поток при быстром
+    и медленном (--delay сек. на запись) выводе.
+    """
+    report: dict = {'records': args.records}
+    formatter = logging.Formatter(TEXT_FORMAT)
+    for delay in (0.0, args.delay):
+        sink = SlowSink(delay)
+        handler: logging.Handler = logging.StreamHandler(sink)
+        handler.setFormatter(formatter)
+        report[f'sync_{delay:g}s'] = asyncio.run(run_logging(handler, args))
+
+        sink = SlowSink(delay)
+        output = logging.StreamHandler(sink)
+        output.setFormatter(formatter)
+        queue_handler = BoundedQueueHandler(args.queue, args.policy)
+        listener = BoundedQueueListener(queue_handler.records, output)
+        listener.start()
+        result = asyncio.run(run_logging(queue_handler, args))
+        listener.stop()
+        result['written'] = sink.lines
+        result['dropped'] = queue_handler.dropped
+        report[f'queue_{delay:g}s'] = result
+    return report
+
+
+def free_port() -> int:
+    """
+    Возвращает свободный TCP-порт на локальном хосте.
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def cpu_seconds(pid: int) -> float:
+    """
+    Возвращает процессорное время (user + system) процесса pid.
+    """
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+@asynccontextmanager
+async def run_server(
+        port: int, server_settings: dict) -> AsyncIterator[int]:
+    """
+    Запускает сервер чата в отдельном процессе и возвращает его pid.
+    """
+    with tempfile.TemporaryDirectory() as data_dir:
+        env = dict(os.environ)
+        # Журнал и файлы - во временном каталоге, порты метрик и HTTP API
+        # закрыты, если сценарию они не нужны
+        env['SERVER'] = json.dumps({
+            'PORT': port,
+            'LOG_DIR': os.path.join(data_dir, 'messages'),
+            'FILES_DIR': os.path.join(data_dir, 'files'),
+            'METRICS_PORT': 0,
+            'HTTP_PORT': 0,
+            **server_settings,
+        })
+        for limit in (
+            'LIMIT_MESSAGES_CNT', 'LIMIT_PRIVATE_CNT', 'LIMIT_DELAY_CNT'
+        ):
+            env[limit] = str(10 ** 9)
+        env['LAST_MESSAGES_CNT'] = '0'
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, 'server.py',
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        try:
+            for _ in range(100):
+                try:
+                    _, writer = await asyncio.open_connection(
+                        '127.0.0.1', port)
+                    writer.close()
+                    break
+                except OSError:
+                    await asyncio.sleep(0.05)
+            yield process.pid
+        finally:
+            process.terminate()
+            await process.wait()
+
+
+async def open_client(port: int, username: str) -> Client:
+    """
+    Подключает клиента без консольного ввода.
+    """
+    client = Client(username, '127.0.0.1', port)
+    await client.connect()
+    return client
+
+
+async def receive(client: Client, prefix: str, expected: int) -> None:
+    """
+    Читает сообщения, пока не получит expected сообщений от авторов,
+    чьи имена начинаются с prefix.
+    """
+    received = 0
+    while received < expected:
+        messages = await client.codec.read(client.reader)
+        if messages is None:
+            raise ConnectionError('Сервер закрыл соединение')
+        received += sum(
+            1 for m in messages
+            if isinstance(m, Message) and m.author.startswith(prefix))
+
+
+async def run_transport(transport: str, args: argparse.Namespace) -> dict:
+    port = free_port()
+    async with run_server(port, {'TRANSPORT': transport}) as pid:
+        receivers = [
+            await open_client(port, f'reader{i}')
+            for i in range(args.receivers)
+        ]
+        senders = [
+            await open_client(port, f'sender{i}')
+            for i in range(args.senders)
+        ]
+        await asyncio.sleep(0.5)
+
+        expected = args.senders * args.messages
+        cpu_started = cpu_seconds(pid)
+        started = time.perf_counter()
+        waiters = [
+            asyncio.create_task(receive(client, 'sender', expected))
+            for client in receivers
+        ]
+        for i in range(args.messages):
+            for client in senders:
+                message_obj = Message(
+                    client.username, f'сообщение {i}',
+                    created_at=datetime.now())
+                client.writer.write(client.codec.encode([message_obj]))
+            await asyncio.gather(*(c.writer.drain() for c in senders))
+        await asyncio.wait_for(asyncio.gather(*waiters), args.timeout)
+        elapsed = time.perf_counter() - started
+        cpu = cpu_seconds(pid) - cpu_started
+
+        for client in receivers + senders:
+            client.writer.close()
+
+    delivered = expected * args.receivers
+    return {
+        'received_messages': expected,
+        'delivered_messages': delivered,
+        'seconds': elapsed,
+        'server_cpu_seconds': cpu,
+        'messages_per_sec': delivered / elapsed,
+        'messages_per_cpu_sec': delivered / cpu if cpu else 0.0,
+    }
+
+
+def bench_transport(args: argparse.Namespace) -> dict:
+    """
+    Сравнивает пропускную способность сервера на StreamReader/StreamWriter
+    и на BufferedProtocol (доставленных сообщений в секунду на ядро).
+    """
+    return {
+        transport: asyncio.run(run_transport(transport, args))
+        for transport in ('streams', 'protocol')
+    }
+
+
+# Метка в тексте сообщений генератора нагрузки, за ней следует время
+# отправки (или ожидаемой доставки) по time.perf_counter_ns
+LOAD_MARK = 'bench:'
+
+
+def process_tree(pid: int) -> list[int]:
+    """
+    Возвращает pid процесса и всех его потомков (рабочих процессов).
+    """
+    pids = [pid]
+    for current in pids:
+        try:
+            with open(f'/proc/{current}/task/{current}/children') as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    return pids
+
+
+def memory_usage(pid: int) -> dict:
+    """
+    Возвращает текущий и пиковый объем резидентной памяти (МиБ)
+    процесса pid вместе с его потомками.
+    """
+    fields = {'VmRSS:': 'rss_mib', 'VmHWM:': 'peak_rss_mib'}
+    usage = dict.fromkeys(fields.values(), 0.0)
+    for current in process_tree(pid):
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    name, *value = line.split()
+                    if name in fields:
+                        usage[fields[name]] += int(value[0]) / 1024
+        except OSError:
+            continue
+    return usage
+
+
+def percentiles(latencies: list[int]) -> dict:
+    """
+    Возвращает перцентили задержки доставки в миллисекундах.
+    """
+    if not latencies:
+        return {}
+    ordered = sorted(latencies)
+    last = len(ordered) - 1
+    return {
+        name: ordered[min(last, int(quantile * len(ordered)))] / 1_000_000
+        for name, quantile in (
+            ('p50_ms', 0.5), ('p99_ms', 0.99), ('p999_ms', 0.999))
+    }
+
+
+class LoadStats:
+    """
+    Считает доставленные сообщения генератора нагрузки и их задержки.
+
+    Задержка отсчитывается от метки времени в тексте сообщения, а если
+    задан since - от этого момента (например, от начала переподключения).
+    """
+
+    def __init__(self, expected: int, since: Optional[int] = None):
+        self.expected = expected
+        self.since = since
+        self.latencies: list[int] = []
+        self.started: int = time.perf_counter_ns()
+        self.finished: int = self.started
+        self.done = asyncio.Event()
+        if expected <= 0:
+            self.done.set()
+
+    def start(self) -> None:
+        self.started = time.perf_counter_ns()
+
+    def record(self, message_obj: Message) -> None:
+        _, mark, sent = message_obj.text.rpartition(LOAD_MARK)
+        if not mark:
+            return
+        self.finished = time.perf_counter_ns()
+        self.latencies.append(self.finished - (self.since or int(sent)))
+        if len(self.latencies) >= self.expected:
+            self.done.set()
+
+    async def wait(self, timeout: float) -> None:
+        """
+        Ждет доставки всех ожидаемых сообщений не дольше timeout.
+        """
+        try:
+            await asyncio.wait_for(self.done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def report(self) -> dict:
+        received = len(self.latencies)
+        seconds = max(self.finished - self.started, 1) / 1_000_000_000
+        return {
+            'expected_messages': self.expected,
+            'received_messages': received,
+            'complete': received >= self.expected,
+            'seconds': seconds,
+            'messages_per_sec': received / seconds,
+            **percentiles(self.latencies),
+        }
+
+
+class LoadUser:
+    """
+    Смоделированный пользователь: клиент чата без консольного ввода
+    и задача, передающая входящие сообщения в LoadStats.
+    """
+
+    def __init__(self, username: str, host: str, port: int, stats: LoadStats):
+        self.client = Client(username, host, port)
+        self.stats = stats
+        self.task: Optional[asyncio.Task] = None
+
+    async def connect(self) -> None:
+        await self.client.connect()
+        self.task = asyncio.create_task(self.listen())
+
+    async def listen(self) -> None:
+        while True:
+            messages = await self.client.codec.read(self.client.reader)
+            if messages is None:
+                return
+            for message_obj in messages:
+                if isinstance(message_obj, Message):
+                    self.stats.record(message_obj)
+
+    def send(self, text: str) -> None:
+        message_obj = Message(
+            self.client.username, text, created_at=datetime.now())
+        self.client.writer.write(self.client.codec.encode([message_obj]))
+
+    async def close(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+        self.client.writer.close()
+
+
+async def connect_users(
+        args: argparse.Namespace, port: int, usernames: list[str],
+        stats: LoadStats) -> tuple[list[LoadUser], float]:
+    """
+    Подключает пользователей не более args.concurrency одновременно.
+    Возвращает пользователей и скорость подключения в секунду.
+    """
+    semaphore = asyncio.Semaphore(args.concurrency)
+    users = [
+        LoadUser(username, args.host, port, stats) for username in usernames
+    ]
+
+    async def connect(user: LoadUser) -> None:
+        async with semaphore:
+            await user.connect()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(connect(user) for user in users))
+    # Даем серверу разослать приветствия и уведомления о входе
+    await asyncio.sleep(args.settle)
+    return users, len(users) / (time.perf_counter() - started)
+
+
+async def send_rounds(
+        senders: list[LoadUser], args: argparse.Namespace,
+        make_text: Callable[[int, int], str]) -> None:
+    """
+    Отправляет args.messages раундов: в каждом раунде каждый
+    отправитель посылает одно сообщение make_text(отправитель, раунд).
+    """
+    for round_index in range(args.messages):
+        for index, user in enumerate(senders):
+            user.send(make_text(index, round_index))
+        await asyncio.gather(*(u.client.writer.drain() for u in senders))
+        if args.interval:
+            await asyncio.sleep(args.interval)
+
+
+def load_mark(delay: float = 0.0) -> str:
+    return f'{LOAD_MARK}{time.perf_counter_ns() + int(delay * 1e9)}'
+
+
+async def load_broadcast(args: argparse.Namespace, port: int) -> dict:
+    """
+    Шторм сообщений в общий чат: senders пользователей пишут,
+    все остальные получают.
+    """
+    senders = min(args.senders, args.users)
+    stats = LoadStats(senders * args.messages * (args.users - 1))
+    users, connect_rate = await connect_users(
+        args, port, [f'user{i}' for i in range(args.users)], stats)
+    stats.start()
+    await send_rounds(users[:senders], args, lambda *_: load_mark())
+    await stats.wait(args.timeout)
+    return {'users': users, 'connect_per_sec': connect_rate,
+            'delivery': stats.report()}
+
+
+async def load_mesh(args: argparse.Namespace, port: int) -> dict:
+    """
+    Сетка личных сообщений: каждый пользователь пишет /private
+    следующим по кругу пользователям.
+    """
+    usernames = [f'user{i}' for i in range(args.users)]
+    stats = LoadStats(args.users * args.messages)
+    users, connect_rate = await connect_users(args, port, usernames, stats)
+
+    def make_text(index: int, round_index: int) -> str:
+        target = usernames[(index + round_index + 1) % len(usernames)]
+        return f'/private {target} {load_mark()}'
+
+    stats.start()
+    await send_rounds(users, args, make_text)
+    await stats.wait(args.timeout)
+    return {'users': users, 'connect_per_sec': connect_rate,
+            'delivery': stats.report()}
+
+
+async def load_reconnect(args: argparse.Namespace, port: int) -> dict:
+    """
+    Волна переподключений: часть пользователей выходит, пока остальные
+    пишут в общий чат, а затем все разом возвращаются и получают
+    непрочитанные сообщения (send_unread_messages).
+    """
+    usernames = [f'user{i}' for i in range(args.users)]
+    senders = min(args.senders, args.users)
+    absent = usernames[senders:][:int(args.users * args.wave)]
+    live = LoadStats(senders * args.messages * (args.users - len(absent) - 1))
+    users, connect_rate = await connect_users(args, port, usernames, live)
+
+    for user in users[senders:][:len(absent)]:
+        await user.close()
+    await asyncio.sleep(args.settle)
+    live.start()
+    await send_rounds(users[:senders], args, lambda *_: load_mark())
+    await live.wait(args.timeout)
+
+    catch_up = LoadStats(
+        len(absent) * senders * args.messages, time.perf_counter_ns())
+    returned, reconnect_rate = await connect_users(
+        args, port, absent, catch_up)
+    await catch_up.wait(args.timeout)
+    return {'users': users + returned, 'connect_per_sec': connect_rate,
+            'reconnect_per_sec': reconnect_rate, 'delivery': live.report(),
+            'catch_up': catch_up.report()}
+
+
+async def load_delay(args: argparse.Namespace, port: int) -> dict:
+    """
+    Поток /delay: каждый пользователь откладывает сообщения на
+    args.delay сек., задержка считается от запланированного времени.
+    """
+    stats = LoadStats(args.users * args.messages * (args.users - 1))
+    users, connect_rate = await connect_users(
+        args, port, [f'user{i}' for i in range(args.users)], stats)
+    stats.start()
+    await send_rounds(
+        users, args,
+        lambda *_: f'/delay {args.delay} {load_mark(args.delay)}')
+    await stats.wait(args.timeout + args.delay)
+    return {'users': users, 'connect_per_sec': connect_rate,
+            'delivery': stats.report()}
+
+
+LOAD_SCENARIOS: dict[
+    str, Callable[[argparse.Namespace, int], Awaitable[dict]]] = {
+    'broadcast': load_broadcast,
+    'mesh': load_mesh,
+    'reconnect': load_reconnect,
+    'delay': load_delay,
+}
+
+
+async def run_load(args: argparse.Namespace) -> dict:
+    async with AsyncExitStack() as stack:
+        port = args.port
+        pid = None
+        if not port:
+            port = free_port()
+            pid = await stack.enter_async_context(run_server(port, {
+                'TRANSPORT': args.transport, 'WORKERS': args.workers}))
+
+        report = await LOAD_SCENARIOS[args.scenario](args, port)
+        if pid is not None:
+            report['server'] = memory_usage(pid)
+        users = report.pop('users')
+        report['users'] = len(users)
+        for user in users:
+            await user.close()
+    return report
+
+
+def bench_load(args: argparse.Namespace) -> dict:
+    """
+    Генератор нагрузки: моделирует много пользователей и измеряет
+    скорость подключения, пропускную способность, задержки доставки
+    и память сервера.
+    """
+    if args.users < 2:
+        raise SystemExit('Нужно хотя бы два пользователя')
+    # Каждому пользователю и серверу нужен свой файловый дескриптор
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return asyncio.run(run_load(args))
+
+
+class HttpUser:
+    """
+    Клиент HTTP API для бенчмарка: постоянное соединение и сессия.
+    """
+
+    def __init__(self, port: int):
+        self.port = port
+        self.session: str = ''
+        # Соединение открывается в connect
+        self.reader: asyncio.StreamReader
+        self.writer: asyncio.StreamWriter
+
+    async def connect(self, username: str, delivery: str) -> None:
+        self.reader, self.writer = await asyncio.open_connection(
+            '127.0.0.1', self.port)
+        body = await self.request(
+            'POST', '/connect', {'username': username, 'delivery': delivery})
+        self.session = json.loads(body)['session']
+
+    def write_request(
+            self, method: str, path: str, body: Optional[dict] = None) -> None:
+        data = json.dumps(body).encode() if body is not None else b''
+        self.writer.write(
+            f'{method} {path} HTTP/1.1\r\nHost: localhost\r\n'
+            f'Content-Length: {len(data)}\r\n\r\n'.encode() + data)
+
+    async def read_response(self) -> bytes:
+        head = await self.reader.readuntil(b'\r\n\r\n')
+        length = 0
+        for line in head.split(b'\r\n'):
+            name, _, value = line.partition(b':')
+            if name.lower() == b'content-length':
+                length = int(value)
+        return await self.reader.readexactly(length)
+
+    async def request(
+            self, method: str, path: str, body: Optional[dict] = None
+    ) -> bytes:
+        self.write_request(method, path, body)
+        return await self.read_response()
+
+    async def send(self, args: argparse.Namespace) -> None:
+        """
+        Отправляет args.messages сообщений, не дожидаясь ответов
+        на предыдущие args.pipeline запросов.
+        """
+        for start in range(0, args.messages, args.pipeline):
+            count = min(args.pipeline, args.messages - start)
+            for _ in range(count):
+                self.write_request(
+                    'POST', f'/send?session={self.session}',
+                    {'text': load_mark()})
+            for _ in range(count):
+                await self.read_response()
+
+    async def poll(self, stats: LoadStats) -> None:
+        """
+        Забирает сообщения запросами long-poll с подтверждением.
+        """
+        ack = 0
+        while not stats.done.is_set():
+            body = await self.request(
+                'GET',
+                f'/messages?session={self.session}&timeout=1&ack={ack}')
+            for line in body.splitlines():
+                message_obj = message_record_to_object(json.loads(line))
+                ack = max(ack, message_obj.seq)
+                stats.record(message_obj)
+
+    async def stream(self, stats: LoadStats) -> None:
+        """
+        Получает сообщения потоком Server-Sent Events.
+        """
+        self.write_request('GET', f'/events?session={self.session}')
+        await self.reader.readuntil(b'\r\n\r\n')
+        while not stats.done.is_set():
+            line = await self.reader.readline()
+            if not line:
+                return
+            if line.startswith(b'data: '):
+                stats.record(message_record_to_object(json.loads(line[6:])))
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+async def http_native_round(args: argparse.Namespace, port: int) -> dict:
+    """
+    Отправка и доставка сообщений по собственному протоколу чата.
+    """
+    stats = LoadStats(args.senders * args.messages)
+    receiver = LoadUser('native_reader', '127.0.0.1', port, stats)
+    await receiver.connect()
+    senders = [
+        LoadUser(f'native{i}', '127.0.0.1', port, stats)
+        for i in range(args.senders)
+    ]
+    for user in senders:
+        await user.connect()
+    await asyncio.sleep(args.settle)
+
+    stats.start()
+    started = time.perf_counter()
+    for _ in range(args.messages):
+        for user in senders:
+            user.send(load_mark())
+    await asyncio.gather(*(u.client.writer.drain() for u in senders))
+    sent = time.perf_counter() - started
+    await stats.wait(args.timeout)
+    for user in [receiver, *senders]:
+        await user.close()
+    return {
+        'requests_per_sec': args.senders * args.messages / sent,
+        'delivery': stats.report(),
+    }
+
+
+async def http_api_round(
+        args: argparse.Namespace, port: int, delivery: str) -> dict:
+    """
+    Отправка запросами POST /send и доставка через long-poll или SSE.
+    """
+    stats = LoadStats(args.senders * args.messages)
+    receiver = HttpUser(port)
+    await receiver.connect(f'{delivery}_reader', delivery)
+    senders = [HttpUser(port) for _ in range(args.senders)]
+    for index, user in enumerate(senders):
+        await user.connect(f'{delivery}{index}', 'poll')
+    receive = receiver.stream if delivery == 'sse' else receiver.poll
+    receive_task = asyncio.create_task(receive(stats))
+    await asyncio.sleep(args.settle)
+
+    stats.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(user.send(args) for user in senders))
+    sent = time.perf_counter() - started
+    await stats.wait(args.timeout)
+    receive_task.cancel()
+    for user in [receiver, *senders]:
+        user.close()
+    return {
+        'requests_per_sec': args.senders * args.messages / sent,
+        'delivery': stats.report(),
+    }
+
+
+async def run_http(args: argparse.Namespace) -> dict:
+    port = free_port()
+    http_port = free_port()
+    async with run_server(port, {'HTTP_PORT': http_port}):
+        return {
+            'native': await http_native_round(args, port),
+            'http_poll': await http_api_round(args, http_port, 'poll'),
+            'http_sse': await http_api_round(args, http_port, 'sse'),
+        }
+
+
+def bench_http(args: argparse.Namespace) -> dict:
+    """
+    Сравнивает HTTP API (keep-alive, pipelining, long-poll и SSE)
+    с собственным протоколом чата: скорость приема сообщений
+    сервером и задержку их доставки получателю.
+    """
+    return asyncio.run(run_http(args))
+
+
+def print_report(name: str, report: dict, indent: str = '') -> None:
+    """
+    Печатает результаты бенчмарка в читаемом виде.
+    """
+    print(f'{indent}{name}:')
+    for key, value in report.items():
+        if isinstance(value, dict):
+            print_report(key, value, indent + '  ')
+        elif isinstance(value, float):
+            print(f'{indent}  {key}: {value:.1f}')
+        else:
+            print(f'{indent}  {key}: {value}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Бенчмарки чата')
+    parser.add_argument(
+        '--json', action='store_true', help='вывести результат в JSON')
+    scenarios = parser.add_subparsers(dest='scenario', required=True)
+
+    codec_parser = scenarios.add_parser(
+        'codec', help='кодирование и декодирование сообщений')
+    codec_parser.add_argument('--messages', type=int, default=100_000)
+    codec_parser.add_argument('--batch', type=int, default=64)
+    codec_parser.set_defaults(func=bench_codec)
+
+    compression_parser = scenarios.add_parser(
+        'compression', help='трафик и цена сжатия кадров')
+    compression_parser.add_argument('--messages', type=int, default=100_000)
+    compression_parser.add_argument(
+        '--page', type=int, default=256,
+        help='сообщений в странице догрузки истории')
+    compression_parser.add_argument(
+        '--batch', type=int, default=8,
+        help='сообщений в пачке записи при живой рассылке')
+    compression_parser.add_argument('--threshold', type=int, default=512)
+    compression_parser.add_argument('--level', type=int, default=6)
+    compression_parser.set_defaults(func=bench_compression)
+
+    search_parser = scenarios.add_parser(
+        'search', help='индексирование и поиск по истории')
+    search_parser.add_argument('--messages', type=int, default=1_000_000)
+    search_parser.add_argument(
+        '--words', type=int, default=8, help='слов в сообщении')
+    search_parser.add_argument('--vocabulary', type=int, default=20_000)
+    search_parser.add_argument('--page', type=int, default=20)
+    search_parser.add_argument('--repeat', type=int, default=200)
+    search_parser.add_argument('--seed', type=int, default=1)
+    search_parser.set_defaults(func=bench_search)
+
+    memory_parser = scenarios.add_parser(
+        'memory', help='память на сообщение в истории')
+    memory_parser.add_argument('--messages', type=int, default=1_000_000)
+    memory_parser.add_argument('--users', type=int, default=1000)
+    memory_parser.set_defaults(func=bench_memory)
+
+    logging_parser = scenarios.add_parser(
+        'logging', help='влияние медленного вывода лога на цикл событий')
+    logging_parser.add_argument('--records', type=int, default=5000)
+    logging_parser.add_argument('--burst', type=int, default=10)
+    logging_parser.add_argument(
+        '--interval', type=float, default=0.001,
+        help='пауза между пачками записей и период замера задержки, сек.')
+    logging_parser.add_argument(
+        '--delay', type=float, default=0.001,
+        help='время записи одной строки в медленный вывод, сек.')
+    logging_parser.add_argument('--queue', type=int, default=1000)
+    logging_parser.add_argument(
+        '--policy', choices=('drop_new', 'drop_oldest'), default='drop_new')
+    logging_parser.set_defaults(func=bench_logging)
+
+    http_parser = scenarios.add_parser(
+        'http', help='HTTP API в сравнении с собственным протоколом')
+    http_parser.add_argument('--senders', type=int, default=10)
+    http_parser.add_argument('--messages', type=int, default=200)
+    http_parser.add_argument(
+        '--pipeline', type=int, default=8,
+        help='запросов, отправляемых без ожидания ответа')
+    http_parser.add_argument('--settle', type=float, default=0.5)
+    http_parser.add_argument('--timeout', type=float, default=60.0)
+    http_parser.set_defaults(func=bench_http)
+
+    transport_parser = scenarios.add_parser(
+        'transport', help='пропускная способность транспортов сервера')
+    transport_parser.add_argument('--senders', type=int, default=10)
+    transport_parser.add_argument('--receivers', type=int, default=50)
+    transport_parser.add_argument('--messages', type=int, default=200)
+    transport_parser.add_argument('--timeout', type=float, default=120.0)
+    transport_parser.set_defaults(func=bench_transport)
+
+    load_parser = scenarios.add_parser(
+        'load', help='генератор нагрузки с множеством пользователей')
+    load_parser.add_argument('scenario', choices=sorted(LOAD_SCENARIOS))
+    load_parser.add_argument('--users', type=int, default=200)
+    load_parser.add_argument(
+        '--senders', type=int, default=10,
+        help='кол-во пишущих пользователей (broadcast, reconnect)')
+    load_parser.add_argument('--messages', type=int, default=20)
+    load_parser.add_argument(
+        '--interval', type=float, default=0.0,
+        help='пауза между раундами отправки, сек.')
+    load_parser.add_argument(
+        '--wave', type=float, default=0.5,
+        help='доля переподключающихся пользователей (reconnect)')
+    load_parser.add_argument(
+        '--delay', type=int, default=1, help='задержка /delay, сек.')
+    load_parser.add_argument(
+        '--concurrency', type=int, default=100,
+        help='кол-во одновременных подключений')
+    load_parser.add_argument('--settle', type=float, default=0.5)
+    load_parser.add_argument('--timeout', type=float, default=120.0)
+    load_parser.add_argument('--host', default='127.0.0.1')
+    load_parser.add_argument(
+        '--port', type=int, default=0,
+        help='порт работающего сервера (по умолчанию запускается свой)')
+    load_parser.add_argument(
+        '--transport', choices=('streams', 'protocol'), default='streams')
+    load_parser.add_argument('--workers', type=int, default=1)
+    load_parser.set_defaults(func=bench_load)
+
+    args = parser.parse_args()
+    report = args.func(args)
+    if args.json:
+        print(json.dumps({args.scenario: report}, indent=2))
+    else:
+        print_report(args.scenario, report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,474 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import struct
+from asyncio.streams import StreamReader, StreamWriter
+from collections import deque
+from multiprocessing.process import BaseProcess
+from typing import Awaitable, Callable, Iterable, Optional, Union
+
+from message import (
+    Message,
+    message_object_to_record,
+    message_record_to_object,
+    now_us,
+)
+from ratelimit import RateLimiter
+from rooms import RoomIndex
+from scheduler import DelayedMessageScheduler
+from settings import Settings
+from wal import MessageLog, MessageLogError
+
+settings = Settings()
+
+logger = logging.getLogger(__name__)
+
+# Заголовок события на шине: длина JSON-представления
+EVENT_HEADER = struct.Struct('!I')
+
+EventHandler = Callable[[dict], Awaitable[None]]
+
+
+def encode_event(event: dict) -> bytes:
+    """
+    Сериализует событие для передачи через сокет брокера. Сообщение
+    в событии брокера уже закодировано для журнала, и его запись
+    вставляется в событие как есть.
+    """
+    message_obj = event.get('message')
+    if isinstance(message_obj, Message):
+        payload = b'{"type":"message","message":%s}' % (
+            message_obj.record_bytes)
+    else:
+        payload = json.dumps(
+            event, ensure_ascii=False, separators=(',', ':')).encode()
+    return EVENT_HEADER.pack(len(payload)) + payload
+
+
+async def read_event(reader: StreamReader) -> Optional[dict]:
+    """
+    Читает событие из сокета брокера.
+    Возвращает None при закрытии соединения.
+    """
+    try:
+        header = await reader.readexactly(EVENT_HEADER.size)
+        [length] = EVENT_HEADER.unpack(header)
+        return json.loads(await reader.readexactly(length))
+    except asyncio.IncompleteReadError:
+        return None
+
+
+async def dispatch(handler: EventHandler, event: dict) -> None:
+    """
+    Передает событие обработчику. Ошибка при обработке одного события
+    пишется в лог и не останавливает доставку следующих.
+    """
+    try:
+        await handler(event)
+    except Exception as error:
+        logger.error(
+            f'Ошибка при обработке события {event.get("type")!r}: {error!r}')
+
+
+class ChatBroker:
+    """
+    Единая точка упорядочивания событий чата.
+
+    Присваивает сообщениям сквозные номера, пишет их в журнал, ведет
+    отложенные сообщения и рассылает события всем серверам-обработчикам
+    (sink). Все обработчики получают события в одном и том же порядке,
+    поэтому их хранилища сообщений совпадают.
+
+    Событие сообщения содержит объект Message, а не словарь записи.
+    Сообщения и изменения комнат рассылаются только после записи
+    в журнал на диск, а следующие за ними события ждут их, чтобы
+    не обогнать.
+
+    Лимиты сообщений тоже проверяет брокер: так они общие для всех
+    рабочих процессов и не сбрасываются при переподключении.
+    """
+
+    def __init__(self, message_log: MessageLog, last_seq: int = 0):
+        self.message_log = message_log
+        self.last_seq = last_seq
+        self.scheduler = DelayedMessageScheduler(self.send_delayed_message)
+        self.sink: Callable[[dict], None] = lambda event: None
+        # События в порядке выдачи, ждущие записи на диск, и id еще
+        # не записанных в журнал событий с автором и текстом отказа
+        self._held: deque[dict] = deque()
+        self._writing: dict[int, tuple[str, str]] = {}
+        # Комнаты по событиям из журнала: перед удалением старых
+        # сегментов их снимок пишется в журнал заново
+        self.rooms = RoomIndex()
+        period = settings.LIMIT_PERIOD_SEC
+        self.public_limiter = RateLimiter(settings.LIMIT_MESSAGES_CNT, period)
+        self.private_limiter = RateLimiter(settings.LIMIT_PRIVATE_CNT, period)
+        self.delay_limiter = RateLimiter(settings.LIMIT_DELAY_CNT, period)
+
+    def restore(self, ttl_sec: float) -> None:
+        """
+        Восстанавливает по журналу последний выданный номер сообщения
+        и комнаты.
+        """
+        for record in self.message_log.replay(ttl_sec):
+            record_type = record.get('type')
+            if record_type == 'room':
+                self.rooms.apply(record)
+            elif record_type == 'rooms':
+                self.rooms.load(record['rooms'])
+            else:
+                self.last_seq = max(self.last_seq, record['seq'])
+
+    def handle(self, event: dict) -> None:
+        """
+        Обрабатывает событие от сервера-обработчика.
+        """
+        event_type = event['type']
+        if event_type == 'message':
+            if self.check_limit(event['message']):
+                self.publish_message(event['message'])
+        elif event_type == 'delay':
+            message_obj = message_record_to_object(event['message'])
+            if not self.delay_limiter.allow(message_obj.author):
+                self.notify(
+                    message_obj.author,
+                    'Вы исчерпали лимит отложенных сообщений !')
+                return
+            message_id = self.scheduler.schedule(message_obj, event['delay'])
+            self.notify(
+                message_obj.author,
+                f'Сообщение #{message_id} будет отправлено '
+                f'через {event["delay"]} сек.')
+        elif event_type == 'cancel':
+            if self.scheduler.cancel(event['id'], event['author']):
+                text = f'Сообщение #{event["id"]} отменено.'
+            else:
+                text = f'Сообщение #{event["id"]} не найдено.'
+            self.notify(event['author'], text)
+        elif event_type == 'clear':
+            count = self.scheduler.clear(event['author'])
+            self.notify(event['author'], f'Отменено сообщений: {count}.')
+        elif event_type == 'room':
+            if self.write_ahead(
+                    event, event, event['username'],
+                    'Изменение комнаты не сохранено'):
+                self.rooms.apply(event)
+        else:
+            self.emit(event)
+
+    def check_limit(self, record: dict) -> bool:
+        """
+        Проверяет лимит сообщений автора в общий чат или личных
+        сообщений и сообщает автору о превышении.
+        """
+        author = record['author']
+        if not record['to_username']:
+            if self.public_limiter.allow(author):
+                return True
+            text = 'Вы исчерпали лимит сообщений в общем чате !'
+        else:
+            if self.private_limiter.allow(author):
+                return True
+            text = 'Вы исчерпали лимит личных сообщений !'
+        self.notify(author, text)
+        return False
+
+    def publish_message(self, record: dict) -> None:
+        """
+        Присваивает сообщению номер и пишет его в журнал. Сообщение
+        рассылается, когда запись сброшена на диск; сообщение, которое
+        не удалось записать, не рассылается.
+        """
+        record['seq'] = self.last_seq + 1
+        # Событие несет сам объект сообщения: запись JSON кодируется
+        # один раз для журнала, сокета брокера и клиентов HTTP API
+        message_obj = message_record_to_object(record)
+        event = {'type': 'message', 'message': message_obj}
+        if self.write_ahead(
+                event, message_obj.record_bytes, message_obj.author,
+                'Сообщение не сохранено'):
+            self.last_seq = record['seq']
+
+    def write_ahead(
+            self, event: dict, record: Union[dict, bytes], username: str,
+            failure: str) -> bool:
+        """
+        Пишет запись события в журнал и рассылает событие после ее
+        записи на диск. При ошибке журнала событие не рассылается,
+        а пользователь username получает уведомление failure.
+        Возвращает False, если журнал не принял запись.
+        """
+        loop = asyncio.get_running_loop()
+
+        def on_commit(error: Optional[OSError]) -> None:
+            # Вызывается в потоке записи журнала
+            try:
+                loop.call_soon_threadsafe(self._committed, event, error)
+            except RuntimeError:
+                # Цикл событий уже остановлен, рассылать некому
+                pass
+
+        try:
+            self.message_log.append(record, on_commit)
+        except MessageLogError as error:
+            self.notify(username, f'{failure}: {error}')
+            return False
+        self._writing[id(event)] = (username, failure)
+        self.emit(event)
+        return True
+
+    def _committed(self, event: dict, error: Optional[OSError]) -> None:
+        username, failure = self._writing.pop(id(event))
+        if error is not None:
+            self._held.remove(event)
+            self.notify(username, f'{failure}: {error}')
+        self._release()
+
+    def emit(self, event: dict) -> None:
+        """
+        Рассылает событие после всех ранее выданных событий.
+        """
+        self._held.append(event)
+        self._release()
+
+    def _release(self) -> None:
+        # Рассылаем события до первого сообщения, ждущего записи
+        while self._held and id(self._held[0]) not in self._writing:
+            self.sink(self._held.popleft())
+
+    def notify(self, username: str, text: str) -> None:
+        """
+        Посылает служебное сообщение пользователю username.
+        """
+        self.emit({'type': 'notice', 'to': username, 'text': text})
+
+    def send_delayed_message(self, message_obj: Message) -> None:
+        """
+        Отправляет в общий чат отложенное сообщение, время которого
+        наступило (вызывается планировщиком).
+        """
+        message_obj.timestamp_us = now_us()
+        self.publish_message(message_object_to_record(message_obj))
+
+    def save_rooms(self) -> None:
+        """
+        Пишет в журнал снимок комнат. Снимок попадает в текущий сегмент
+        раньше команды удаления старых сегментов, поэтому комнаты,
+        созданные в удаляемых сегментах, восстанавливаются из него.
+        """
+        if not self.rooms.rooms:
+            return
+        try:
+            self.message_log.append(
+                {'type': 'rooms', 'rooms': self.rooms.snapshot()})
+        except MessageLogError as error:
+            logger.error(f'Снимок комнат не сохранен: {error}')
+
+    async def run_compaction(self, interval: float) -> None:
+        """
+        Периодически удаляет сегменты журнала со старыми сообщениями.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            self.save_rooms()
+            self.message_log.compact()
+
+    async def run_limiter_sweep(self, interval: float) -> None:
+        """
+        Удаляет лимиты неактивных пользователей.
+        """
+        await asyncio.gather(*(
+            limiter.run_sweep(interval) for limiter in (
+                self.public_limiter, self.private_limiter,
+                self.delay_limiter)
+        ))
+
+    async def close(self) -> None:
+        """
+        Останавливает планировщик и дописывает журнал на диск.
+        """
+        self.scheduler.close()
+        logger.info(
+            f'Отложенные сообщения: ожидают {self.scheduler.pending}, '
+            f'отправлено {self.scheduler.fired}, '
+            f'отменено {self.scheduler.cancelled}.'
+        )
+        await asyncio.to_thread(self.message_log.close)
+        logger.info(
+            f'История чата сохранена в {self.message_log.directory}: '
+            f'записей {self.message_log.written}, '
+            f'сбросов на диск {self.message_log.fsyncs}.'
+        )
+
+
+class LocalBus:
+    """
+    Шина событий внутри одного процесса: брокер работает в том же
+    цикле событий, что и единственный сервер.
+    """
+
+    def __init__(self, broker: ChatBroker):
+        self.broker = broker
+        self.broker.sink = self._deliver
+        self._queue: asyncio.Queue[dict] = asyncio.Queue()
+
+    async def publish(self, event: dict) -> None:
+        self.broker.handle(event)
+
+    def _deliver(self, event: dict) -> None:
+        self._queue.put_nowait(event)
+
+    async def run(self, handler: EventHandler) -> None:
+        """
+        Передает события брокера обработчику по порядку.
+        """
+        while True:
+            event = await self._queue.get()
+            await dispatch(handler, event)
+
+    async def close(self) -> None:
+        await self.broker.close()
+
+
+class SocketBus:
+    """
+    Шина событий рабочего процесса: связь с брокером в родительском
+    процессе через Unix domain socket.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.reader: Optional[StreamReader] = None
+        self.writer: Optional[StreamWriter] = None
+        self.closing: bool = False
+
+    async def connect(self) -> None:
+        """
+        Подключается к брокеру и ждет, пока подключатся все рабочие
+        процессы, чтобы ни один из них не пропустил события.
+        """
+        self.reader, self.writer = await asyncio.open_unix_connection(
+            self.path)
+        event = await read_event(self.reader)
+        if event is None or event['type'] != 'ready':
+            raise ConnectionError('Брокер не подтвердил подключение')
+
+    async def publish(self, event: dict) -> None:
+        if self.writer is None:
+            raise ConnectionError('Нет подключения к брокеру')
+        if not self.closing:
+            self.writer.write(encode_event(event))
+
+    async def run(self, handler: EventHandler) -> None:
+        """
+        Передает события брокера обработчику по порядку.
+        При потере связи с брокером вызывает ConnectionError.
+        """
+        reader = self.reader
+        if reader is None:
+            raise ConnectionError('Нет подключения к брокеру')
+        while True:
+            event = await read_event(reader)
+            if event is None:
+                if not self.closing:
+                    raise ConnectionError('Соединение с брокером потеряно')
+                return
+            await dispatch(handler, event)
+
+    async def close(self) -> None:
+        self.closing = True
+        if self.writer is not None:
+            self.writer.close()
+
+
+def join_processes(processes: Iterable[BaseProcess]) -> None:
+    """
+    Ждет завершения процессов (вызывается в отдельном потоке).
+    """
+    for process in processes:
+        process.join()
+
+
+class BrokerServer:
+    """
+    Брокер для режима с несколькими рабочими процессами.
+
+    Рабочие процессы принимают клиентов на общем порту (SO_REUSEPORT)
+    и обмениваются событиями через брокер в родительском процессе.
+    """
+
+    def __init__(self, broker: ChatBroker, path: str, workers: int):
+        self.broker = broker
+        self.broker.sink = self._deliver
+        self.path = path
+        self.workers = workers
+        self._writers: list[StreamWriter] = []
+        self._stopped = asyncio.Event()
+
+    def _deliver(self, event: dict) -> None:
+        data = encode_event(event)
+        for writer in self._writers:
+            if not writer.is_closing():
+                writer.write(data)
+        if event['type'] == 'stop':
+            self._stopped.set()
+
+    async def worker_connected(
+            self, reader: StreamReader, writer: StreamWriter) -> None:
+        self._writers.append(writer)
+        if len(self._writers) == self.workers:
+            self._deliver({'type': 'ready'})
+            logger.info(f'Подключено рабочих процессов: {self.workers}.')
+        try:
+            while True:
+                event = await read_event(reader)
+                if event is None:
+                    break
+                try:
+                    self.broker.handle(event)
+                except Exception as error:
+                    logger.error(
+                        f'Ошибка при обработке события '
+                        f'{event.get("type")!r}: {error!r}')
+        except ConnectionError:
+            pass
+        finally:
+            self._writers.remove(writer)
+            writer.close()
+
+    async def serve(
+            self, worker_target: Callable[[int], None],
+            compaction_interval: float) -> None:
+        """
+        Запускает брокер и рабочие процессы, ждет команды остановки.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        server = await asyncio.start_unix_server(
+            self.worker_connected, self.path)
+
+        context = multiprocessing.get_context('spawn')
+        processes = [
+            context.Process(target=worker_target, args=(index,))
+            for index in range(self.workers)
+        ]
+        for process in processes:
+            process.start()
+
+        tasks = [
+            asyncio.create_task(
+                self.broker.run_compaction(compaction_interval)),
+            asyncio.create_task(self.broker.run_limiter_sweep(
+                settings.LIMIT_SWEEP_INTERVAL_SEC)),
+        ]
+        try:
+            await self._stopped.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.to_thread(join_processes, processes)
+            server.close()
+            await self.broker.close()
+            os.remove(self.path)
@@ -1,45 +1,71 @@
 import asyncio
 import datetime
+import hashlib
 import logging
+import os
 
 from aioconsole import ainput  # type: ignore
 
-from server import Message, message_object_to_str, message_str_to_object
+from message import Message
+from protocol import (
+    FILE_CHUNK_SIZE,
+    FILE_DIGEST_SIZE,
+    FLAG_COMPRESSION,
+    LEGACY_VERSION,
+    PROTOCOL_VERSION,
+    FileFrame,
+    FrameCodec,
+    Incoming,
+    LineCodec,
+    StreamCodec,
+    hello,
+    make_codec,
+    read_hello,
+)
 from settings import Settings
 
 settings = Settings()
 
 logger = logging.getLogger()
 
+# Кол-во попыток переподключения после обрыва соединения и пауза
+# перед первой из них (каждая следующая пауза вдвое длиннее)
+RECONNECT_ATTEMPTS = 5
+RECONNECT_DELAY_SEC = 0.5
+# Каталог для скачанных файлов
+DOWNLOAD_DIR = 'downloads'
+
 
 class Client:
     def __init__(
             self,
             username: str,
             server_host: str = settings.SERVER.HOST,
-            server_port: int = settings.SERVER.PORT
+            server_port: int = settings.SERVER.PORT,
+            protocol_version: int = PROTOCOL_VERSION,
+            compression: bool = True
     ):
         self.server_host = server_host
         self.server_port = server_port
-        self.reader = None
-        self.writer = None
+        # Соединение с сервером открывается в connect
+        self.reader: asyncio.StreamReader
+        self.writer: asyncio.StreamWriter
         self.username = username
+        self.protocol_version = protocol_version
+        # Просить ли сервер сжимать кадры
+        self.compression = compression
+        self.codec: StreamCodec = LineCodec()
+        # Номер последнего полученного сообщения: с него клиент
+        # продолжает после переподключения
+        self.last_seq: int = 0
 
     async def start(self) -> None:
         """
         Подключаемся к серверу и посылаем стартовое сообщение.
         """
         try:
-            self.reader, self.writer = await asyncio.open_connection(
-                self.server_host, self.server_port
-            )
             print(f'Подключаемся к {self.server_host}:{self.server_port}')
-
-            # Отправляем стартовое сообщение с именем пользователя
-            message_obj = Message(username=self.username)
-            message_bytes = message_object_to_str(message_obj).encode()
-            self.writer.write(message_bytes)
-            await self.writer.drain()
+            await self.connect()
 
             # Запускаем корутины для отправки и получения сообщений
             await asyncio.gather(self.listen(), self.send())
@@ -48,21 +74,118 @@ class Client:
             logger.error(f'Произошла ошибка: {error}')
             self.writer.close()
 
+    async def connect(self) -> None:
+        """
+        Открывает соединение с сервером и выполняет рукопожатие.
+        Не требует консольного ввода, поэтому подходит и для
+        генератора нагрузки.
+        """
+        self.reader, self.writer = await asyncio.open_connection(
+            self.server_host, self.server_port
+        )
+        await self.handshake()
+
+    async def handshake(self) -> None:
+        """
+        Согласует с сервером версию протокола и сжатие и посылает
+        стартовое сообщение с именем пользователя.
+        """
+        if self.protocol_version != LEGACY_VERSION:
+            self.writer.write(hello(
+                self.protocol_version,
+                FLAG_COMPRESSION if self.compression else 0))
+            version, flags = await read_hello(self.reader)
+            self.codec = make_codec(
+                version, settings.SERVER.MAX_FRAME_SIZE,
+                settings.SERVER.MAX_FILE_SIZE)
+            if flags & FLAG_COMPRESSION and isinstance(
+                self.codec, FrameCodec
+            ):
+                self.codec.enable_decompression()
+
+        # Отправляем стартовое сообщение с именем пользователя
+        # и номером последнего полученного сообщения
+        message_obj = Message(username=self.username,
+                              created_at=datetime.datetime.now())
+        message_obj.seq = self.last_seq
+        self.writer.write(self.codec.encode([message_obj]))
+        await self.writer.drain()
+
     async def listen(self) -> None:
         """
         Слушает StreamReader и выводит поступающие пользователю сообщения.
         """
-        try:
-            while True:
-                message_bytes = await self.reader.readline()
-                if not message_bytes:
+        while True:
+            try:
+                messages = await self.codec.read(self.reader)
+            except OSError as error:
+                logger.error(f'Произошла ошибка: {error}')
+                messages = None
+            if messages is None:
+                if not await self.reconnect():
                     break
-                message_str = message_bytes.decode().strip()
-                message_obj = message_str_to_object(message_str)
+                continue
+
+            self.acknowledge(self.show(messages))
+
+    def show(self, messages: list[Incoming]) -> list[Message]:
+        """
+        Выводит сообщения и сохраняет полученные файлы.
+        Возвращает выведенные сообщения.
+        """
+        shown = []
+        for message_obj in messages:
+            if isinstance(message_obj, FileFrame):
+                print(f'Файл сохранен: {self.save_file(message_obj)}')
+            else:
                 print(message_obj)
+                shown.append(message_obj)
+        return shown
 
-        except OSError as error:
-            logger.error(f'Произошла ошибка: {error}')
+    def save_file(self, frame: FileFrame) -> str:
+        """
+        Сохраняет файл, выданный сервером по команде /get, в каталог
+        DOWNLOAD_DIR под его идентификатором. Возвращает путь к файлу.
+        """
+        digest = frame.payload[:FILE_DIGEST_SIZE]
+        content = memoryview(frame.payload)[FILE_DIGEST_SIZE:]
+        if hashlib.sha256(content).digest() != digest:
+            logger.error('Файл поврежден при передаче.')
+        os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+        path = os.path.join(DOWNLOAD_DIR, digest.hex())
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def acknowledge(self, messages: list[Message]) -> None:
+        """
+        Запоминает номер последнего полученного сообщения и подтверждает
+        его получение серверу (в бинарном протоколе).
+        """
+        seq = max((message_obj.seq for message_obj in messages), default=0)
+        if seq <= self.last_seq:
+            return
+        self.last_seq = seq
+        if isinstance(self.codec, FrameCodec):
+            self.writer.write(self.codec.encode_ack(seq))
+
+    async def reconnect(self) -> bool:
+        """
+        Переподключается к серверу после обрыва соединения и продолжает
+        получение сообщений с последнего полученного.
+        """
+        self.writer.close()
+        delay = RECONNECT_DELAY_SEC
+        for _ in range(RECONNECT_ATTEMPTS):
+            await asyncio.sleep(delay)
+            try:
+                await self.connect()
+                logger.info('Соединение с сервером восстановлено.')
+                return True
+            except (OSError, EOFError) as error:
+                logger.error(f'Не удалось переподключиться: {error}')
+                delay *= 2
+        return False
 
     async def send(self) -> None:
         """
@@ -72,13 +195,39 @@ class Client:
             user_input = await ainput('')
             if not user_input:  # просто нажали Enter
                 break
+            if user_input.startswith('/send '):
+                [_, path, *to_username] = user_input.split(maxsplit=2)
+                try:
+                    await self.upload(path, ''.join(to_username))
+                except OSError as error:
+                    logger.error(f'Не удалось отправить файл: {error}')
+                continue
 
             message_obj = Message(username=self.username, text=user_input,
                                   created_at=datetime.datetime.now())
-            message_bytes = message_object_to_str(message_obj).encode()
-            self.writer.write(message_bytes)
+            self.writer.write(self.codec.encode([message_obj]))
             await self.writer.drain()
 
+    async def upload(self, path: str, to_username: str = '') -> None:
+        """
+        Загружает файл на сервер частями, не читая его в память целиком.
+        Сервер разошлет получателям сообщение с командой /get.
+        """
+        if not isinstance(self.codec, FrameCodec):
+            logger.error('Файлы передаются только по бинарному протоколу.')
+            return
+        size = os.path.getsize(path)
+        checksum = hashlib.sha256()
+        self.writer.write(self.codec.encode_file_begin(
+            size, os.path.basename(path), to_username))
+        with open(path, 'rb') as f:
+            while chunk := f.read(FILE_CHUNK_SIZE):
+                checksum.update(chunk)
+                self.writer.write(self.codec.encode_file_chunk(chunk))
+                await self.writer.drain()
+        self.writer.write(self.codec.encode_file_end(checksum.digest()))
+        await self.writer.drain()
+
 
 async def main() -> None:
     user_input = str(input('Введите свой username: '))
@@ -0,0 +1,285 @@
+import asyncio
+import itertools
+import logging
+import time
+from abc import ABC, abstractmethod
+from asyncio.streams import StreamWriter
+from typing import BinaryIO, Optional, Sequence, Union
+
+import metrics
+from message import Message
+from protocol import Codec, LineCodec
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = 'drop_oldest'
+DISCONNECT = 'disconnect'
+BLOCK = 'block'
+
+
+class OutgoingFile:
+    """
+    Файл в очереди отправки: заголовок кадра и открытый файл,
+    содержимое которого уходит в сокет через sendfile.
+    """
+
+    def __init__(self, header: bytes, file: BinaryIO):
+        self.header = header
+        self.file = file
+
+
+Outgoing = Union[bytes, OutgoingFile]
+# Признак того, что очередь отправки разобрана до конца
+_QUEUE_EMPTY = object()
+# Идентификаторы подключений для лога
+_connection_ids = itertools.count(1)
+
+
+def discard(item: object) -> None:
+    """
+    Отбрасывает неотправленные данные: файл из очереди закрывается.
+    """
+    if isinstance(item, OutgoingFile):
+        item.file.close()
+
+
+class BaseConnection(ABC):
+    """
+    Подключение клиента, не зависящее от транспорта.
+    """
+
+    def __init__(
+            self,
+            queue_size: int,
+            policy: str = DROP_OLDEST,
+            codec: Optional[Codec] = None
+    ):
+        self.queue_size = queue_size
+        self.policy = policy
+        self.codec: Codec = codec or LineCodec()
+        self.id: int = next(_connection_ids)
+        self.dropped: int = 0
+        self.closed: bool = False
+        self.username: str = ''
+        # Номер последнего сообщения, отправленного клиенту, и признак
+        # догрузки пропущенных сообщений (на это время живая рассылка
+        # сохраненных сообщений клиенту приостанавливается)
+        self.sent_seq: int = 0
+        self.catching_up: bool = False
+
+    @property
+    @abstractmethod
+    def queue_depth(self) -> int:
+        """
+        Кол-во записей, ожидающих отправки клиенту.
+        """
+
+    def send_nowait(self, data: Outgoing) -> bool:
+        """
+        Ставит данные в очередь отправки без ожидания. Переполнение
+        очереди обрабатывается по политике медленного клиента.
+        Возвращает False, если очередь заполнена и политика
+        требует ожидания (block).
+        """
+        if self.closed:
+            return True
+        if self.queue_depth >= self.queue_size:
+            if self.policy == BLOCK:
+                return False
+            if self.policy == DISCONNECT:
+                logger.warning(
+                    'Очередь клиента переполнена, клиент отключен.')
+                self.abort()
+                return True
+            # DROP_OLDEST: освобождаем место за счет самого старого
+            discard(self._pop_oldest())
+            self.dropped += 1
+            metrics.messages_dropped.inc()
+        self._append(data)
+        return True
+
+    @abstractmethod
+    def _pop_oldest(self) -> Optional[Outgoing]:
+        """
+        Забирает из очереди отправки самую старую запись.
+        """
+
+    @abstractmethod
+    def _append(self, data: Outgoing) -> None:
+        """
+        Ставит данные в конец очереди отправки (место в ней есть).
+        """
+
+    @abstractmethod
+    async def send(self, data: Outgoing) -> None:
+        """
+        Отправляет данные с учетом политики медленного клиента.
+        """
+
+    async def send_file(self, header: bytes, file: BinaryIO) -> None:
+        """
+        Отправляет заголовок и содержимое открытого файла по порядку
+        с остальными данными. Содержимое передается через sendfile
+        без чтения в память процесса; файл закрывается после отправки.
+        """
+        await self.send(OutgoingFile(header, file))
+
+    async def send_messages(self, messages: Sequence[Message]) -> None:
+        """
+        Кодирует сообщения согласованным протоколом и отправляет
+        одной записью.
+        """
+        if messages:
+            await self.send(self.codec.encode(messages))
+
+    @abstractmethod
+    async def wait_flushed(self) -> None:
+        """
+        Ждет, пока очередь отправки не опустеет (или подключение
+        не закроется).
+        """
+
+    @property
+    def cursor(self) -> int:
+        """
+        Номер, с которого клиент продолжит получать сообщения после
+        переподключения: подтвержденный клиентом, а если клиент
+        не подтверждает получение - последний отправленный.
+        """
+        return self.codec.acked_seq or self.sent_seq
+
+    @abstractmethod
+    def abort(self) -> None:
+        """
+        Немедленно закрывает подключение.
+        """
+
+    @abstractmethod
+    async def close(self) -> None:
+        """
+        Дописывает неотправленные данные и закрывает подключение.
+        """
+
+
+class Connection(BaseConnection):
+    """
+    Подключение клиента с ограниченной очередью исходящих сообщений.
+
+    Очередь разгребает отдельная задача-писатель, поэтому медленный клиент
+    не задерживает доставку сообщений остальным участникам чата.
+    """
+
+    def __init__(
+            self,
+            writer: StreamWriter,
+            queue_size: int,
+            policy: str = DROP_OLDEST,
+            codec: Optional[Codec] = None
+    ):
+        super().__init__(queue_size, policy, codec)
+        self.writer = writer
+        self.queue: asyncio.Queue[Optional[Outgoing]] = asyncio.Queue(
+            maxsize=queue_size)
+        self._flushed = asyncio.Event()
+        self._task = asyncio.create_task(self._write_loop())
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+
+    def _pop_oldest(self) -> Optional[Outgoing]:
+        return self.queue.get_nowait()
+
+    def _append(self, data: Outgoing) -> None:
+        self.queue.put_nowait(data)
+
+    async def send(self, data: Outgoing) -> None:
+        """
+        Ставит данные в очередь с учетом политики медленного клиента.
+        """
+        if not self.send_nowait(data):
+            await self.queue.put(data)
+
+    async def _write_loop(self) -> None:
+        """
+        Забирает данные из очереди и пишет их в сокет, склеивая
+        накопившиеся сообщения в одну запись. Файлы отправляются
+        отдельно через sendfile.
+        """
+        item: Optional[Outgoing] = None
+        try:
+            item = await self.queue.get()
+            while item is not None:
+                if isinstance(item, OutgoingFile):
+                    await self._write_file(item)
+                    item = await self.queue.get()
+                    continue
+                chunks = [item]
+                item = self._collect(chunks)
+                self.writer.writelines(self.codec.compress(chunks))
+                started = time.perf_counter()
+                await self.writer.drain()
+                metrics.drain_seconds.observe(time.perf_counter() - started)
+                self._flushed.set()
+                if item is _QUEUE_EMPTY:
+                    item = await self.queue.get()
+        except (ConnectionError, OSError) as error:
+            logger.error(f'Ошибка записи в сокет клиента: {error}')
+        finally:
+            self.closed = True
+            self._flushed.set()
+            # Файл, на котором оборвалась запись, и очередь отбрасываются,
+            # чтобы не держать открытые файлы и ожидающих отправителей
+            discard(item)
+            while not self.queue.empty():
+                discard(self.queue.get_nowait())
+            self.writer.close()
+
+    def _collect(self, chunks: list[bytes]):
+        """
+        Забирает из очереди идущие подряд данные в chunks. Возвращает
+        первый элемент, который нельзя склеить с ними (файл или признак
+        закрытия), либо _QUEUE_EMPTY.
+        """
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if not isinstance(item, bytes):
+                return item
+            chunks.append(item)
+        return _QUEUE_EMPTY
+
+    async def _write_file(self, outgoing: OutgoingFile) -> None:
+        with outgoing.file:
+            if self.writer.is_closing():
+                return
+            self.writer.write(outgoing.header)
+            await asyncio.get_running_loop().sendfile(
+                self.writer.transport, outgoing.file)
+
+    async def wait_flushed(self) -> None:
+        while not self.queue.empty() and not self.closed:
+            self._flushed.clear()
+            await self._flushed.wait()
+
+    def abort(self) -> None:
+        """
+        Немедленно закрывает подключение, отбрасывая очередь.
+        """
+        self.closed = True
+        self._task.cancel()
+
+    async def close(self) -> None:
+        """
+        Дописывает очередь и закрывает подключение.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
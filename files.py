@@ -0,0 +1,160 @@
+import asyncio
+import hashlib
+import logging
+import os
+import secrets
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Суффикс временных файлов незавершенных загрузок
+PART_SUFFIX = '.part'
+# Длина идентификатора файла - sha256 в шестнадцатеричном виде
+FILE_ID_LENGTH = 64
+
+
+class FileTransferError(Exception):
+    """
+    Ошибка загрузки или выдачи файла.
+    """
+
+
+class Upload:
+    """
+    Принимаемый от клиента файл.
+
+    Части файла сразу пишутся во временный файл на диске, контрольная
+    сумма считается по ходу записи, поэтому файл целиком в памяти
+    не держится.
+    """
+
+    def __init__(self, path: str, name: str, size: int, to_username: str):
+        self.path = path
+        self.name = name
+        self.size = size
+        self.to_username = to_username
+        self.received: int = 0
+        self.hash = hashlib.sha256()
+        self.file = open(path, 'wb')
+
+    def write(self, data: bytes) -> None:
+        """
+        Дописывает часть файла (вызывается в потоке, чтобы не ждать
+        диска в цикле событий).
+        """
+        self.received += len(data)
+        if self.received > self.size:
+            raise FileTransferError(
+                f'Файл {self.name} больше заявленного размера.')
+        self.file.write(data)
+        self.hash.update(data)
+
+    def abort(self) -> None:
+        """
+        Прерывает загрузку и удаляет временный файл.
+        """
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class FileStore:
+    """
+    Хранилище файлов с адресацией по содержимому.
+
+    Имя файла на диске - его sha256, поэтому одинаковые файлы хранятся
+    один раз, а рабочие процессы могут делить общий каталог. Файлы
+    удаляются вместе с сообщениями по истечении ttl: повторная загрузка
+    того же файла продлевает его жизнь.
+    """
+
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+
+    def open(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+
+    def begin(self, name: str, size: int, to_username: str = '') -> Upload:
+        """
+        Начинает загрузку файла name размером size байт.
+        """
+        if size > self.max_size:
+            raise FileTransferError(
+                f'Файл {name} больше {self.max_size} байт.')
+        path = os.path.join(
+            self.directory, secrets.token_hex(8) + PART_SUFFIX)
+        return Upload(path, os.path.basename(name), size, to_username)
+
+    async def write(self, upload: Upload, data: bytes) -> None:
+        try:
+            await asyncio.to_thread(upload.write, data)
+        except (FileTransferError, OSError):
+            upload.abort()
+            raise
+
+    async def finish(self, upload: Upload, digest: bytes) -> str:
+        """
+        Завершает загрузку: сверяет размер и контрольную сумму и кладет
+        файл в хранилище. Возвращает идентификатор файла.
+        """
+        upload.file.close()
+        if upload.received != upload.size or upload.hash.digest() != digest:
+            upload.abort()
+            raise FileTransferError(
+                f'Файл {upload.name} поврежден при передаче.')
+        file_id = digest.hex()
+        path = os.path.join(self.directory, file_id)
+        if os.path.exists(path):
+            # Такой файл уже есть: оставляем его и продлеваем жизнь
+            upload.abort()
+            os.utime(path)
+        else:
+            os.replace(upload.path, path)
+        return file_id
+
+    def path(self, file_id: str) -> Optional[str]:
+        """
+        Возвращает путь к файлу по идентификатору или None, если
+        такого файла нет.
+        """
+        if len(file_id) != FILE_ID_LENGTH or not all(
+            char in '0123456789abcdef' for char in file_id
+        ):
+            return None
+        path = os.path.join(self.directory, file_id)
+        return path if os.path.isfile(path) else None
+
+    def compact(self, ttl_sec: float) -> int:
+        """
+        Удаляет файлы и незавершенные загрузки старше ttl_sec.
+        Возвращает кол-во удаленных файлов.
+        """
+        deadline = time.time() - ttl_sec
+        removed = 0
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.stat().st_mtime < deadline:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                # Файл уже удалил другой рабочий процесс
+                continue
+        return removed
+
+    async def run_compaction(self, ttl_sec: float, interval: float) -> None:
+        """
+        Периодически удаляет устаревшие файлы.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                removed = await asyncio.to_thread(self.compact, ttl_sec)
+            except OSError as error:
+                logger.error(f'Ошибка очистки каталога файлов: {error}')
+                continue
+            if removed:
+                logger.info(f'Удалено устаревших файлов: {removed}.')
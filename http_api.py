@@ -0,0 +1,498 @@
+import asyncio
+import json
+import logging
+import math
+import secrets
+import time
+from asyncio.streams import StreamReader, StreamWriter
+from collections import deque
+from http import HTTPStatus
+from typing import TYPE_CHECKING, Awaitable, Callable, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+from connection import BaseConnection, Outgoing
+from message import Message
+from protocol import EventStreamCodec, JsonCodec
+from rooms import is_valid_username
+from settings import Settings
+
+if TYPE_CHECKING:
+    from server import Server
+
+settings = Settings()
+
+logger = logging.getLogger(__name__)
+
+HEADERS_END = b'\r\n\r\n'
+# Период комментариев-пингов в потоке SSE: по ним сервер замечает
+# закрытые клиентом потоки, а прокси не закрывают молчащие
+SSE_PING_SEC = 15.0
+# Период поиска брошенных клиентами сессий
+SESSION_SWEEP_INTERVAL_SEC = 5.0
+
+
+class HttpError(Exception):
+    """
+    Ошибка обработки HTTP-запроса, возвращаемая клиенту со статусом.
+    """
+
+    def __init__(self, status: HTTPStatus, text: str = ''):
+        super().__init__(text or status.phrase)
+        self.status = status
+
+
+class Request:
+    """
+    Разобранный HTTP-запрос.
+    """
+
+    def __init__(
+            self, method: str, target: str, version: str,
+            headers: dict[str, str]):
+        self.method = method
+        url = urlsplit(target)
+        self.path = url.path
+        self.query = dict(parse_qsl(url.query))
+        self.version = version
+        # Имена заголовков приведены к нижнему регистру
+        self.headers = headers
+        self.body = b''
+
+    @property
+    def keep_alive(self) -> bool:
+        """
+        Оставить ли соединение открытым после ответа: в HTTP/1.1
+        по умолчанию да, в HTTP/1.0 - только по просьбе клиента.
+        """
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    def json(self) -> dict:
+        try:
+            data = json.loads(self.body or b'{}')
+        except ValueError as error:
+            raise HttpError(
+                HTTPStatus.BAD_REQUEST, f'Некорректный JSON: {error}')
+        if not isinstance(data, dict):
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'Ожидается объект JSON')
+        return data
+
+
+def parse_head(head: bytes) -> Request:
+    """
+    Разбирает строку запроса и заголовки.
+    """
+    try:
+        lines = head.decode('latin-1').split('\r\n')
+        method, target, version = lines[0].split(' ')
+    except ValueError:
+        raise HttpError(HTTPStatus.BAD_REQUEST, 'Некорректная строка запроса')
+    if version not in ('HTTP/1.0', 'HTTP/1.1'):
+        raise HttpError(HTTPStatus.HTTP_VERSION_NOT_SUPPORTED)
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, separator, value = line.partition(':')
+        if not separator or not name or name != name.strip():
+            raise HttpError(
+                HTTPStatus.BAD_REQUEST, 'Некорректный заголовок')
+        headers[name.lower()] = value.strip()
+    return Request(method, target, version, headers)
+
+
+def body_length(request: Request, max_body_size: int) -> int:
+    """
+    Возвращает длину тела запроса из Content-Length.
+    """
+    if 'transfer-encoding' in request.headers:
+        raise HttpError(
+            HTTPStatus.NOT_IMPLEMENTED, 'Поддерживается только Content-Length')
+    value = request.headers.get('content-length', '0')
+    if not value.isdigit():
+        raise HttpError(HTTPStatus.BAD_REQUEST, 'Некорректный Content-Length')
+    length = int(value)
+    if length > max_body_size:
+        raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+    return length
+
+
+async def read_request(
+        reader: StreamReader, max_body_size: int) -> Optional[Request]:
+    """
+    Читает очередной запрос соединения. Заголовки ограничены размером
+    буфера reader (limit сервера), тело - max_body_size. Запросы,
+    присланные подряд без ожидания ответа (pipelining), остаются
+    в буфере reader до следующего вызова.
+    Возвращает None, если клиент закрыл соединение между запросами.
+    """
+    try:
+        head = await reader.readuntil(HEADERS_END)
+    except asyncio.IncompleteReadError as error:
+        if not error.partial.strip():
+            return None
+        raise HttpError(HTTPStatus.BAD_REQUEST, 'Запрос оборван')
+    except asyncio.LimitOverrunError:
+        raise HttpError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+    request = parse_head(head[:-len(HEADERS_END)])
+    length = body_length(request, max_body_size)
+    if length:
+        try:
+            request.body = await reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'Тело запроса оборвано')
+    return request
+
+
+def response(
+        status: HTTPStatus, body: bytes = b'',
+        content_type: str = 'application/json; charset=utf-8',
+        keep_alive: bool = True) -> bytes:
+    """
+    Формирует ответ целиком: строку статуса, заголовки и тело.
+    """
+    return (
+        f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+        f'Content-Type: {content_type}\r\n'
+        f'Content-Length: {len(body)}\r\n'
+        f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'
+    ).encode() + body
+
+
+def json_response(
+        data: dict, status: HTTPStatus = HTTPStatus.OK,
+        keep_alive: bool = True) -> bytes:
+    body = json.dumps(data, ensure_ascii=False).encode()
+    return response(status, body, keep_alive=keep_alive)
+
+
+class HttpConnection(BaseConnection):
+    """
+    Сессия клиента HTTP API.
+
+    Клиент HTTP не держит постоянного соединения, поэтому сообщения
+    ставятся в очередь сессии той же рассылкой, что и для TCP-клиентов,
+    а клиент забирает их запросом long-poll или потоком SSE.
+    Переполнение очереди обрабатывается по политике медленного клиента.
+    """
+
+    def __init__(
+            self,
+            token: str,
+            queue_size: int,
+            policy: str,
+            codec: JsonCodec
+    ):
+        super().__init__(queue_size, policy, codec)
+        self.token = token
+        self.codec: JsonCodec = codec
+        # Время последнего обращения клиента и кол-во запросов,
+        # ожидающих сейчас сообщений сессии
+        self.last_active: float = time.monotonic()
+        self.waiters: int = 0
+        self._backlog: deque[bytes] = deque()
+        self._ready = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._backlog)
+
+    def send_nowait(self, data: Outgoing) -> bool:
+        if not isinstance(data, bytes):
+            # Файлы выдаются только по бинарному протоколу
+            data.file.close()
+            return True
+        return super().send_nowait(data)
+
+    def _pop_oldest(self) -> Optional[Outgoing]:
+        return self._backlog.popleft()
+
+    def _append(self, data: Outgoing) -> None:
+        # Файлы отсеиваются в send_nowait
+        assert isinstance(data, bytes)
+        self._backlog.append(data)
+        self._ready.set()
+
+    async def send(self, data: Outgoing) -> None:
+        while not self.send_nowait(data):
+            self._writable.clear()
+            await self._writable.wait()
+
+    async def receive(self, timeout: float) -> list[bytes]:
+        """
+        Забирает накопленные данные, ожидая их не дольше timeout секунд.
+        """
+        if not self._backlog and not self.closed:
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        chunks = list(self._backlog)
+        self._backlog.clear()
+        self.last_active = time.monotonic()
+        self._drained.set()
+        self._writable.set()
+        return chunks
+
+    async def wait_flushed(self) -> None:
+        while self._backlog and not self.closed:
+            self._drained.clear()
+            await self._drained.wait()
+
+    def abort(self) -> None:
+        self.closed = True
+        self._backlog.clear()
+        for event in (self._ready, self._drained, self._writable):
+            event.set()
+
+    async def close(self) -> None:
+        # Клиент не подключен постоянно, дописывать очередь некуда
+        self.abort()
+
+
+Handler = Callable[[Request, StreamWriter], Awaitable[Optional[bytes]]]
+
+
+class HttpApi:
+    """
+    HTTP/1.1 API чата, работающее рядом с основным протоколом.
+
+    POST /connect - открыть сессию, POST /send - отправить сообщение
+    или команду, GET /messages - забрать сообщения (long-poll),
+    GET /events - поток сообщений Server-Sent Events, GET /status -
+    состояние сервера, POST /disconnect - закрыть сессию.
+
+    Соединения постоянные (keep-alive), запросы, присланные подряд
+    без ожидания ответов, обрабатываются по порядку, и ответы уходят
+    в том же порядке. Сессия, клиент которой не обращался к ней
+    HTTP_SESSION_TIMEOUT_SEC секунд, закрывается.
+    """
+
+    def __init__(self, server: 'Server', host: str, port: int):
+        self.server = server
+        self.host = host
+        self.port = port
+        self.sessions: dict[str, HttpConnection] = {}
+        self.http_server: Optional[asyncio.AbstractServer] = None
+        self.tasks: set[asyncio.Task] = set()
+        self.routes: dict[tuple[str, str], Handler] = {
+            ('POST', '/connect'): self.connect,
+            ('POST', '/send'): self.send,
+            ('GET', '/messages'): self.poll,
+            ('GET', '/events'): self.events,
+            ('GET', '/status'): self.status,
+            ('POST', '/disconnect'): self.disconnect,
+        }
+
+    async def start(self) -> None:
+        try:
+            self.http_server = await asyncio.start_server(
+                self.handle_client, self.host, self.port,
+                limit=settings.SERVER.HTTP_MAX_HEADER_SIZE)
+        except OSError as error:
+            logger.error(f'Не удалось открыть порт HTTP API: {error}')
+            return
+        self.spawn(self.run_session_sweep(SESSION_SWEEP_INTERVAL_SEC))
+        logger.info(f'HTTP API доступно на http://{self.host}:{self.port}/')
+
+    def spawn(self, coroutine: Awaitable) -> None:
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def handle_client(
+            self, reader: StreamReader, writer: StreamWriter) -> None:
+        """
+        Обрабатывает запросы постоянного соединения по очереди.
+        """
+        try:
+            while await self.handle_request(reader, writer):
+                pass
+        except (ConnectionError, OSError) as error:
+            logger.error(f'Ошибка соединения HTTP API: {error}')
+        finally:
+            writer.close()
+
+    async def handle_request(
+            self, reader: StreamReader, writer: StreamWriter) -> bool:
+        """
+        Читает и выполняет один запрос.
+        Возвращает False, если соединение нужно закрыть.
+        """
+        try:
+            request = await asyncio.wait_for(
+                read_request(reader, settings.SERVER.HTTP_MAX_BODY_SIZE),
+                settings.SERVER.HTTP_KEEP_ALIVE_SEC)
+        except asyncio.TimeoutError:
+            return False
+        except HttpError as error:
+            writer.write(json_response(
+                {'error': str(error)}, error.status, keep_alive=False))
+            await writer.drain()
+            return False
+        if request is None:
+            return False
+
+        handler = self.routes.get((request.method, request.path))
+        try:
+            if handler is None:
+                raise HttpError(HTTPStatus.NOT_FOUND)
+            data = await handler(request, writer)
+        except HttpError as error:
+            data = json_response(
+                {'error': str(error)}, error.status, request.keep_alive)
+        if data is None:
+            # Обработчик забрал соединение себе (поток SSE)
+            return False
+        writer.write(data)
+        await writer.drain()
+        return request.keep_alive
+
+    def session(self, request: Request) -> HttpConnection:
+        connection = self.sessions.get(request.query.get('session', ''))
+        if connection is None or connection.closed:
+            raise HttpError(HTTPStatus.NOT_FOUND, 'Сессия не найдена')
+        connection.last_active = time.monotonic()
+        return connection
+
+    async def connect(
+            self, request: Request, writer: StreamWriter) -> bytes:
+        """
+        Открывает сессию: {"username": ..., "seq": номер последнего
+        полученного сообщения, "delivery": "poll" | "sse"}.
+        """
+        data = request.json()
+        username = data.get('username')
+        if not isinstance(username, str) or not is_valid_username(username):
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'Некорректное имя')
+        resume_seq = data.get('seq', 0)
+        if not isinstance(resume_seq, int) or resume_seq < 0:
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'Некорректный номер')
+        codec = (
+            EventStreamCodec() if data.get('delivery') == 'sse'
+            else JsonCodec())
+
+        token = secrets.token_urlsafe(16)
+        connection = HttpConnection(
+            token,
+            settings.SERVER.SEND_QUEUE_SIZE,
+            settings.SERVER.SLOW_CONSUMER_POLICY,
+            codec,
+        )
+        self.sessions[token] = connection
+        # Догрузка непрочитанных сообщений ждет, пока клиент заберет
+        # предыдущую страницу, поэтому идет в фоне
+        self.spawn(self.server.open_session(connection, username, resume_seq))
+        return json_response(
+            {'session': token}, HTTPStatus.CREATED, request.keep_alive)
+
+    async def send(self, request: Request, writer: StreamWriter) -> bytes:
+        """
+        Отправляет сообщение или команду: {"text": ...}. Ответы
+        на команды приходят в сессию вместе с остальными сообщениями.
+        """
+        connection = self.session(request)
+        text = request.json().get('text')
+        if not isinstance(text, str) or not text:
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'Пустое сообщение')
+        await self.server.handle_message(
+            connection, Message(connection.username, text))
+        return json_response(
+            {'status': 'accepted'}, HTTPStatus.ACCEPTED, request.keep_alive)
+
+    async def poll(self, request: Request, writer: StreamWriter) -> bytes:
+        """
+        Отдает накопленные сообщения сессии строками JSON, при их
+        отсутствии ждет до timeout секунд. Параметр ack - номер
+        последнего обработанного клиентом сообщения.
+        """
+        connection = self.session(request)
+        try:
+            timeout = float(request.query.get('timeout', 0))
+            ack = int(request.query.get('ack', 0))
+        except ValueError:
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'Некорректный параметр')
+        # float() принимает и nan, inf, -1
+        if not (math.isfinite(timeout) and timeout >= 0):
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'Некорректный параметр')
+        timeout = min(timeout, settings.SERVER.HTTP_POLL_TIMEOUT_SEC)
+        connection.codec.acknowledge(ack)
+        connection.waiters += 1
+        try:
+            chunks = await connection.receive(timeout)
+        finally:
+            connection.waiters -= 1
+        return response(
+            HTTPStatus.OK, b''.join(chunks), 'application/x-ndjson',
+            request.keep_alive)
+
+    async def events(self, request: Request, writer: StreamWriter) -> None:
+        """
+        Передает сообщения сессии потоком Server-Sent Events, пока
+        клиент не закроет соединение.
+        """
+        connection = self.session(request)
+        if not isinstance(connection.codec, EventStreamCodec):
+            raise HttpError(
+                HTTPStatus.CONFLICT, 'Сессия открыта для доставки long-poll')
+        last_event_id = request.headers.get('last-event-id', '0')
+        if last_event_id.isdigit():
+            connection.codec.acknowledge(int(last_event_id))
+        writer.write(
+            b'HTTP/1.1 200 OK\r\n'
+            b'Content-Type: text/event-stream; charset=utf-8\r\n'
+            b'Cache-Control: no-cache\r\n'
+            b'Connection: close\r\n\r\n')
+        connection.waiters += 1
+        try:
+            while not connection.closed:
+                chunks = await connection.receive(SSE_PING_SEC)
+                writer.writelines(chunks or [b': ping\n\n'])
+                await writer.drain()
+        except ConnectionError:
+            # Клиент закрыл поток; сессия живет до переподключения
+            pass
+        finally:
+            connection.waiters -= 1
+            connection.last_active = time.monotonic()
+
+    async def status(self, request: Request, writer: StreamWriter) -> bytes:
+        return json_response(
+            {'status': self.server.status_lines()},
+            keep_alive=request.keep_alive)
+
+    async def disconnect(
+            self, request: Request, writer: StreamWriter) -> bytes:
+        await self.close_session(self.session(request))
+        return json_response(
+            {'status': 'closed'}, keep_alive=request.keep_alive)
+
+    async def close_session(self, connection: HttpConnection) -> None:
+        if self.sessions.pop(connection.token, None) is not None:
+            await self.server.close_session(connection)
+
+    async def run_session_sweep(self, interval: float) -> None:
+        """
+        Закрывает сессии, клиенты которых перестали забирать сообщения.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            deadline = (
+                time.monotonic() - settings.SERVER.HTTP_SESSION_TIMEOUT_SEC)
+            for connection in list(self.sessions.values()):
+                if not connection.waiters and (
+                    connection.last_active < deadline or connection.closed
+                ):
+                    await self.close_session(connection)
+
+    def close(self) -> None:
+        if self.http_server is not None:
+            self.http_server.close()
+        for task in self.tasks:
+            task.cancel()
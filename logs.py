@@ -0,0 +1,155 @@
+import json
+import logging
+import queue
+import sys
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, TextIO
+
+import metrics
+from settings import Settings
+
+settings = Settings()
+
+DROP_NEW = 'drop_new'
+DROP_OLDEST = 'drop_oldest'
+
+TEXT_FORMAT = '%(asctime)s [%(levelname)s]: %(message)s'
+# Дополнительные поля записи (logger.info(..., extra={...})),
+# которые выводятся в JSON-формате
+STRUCTURED_FIELDS = ('category', 'connection_id', 'message_id', 'username')
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    Передает записи лога в ограниченную очередь, которую разбирает
+    отдельный поток (BoundedQueueListener).
+
+    Цикл событий никогда не ждет вывода: при переполнении очереди
+    запись отбрасывается - новая (drop_new) или самая старая
+    (drop_oldest), а отброшенные записи считаются.
+    """
+
+    def __init__(self, queue_size: int, policy: str = DROP_NEW):
+        self.records: queue.Queue = queue.Queue(queue_size)
+        super().__init__(self.records)
+        self.policy = policy
+        self.dropped: int = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.records.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+        self.dropped += 1
+        metrics.log_messages_dropped.inc()
+        if self.policy == DROP_OLDEST:
+            try:
+                self.records.get_nowait()
+                self.records.put_nowait(record)
+            except (queue.Empty, queue.Full):
+                # Очередь успел разобрать или заполнить другой поток
+                pass
+
+
+class BoundedQueueListener(QueueListener):
+    """
+    Поток вывода записей из ограниченной очереди.
+
+    Признак остановки ставится в очередь с ожиданием свободного места:
+    стандартный QueueListener ставит его без ожидания и при заполненной
+    очереди (медленный вывод) падает с queue.Full, не дописав записи.
+    """
+
+    # Признак остановки, как у QueueListener
+    _sentinel = None
+
+    def __init__(self, records: queue.Queue, *handlers: logging.Handler):
+        super().__init__(records, *handlers)
+        self.records = records
+
+    def enqueue_sentinel(self) -> None:
+        self.records.put(self._sentinel)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает заданную долю записей категории (поле category),
+    например эха сообщений чата. Отбор равномерный: при доле 0.1
+    проходит каждая десятая запись. Записи без категории и категории
+    без настройки проходят всегда.
+    """
+
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self._credits: dict[str, float] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        category = getattr(record, 'category', None)
+        if not isinstance(category, str):
+            return True
+        rate = self.rates.get(category)
+        if rate is None or rate >= 1:
+            return True
+        credit = self._credits.get(category, 0.0) + rate
+        if credit >= 1:
+            self._credits[category] = credit - 1
+            return True
+        self._credits[category] = credit
+        metrics.log_messages_sampled.inc()
+        return False
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Выводит запись одной строкой JSON со служебными полями
+    и идентификаторами подключения и сообщения, если они есть.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': datetime.fromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+def make_formatter(log_format: str) -> logging.Formatter:
+    if log_format == 'json':
+        return JsonFormatter()
+    return logging.Formatter(TEXT_FORMAT)
+
+
+def setup_logging(
+        stream: Optional[TextIO] = None) -> BoundedQueueListener:
+    """
+    Настраивает асинхронный вывод лога процесса: записи уходят
+    в ограниченную очередь, а в stream (по умолчанию stdout) их пишет
+    отдельный поток. Возвращает запущенный QueueListener, который
+    нужно остановить при завершении, чтобы дописать очередь.
+    """
+    handler = BoundedQueueHandler(
+        settings.LOG.QUEUE_SIZE, settings.LOG.OVERFLOW_POLICY)
+    handler.addFilter(SamplingFilter(settings.LOG.SAMPLING))
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(make_formatter(settings.LOG.FORMAT))
+
+    root = logging.getLogger()
+    for previous in root.handlers[:]:
+        root.removeHandler(previous)
+    root.addHandler(handler)
+    root.setLevel(settings.LOG.LEVEL)
+
+    listener = BoundedQueueListener(handler.records, output)
+    listener.start()
+    return listener
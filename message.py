@@ -0,0 +1,140 @@
+import json
+import sys
+import time
+from datetime import datetime
+from typing import Optional
+
+
+def now_us() -> int:
+    """
+    Возвращает текущее время в микросекундах.
+    """
+    return time.time_ns() // 1000
+
+
+class Message:
+    """
+    Сообщение чата.
+
+    В памяти сервера одновременно живут сотни тысяч сообщений, поэтому
+    сообщение компактно: атрибуты в __slots__ вместо словаря, время -
+    целое число микросекунд вместо объекта datetime, имена
+    пользователей и разделитель интернированы и не дублируются
+    в каждом сообщении. Текст хранится сразу в UTF-8: в таком виде
+    он уходит в сокет при каждой отправке без повторного кодирования.
+    Запись JSON сообщения (record_bytes) тоже кодируется один раз:
+    ее пишет журнал и получают клиенты HTTP API.
+    """
+
+    __slots__ = (
+        'author', 'encoded_text', 'timestamp_us', 'sep', 'to_username',
+        'send_after', 'seq', '_record_bytes',
+    )
+
+    def __init__(
+            self,
+            username: str,
+            text: str = '',
+            created_at: Optional[datetime] = None,
+            sep: str = ':',
+            to: str = '',
+            send_after: int = 0,
+            timestamp_us: Optional[int] = None,
+    ):
+        self.author = sys.intern(username)
+        self.encoded_text = text.encode()
+        # Время создания; по умолчанию - момент создания сообщения
+        if timestamp_us is None:
+            timestamp_us = (
+                now_us() if created_at is None
+                else round(created_at.timestamp() * 1_000_000))
+        self.timestamp_us = timestamp_us
+        self.sep = sys.intern(sep)
+        self.to_username = sys.intern(to)
+        self.send_after = send_after
+        # Порядковый номер, присваивается при сохранении в MessageStore
+        self.seq = 0
+        self._record_bytes: Optional[bytes] = None
+
+    @property
+    def text(self) -> str:
+        return self.encoded_text.decode()
+
+    @text.setter
+    def text(self, text: str) -> None:
+        self.encoded_text = text.encode()
+        self._record_bytes = None
+
+    @property
+    def record_bytes(self) -> bytes:
+        """
+        Запись сообщения в JSON (UTF-8). Кодируется при первом
+        обращении, когда у сообщения уже есть номер.
+        """
+        if self._record_bytes is None:
+            self._record_bytes = json.dumps(
+                message_object_to_record(self), ensure_ascii=False,
+                separators=(',', ':')).encode()
+        return self._record_bytes
+
+    @property
+    def timestamp(self) -> float:
+        return self.timestamp_us / 1_000_000
+
+    @property
+    def datetime(self) -> datetime:
+        return datetime.fromtimestamp(self.timestamp)
+
+    def __str__(self) -> str:
+        return f'{self.author}{self.sep} {self.text}'
+
+
+def message_object_to_str(message: Message) -> str:
+    """
+    Сериализует объект Message в строку
+    """
+    return (f'{message.datetime};{message.author};'
+            f'{message.text};{message.sep};{message.to_username}\n')
+
+
+def message_str_to_object(message: str) -> Message:
+    """
+    Десериализует строку message в объект Message
+    """
+    message_list = message.split(sep=';', maxsplit=4)
+    username = message_list[1]
+    text = message_list[2]
+    created_at = datetime.strptime(message_list[0], '%Y-%m-%d %H:%M:%S.%f')
+    sep = message_list[3]
+    to_username = message_list[4]
+    return Message(username=username, text=text, created_at=created_at,
+                   sep=sep, to=to_username)
+
+
+def message_object_to_record(message: Message) -> dict:
+    """
+    Переводит объект Message в словарь для журнала и шины событий.
+    """
+    return {
+        'seq': message.seq,
+        'author': message.author,
+        'text': message.text,
+        'datetime': message.timestamp,
+        'sep': message.sep,
+        'to_username': message.to_username,
+    }
+
+
+def message_record_to_object(record: dict) -> Message:
+    """
+    Восстанавливает объект Message из словаря журнала или шины событий.
+    """
+    message = Message(
+        username=record['author'],
+        text=record['text'],
+        sep=record['sep'],
+        to=record['to_username'],
+        timestamp_us=round(record['datetime'] * 1_000_000),
+    )
+    message.seq = record['seq']
+    return message
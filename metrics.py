@@ -0,0 +1,257 @@
+import asyncio
+import logging
+from asyncio.streams import StreamReader, StreamWriter
+from bisect import bisect_left
+from typing import Callable, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержек в секундах
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+GaugeValue = Union[float, dict[str, float]]
+
+
+class Counter:
+    """
+    Монотонно растущий счетчик.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.value: int = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def render(self) -> list[str]:
+        return [f'{self.name} {self.value}']
+
+
+class Gauge:
+    """
+    Текущее значение, вычисляемое в момент опроса.
+
+    Функция может вернуть число либо словарь {значение метки: число}
+    для метрик с меткой label (например, отклоненные сообщения
+    по видам лимитов).
+    """
+
+    kind = 'gauge'
+
+    def __init__(
+            self,
+            name: str,
+            help_text: str,
+            func: Callable[[], GaugeValue],
+            label: str = ''
+    ):
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+        self.label = label
+
+    def render(self) -> list[str]:
+        value = self.func()
+        if not isinstance(value, dict):
+            return [f'{self.name} {value}']
+        return [
+            f'{self.name}{{{self.label}="{escape_label(key)}"}} {item}'
+            for key, item in value.items()
+        ]
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными корзинами.
+
+    Наблюдение стоит одного двоичного поиска и трех сложений,
+    поэтому гистограммы можно держать включенными на горячем пути.
+    """
+
+    kind = 'histogram'
+
+    def __init__(
+            self,
+            name: str,
+            help_text: str,
+            buckets: tuple[float, ...] = LATENCY_BUCKETS
+    ):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        # Последняя корзина - все, что больше последней границы (+Inf)
+        self.counts: list[int] = [0] * (len(buckets) + 1)
+        self.sum: float = 0.0
+        self.count: int = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        Оценивает квантиль q сверху по границе корзины.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def render(self) -> list[str]:
+        lines = []
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {seen}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{self.name}_sum {self.sum}')
+        lines.append(f'{self.name}_count {self.count}')
+        return lines
+
+
+Metric = Union[Counter, Gauge, Histogram]
+
+
+def escape_label(value: str) -> str:
+    return (
+        value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+
+
+class Registry:
+    """
+    Набор метрик процесса с выводом в текстовом формате Prometheus.
+    """
+
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._register(Counter(name, help_text))
+
+    def histogram(self, name: str, help_text: str) -> Histogram:
+        return self._register(Histogram(name, help_text))
+
+    def gauge(
+            self,
+            name: str,
+            help_text: str,
+            func: Callable[[], GaugeValue],
+            label: str = ''
+    ) -> Gauge:
+        """
+        Регистрирует (или заменяет) вычисляемую метрику.
+        """
+        gauge = Gauge(name, help_text, func, label)
+        self.metrics[name] = gauge
+        return gauge
+
+    def _register(self, metric):
+        # Повторная регистрация возвращает уже существующую метрику
+        return self.metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+messages_received = registry.counter(
+    'chat_messages_received_total', 'Сообщений получено от клиентов')
+messages_delivered = registry.counter(
+    'chat_messages_delivered_total', 'Сообщений поставлено в очереди клиентов')
+messages_dropped = registry.counter(
+    'chat_messages_dropped_total',
+    'Сообщений отброшено из-за переполнения очереди клиента')
+receive_seconds = registry.histogram(
+    'chat_receive_seconds', 'Время обработки входящего сообщения')
+fanout_seconds = registry.histogram(
+    'chat_fanout_seconds', 'Время раскладки сообщения по очередям клиентов')
+drain_seconds = registry.histogram(
+    'chat_drain_seconds', 'Время ожидания освобождения буфера сокета')
+log_records = registry.counter(
+    'chat_log_records_total', 'Записей сохранено в журнал сообщений')
+log_fsync_seconds = registry.histogram(
+    'chat_log_fsync_seconds', 'Время записи пачки журнала на диск с fsync')
+log_write_errors = registry.counter(
+    'chat_log_write_errors_total',
+    'Ошибок записи, остановивших поток записи журнала сообщений')
+log_messages_dropped = registry.counter(
+    'chat_log_messages_dropped_total',
+    'Записей лога отброшено из-за переполнения очереди вывода')
+log_messages_sampled = registry.counter(
+    'chat_log_messages_sampled_total',
+    'Записей лога пропущено выборкой по категории')
+loop_lag_seconds = registry.histogram(
+    'chat_loop_lag_seconds', 'Задержка срабатывания таймера цикла событий')
+
+
+async def probe_loop_lag(interval: float) -> None:
+    """
+    Раз в interval секунд замеряет, насколько позже запланированного
+    просыпается цикл событий.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        loop_lag_seconds.observe(max(0.0, loop.time() - started - interval))
+
+
+class MetricsServer:
+    """
+    Отдает метрики по HTTP для сборщика Prometheus (GET /metrics).
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        try:
+            self.server = await asyncio.start_server(
+                self.handle_request, self.host, self.port)
+        except OSError as error:
+            logger.error(f'Не удалось открыть порт метрик: {error}')
+            return
+        logger.info(f'Метрики доступны на http://{self.host}:{self.port}/')
+
+    async def handle_request(
+            self, reader: StreamReader, writer: StreamWriter) -> None:
+        try:
+            # Читаем заголовки запроса до пустой строки, тело не ожидается
+            while (await reader.readline()).strip():
+                pass
+            body = registry.render().encode()
+            writer.write(
+                b'HTTP/1.1 200 OK\r\n'
+                b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                b'Connection: close\r\n\r\n' + body)
+            await writer.drain()
+        except (ConnectionError, OSError) as error:
+            logger.error(f'Ошибка отдачи метрик: {error}')
+        finally:
+            writer.close()
+
+    def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
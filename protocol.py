@@ -0,0 +1,542 @@
+import asyncio
+import struct
+import sys
+import zlib
+from asyncio.streams import StreamReader
+from typing import Optional, Sequence, Union
+
+from message import Message, message_object_to_str, message_str_to_object
+
+# Версии протокола: 0 - текстовые строки через ';', 1 - бинарные кадры
+LEGACY_VERSION = 0
+BINARY_VERSION = 1
+PROTOCOL_VERSION = BINARY_VERSION
+# Форматы доставки HTTP API: строки JSON (long-poll) и Server-Sent Events
+JSON_VERSION = 2
+EVENT_STREAM_VERSION = 3
+
+# Приветствие: сигнатура, версия протокола и флаги возможностей
+PROTOCOL_MAGIC = b'\xffCHT'
+HELLO = struct.Struct('!4sBB')
+# Флаг приветствия: сжатие кадров от сервера к клиенту
+FLAG_COMPRESSION = 0x01
+
+# Заголовок кадра: тип кадра и длина полезной нагрузки
+FRAME_HEADER = struct.Struct('!BI')
+FRAME_MESSAGES = 1
+# Подтверждение получения: номер последнего полученного сообщения
+FRAME_ACK = 2
+ACK = struct.Struct('!Q')
+# Загрузка файла на сервер: начало (размер, получатель и имя файла),
+# части содержимого и окончание с контрольной суммой sha256
+FRAME_FILE_BEGIN = 3
+FRAME_FILE_CHUNK = 4
+FRAME_FILE_END = 5
+FILE_BEGIN = struct.Struct('!QB')
+# Выдача файла клиенту: sha256 и содержимое файла
+FRAME_FILE = 6
+FILE_DIGEST_SIZE = 32
+FILE_FRAMES = (FRAME_FILE_BEGIN, FRAME_FILE_CHUNK, FRAME_FILE_END, FRAME_FILE)
+# Размер части файла при загрузке
+FILE_CHUNK_SIZE = 64 * 1024
+# Сжатая zlib пачка кадров
+FRAME_COMPRESSED = 7
+# Окно 4 КБ (raw deflate) и уровень памяти zlib: контекст сжатия живет
+# все время подключения, поэтому его размер ограничен (~32 КБ)
+COMPRESSION_WBITS = -12
+COMPRESSION_MEM_LEVEL = 5
+
+# Заголовок сообщения в кадре: seq, время в микросекундах от эпохи,
+# индексы автора и получателя в таблице имен, длины sep и текста
+MESSAGE_HEADER = struct.Struct('!QqHHBI')
+COUNT = struct.Struct('!H')
+NAME_LENGTH = struct.Struct('!B')
+# Длины имен и разделителя занимают в кадре по одному байту
+MAX_NAME_SIZE = 255
+# Полезная нагрузка кадра без сообщений: кол-во имен, пустое имя
+# в таблице имен и кол-во сообщений
+EMPTY_PAYLOAD_SIZE = COUNT.size + NAME_LENGTH.size + COUNT.size
+
+# Максимальное кол-во сообщений в одном кадре
+MAX_BATCH_MESSAGES = 256
+
+
+class ProtocolError(Exception):
+    """
+    Нарушение формата протокола обмена сообщениями.
+    """
+
+
+class FileFrame:
+    """
+    Кадр передачи файла, полученный вместе с сообщениями.
+    """
+
+    def __init__(self, frame_type: int, payload: bytes):
+        self.frame_type = frame_type
+        self.payload = payload
+
+
+Incoming = Union[Message, FileFrame]
+
+
+class LineCodec:
+    """
+    Исходный текстовый протокол: одно сообщение в строке,
+    поля разделены ';'.
+    """
+
+    version = LEGACY_VERSION
+    # Текстовый протокол не подтверждает получение сообщений
+    acked_seq = 0
+
+    def compress(self, chunks: list[bytes]) -> list[bytes]:
+        # Текстовый протокол не сжимается
+        return chunks
+
+    def encode(self, messages: Sequence[Message]) -> bytes:
+        lines = []
+        for message_obj in messages:
+            line = message_object_to_str(message_obj)
+            # Переводы строк из бинарного протокола ломают текстовый
+            if '\n' in line[:-1]:
+                line = line[:-1].replace('\n', ' ') + '\n'
+            lines.append(line.encode())
+        return b''.join(lines)
+
+    async def read(self, reader: StreamReader) -> Optional[list[Incoming]]:
+        """
+        Читает одно сообщение. Возвращает None при закрытии соединения.
+        """
+        message_bytes = await reader.readline()
+        if not message_bytes:
+            return None
+        message_str = message_bytes.decode().strip()
+        return [message_str_to_object(message_str)]
+
+
+class FrameCodec:
+    """
+    Бинарный протокол: кадры с длиной в заголовке, в одном кадре может
+    быть несколько сообщений. Имена пользователей передаются один раз
+    на кадр через таблицу имен, время - целым числом микросекунд.
+    """
+
+    version = BINARY_VERSION
+
+    def __init__(
+            self,
+            max_frame_size: int = 1024 * 1024,
+            max_file_size: int = 5 * 1024 * 1024
+    ):
+        self.max_frame_size = max_frame_size
+        self.max_file_size = max_file_size
+        # Последний подтвержденный собеседником номер сообщения
+        self.acked_seq: int = 0
+        # Контексты сжатия исходящих и распаковки входящих кадров,
+        # если сжатие согласовано в приветствии
+        self.compressor: Optional['zlib._Compress'] = None
+        self.decompressor: Optional['zlib._Decompress'] = None
+        self.compression_threshold: int = 0
+
+    def enable_compression(self, threshold: int, level: int) -> None:
+        """
+        Включает сжатие отправляемых пачек кадров размером от threshold
+        байт.
+        """
+        self.compressor = zlib.compressobj(
+            level, zlib.DEFLATED, COMPRESSION_WBITS, COMPRESSION_MEM_LEVEL)
+        self.compression_threshold = threshold
+
+    def enable_decompression(self) -> None:
+        self.decompressor = zlib.decompressobj(COMPRESSION_WBITS)
+
+    def compress(self, chunks: list[bytes]) -> list[bytes]:
+        """
+        Сжимает пачку кадров перед записью в сокет.
+
+        Контекст zlib общий на все подключение, поэтому повторы имен,
+        времени и служебных строк из прошлых пачек сжимаются ссылками
+        назад. Пачка завершается синхронизирующим сбросом, и клиент
+        распаковывает ее сразу. Пачки меньше порога уходят как есть:
+        пропущенные данные не нарушают поток сжатия.
+        """
+        compressor = self.compressor
+        if (
+            compressor is None
+            or sum(map(len, chunks)) < self.compression_threshold
+        ):
+            return chunks
+        # Сжатый кадр не должен превысить максимальный размер кадра
+        limit = self.max_frame_size // 2
+        frames: list[bytes] = []
+        parts: list[bytes] = []
+        size = 0
+        for chunk in chunks:
+            if size and size + len(chunk) > limit:
+                self._flush_compressed(compressor, parts, frames)
+                size = 0
+            parts.append(compressor.compress(chunk))
+            size += len(chunk)
+        self._flush_compressed(compressor, parts, frames)
+        return frames
+
+    def _flush_compressed(
+            self, compressor: 'zlib._Compress', parts: list[bytes],
+            frames: list[bytes]) -> None:
+        parts.append(compressor.flush(zlib.Z_SYNC_FLUSH))
+        data = b''.join(parts)
+        parts.clear()
+        frames.append(FRAME_HEADER.pack(FRAME_COMPRESSED, len(data)))
+        frames.append(data)
+
+    def decompress(
+            self, payload: Union[bytes, memoryview]) -> list[Incoming]:
+        """
+        Распаковывает пачку кадров из кадра FRAME_COMPRESSED.
+        """
+        if self.decompressor is None:
+            raise ProtocolError('Сжатие не согласовано')
+        try:
+            data = self.decompressor.decompress(payload)
+        except zlib.error as error:
+            raise ProtocolError(
+                f'Некорректный сжатый кадр: {error}') from error
+        view = memoryview(data)
+        items: list[Incoming] = []
+        offset = 0
+        while offset < len(data):
+            try:
+                frame_type, length = FRAME_HEADER.unpack_from(view, offset)
+            except struct.error as error:
+                raise ProtocolError(f'Некорректный кадр: {error}') from error
+            offset += FRAME_HEADER.size
+            if frame_type == FRAME_COMPRESSED or offset + length > len(data):
+                raise ProtocolError('Некорректный сжатый кадр')
+            items.extend(
+                self.decode_frame(frame_type, view[offset:offset + length]))
+            offset += length
+        return items
+
+    def encode(self, messages: Sequence[Message]) -> bytes:
+        """
+        Кодирует сообщения в один или несколько кадров. Следующий кадр
+        начинается, когда в текущем MAX_BATCH_MESSAGES сообщений или
+        очередное сообщение не уместится в max_frame_size.
+        """
+        frames = []
+        start = 0
+        names = {''}
+        size = EMPTY_PAYLOAD_SIZE
+        for index, message_obj in enumerate(messages):
+            added = message_size(message_obj, names)
+            if index > start and (
+                index - start == MAX_BATCH_MESSAGES
+                or size + added > self.max_frame_size
+            ):
+                frames.append(self.encode_frame(messages[start:index]))
+                start = index
+                names = {''}
+                size = EMPTY_PAYLOAD_SIZE
+                added = message_size(message_obj, names)
+            names.add(message_obj.author)
+            names.add(message_obj.to_username)
+            size += added
+        if start < len(messages):
+            frames.append(self.encode_frame(messages[start:]))
+        return b''.join(frames)
+
+    def encode_frame(self, messages: Sequence[Message]) -> bytes:
+        payload = self.encode_payload(messages)
+        return FRAME_HEADER.pack(FRAME_MESSAGES, len(payload)) + payload
+
+    def encode_payload(self, messages: Sequence[Message]) -> bytes:
+        names: dict[str, int] = {'': 0}
+        parts = [b'']
+        body = [COUNT.pack(len(messages))]
+        for message_obj in messages:
+            author = names.setdefault(message_obj.author, len(names))
+            to_username = names.setdefault(
+                message_obj.to_username, len(names))
+            sep = message_obj.sep.encode()
+            text = message_obj.encoded_text
+            body.append(MESSAGE_HEADER.pack(
+                message_obj.seq, message_obj.timestamp_us, author,
+                to_username, len(sep), len(text),
+            ))
+            body.append(sep)
+            body.append(text)
+
+        parts[0] = COUNT.pack(len(names))
+        for name in names:
+            name_bytes = name.encode()
+            parts.append(NAME_LENGTH.pack(len(name_bytes)))
+            parts.append(name_bytes)
+        return b''.join(parts + body)
+
+    def encode_ack(self, seq: int) -> bytes:
+        """
+        Кодирует подтверждение получения сообщений до seq включительно.
+        """
+        return FRAME_HEADER.pack(FRAME_ACK, ACK.size) + ACK.pack(seq)
+
+    def decode_ack(self, payload: Union[bytes, memoryview]) -> None:
+        """
+        Запоминает номер из кадра подтверждения FRAME_ACK.
+        """
+        try:
+            [seq] = ACK.unpack(payload)
+        except struct.error as error:
+            raise ProtocolError(f'Некорректный кадр: {error}') from error
+        self.acked_seq = max(self.acked_seq, seq)
+
+    def encode_file_begin(
+            self, size: int, name: str, to_username: str = '') -> bytes:
+        """
+        Кодирует начало загрузки файла name размером size байт.
+        """
+        to_bytes = to_username.encode()
+        payload = (
+            FILE_BEGIN.pack(size, len(to_bytes)) + to_bytes + name.encode())
+        return FRAME_HEADER.pack(FRAME_FILE_BEGIN, len(payload)) + payload
+
+    def decode_file_begin(
+            self, payload: Union[bytes, memoryview]) -> tuple[int, str, str]:
+        """
+        Возвращает размер, имя файла и получателя из кадра
+        FRAME_FILE_BEGIN.
+        """
+        view = memoryview(payload)
+        try:
+            size, to_length = FILE_BEGIN.unpack_from(view)
+            offset = FILE_BEGIN.size
+            to_username = str(view[offset:offset + to_length], 'utf-8')
+            name = str(view[offset + to_length:], 'utf-8')
+        except (struct.error, UnicodeDecodeError) as error:
+            raise ProtocolError(f'Некорректный кадр: {error}') from error
+        return size, name, to_username
+
+    def encode_file_chunk(self, data: bytes) -> bytes:
+        return FRAME_HEADER.pack(FRAME_FILE_CHUNK, len(data)) + data
+
+    def encode_file_end(self, digest: bytes) -> bytes:
+        return FRAME_HEADER.pack(FRAME_FILE_END, len(digest)) + digest
+
+    def encode_file_header(self, digest: bytes, size: int) -> bytes:
+        """
+        Кодирует заголовок кадра FRAME_FILE. Содержимое файла
+        отправляется следом без кодирования.
+        """
+        return FRAME_HEADER.pack(FRAME_FILE, len(digest) + size) + digest
+
+    def decode_payload(
+            self, payload: Union[bytes, memoryview]) -> list[Message]:
+        """
+        Декодирует полезную нагрузку кадра FRAME_MESSAGES.
+        """
+        view = memoryview(payload)
+        try:
+            offset = 0
+            [names_count] = COUNT.unpack_from(view, offset)
+            offset += COUNT.size
+            names = []
+            for _ in range(names_count):
+                [length] = NAME_LENGTH.unpack_from(view, offset)
+                offset += NAME_LENGTH.size
+                name = str(view[offset:offset + length], 'utf-8')
+                names.append(sys.intern(name))
+                offset += length
+
+            [messages_count] = COUNT.unpack_from(view, offset)
+            offset += COUNT.size
+            messages = []
+            for _ in range(messages_count):
+                (seq, timestamp, author, to_username,
+                 sep_length, text_length) = MESSAGE_HEADER.unpack_from(
+                    view, offset)
+                offset += MESSAGE_HEADER.size
+                sep = str(view[offset:offset + sep_length], 'utf-8')
+                offset += sep_length
+                text = str(view[offset:offset + text_length], 'utf-8')
+                offset += text_length
+
+                message_obj = Message(
+                    names[author], text, sep=sep, to=names[to_username],
+                    timestamp_us=timestamp,
+                )
+                message_obj.seq = seq
+                messages.append(message_obj)
+        except (struct.error, IndexError, UnicodeDecodeError) as error:
+            raise ProtocolError(f'Некорректный кадр: {error}') from error
+        return messages
+
+    def max_length(self, frame_type: int) -> int:
+        """
+        Возвращает допустимую длину кадра: файл приходит одним кадром
+        и может быть больше обычного кадра.
+        """
+        if frame_type == FRAME_FILE:
+            return self.max_file_size + FILE_DIGEST_SIZE
+        return self.max_frame_size
+
+    def decode_frame(
+            self, frame_type: int,
+            payload: Union[bytes, memoryview]) -> list[Incoming]:
+        """
+        Декодирует несжатый кадр. Кадр подтверждения обрабатывается
+        сразу, для него возвращается пустой список.
+        """
+        if frame_type == FRAME_MESSAGES:
+            return list(self.decode_payload(payload))
+        if frame_type in FILE_FRAMES:
+            return [FileFrame(frame_type, bytes(payload))]
+        if frame_type != FRAME_ACK:
+            raise ProtocolError(f'Неизвестный тип кадра: {frame_type}')
+        self.decode_ack(payload)
+        return []
+
+    async def read(self, reader: StreamReader) -> Optional[list[Incoming]]:
+        """
+        Читает кадр с сообщениями или передачей файла (либо сжатую
+        пачку кадров), попутно обрабатывая кадры подтверждения.
+        Возвращает None при закрытии соединения.
+        """
+        while True:
+            try:
+                header = await reader.readexactly(FRAME_HEADER.size)
+                frame_type, length = FRAME_HEADER.unpack(header)
+                if length > self.max_length(frame_type):
+                    raise ProtocolError(
+                        f'Слишком большой кадр: {length} байт')
+                payload = await reader.readexactly(length)
+            except asyncio.IncompleteReadError:
+                return None
+            if frame_type == FRAME_COMPRESSED:
+                items = self.decompress(payload)
+            else:
+                items = self.decode_frame(frame_type, payload)
+            if items:
+                return items
+
+
+class JsonCodec:
+    """
+    Доставка сообщений HTTP API по запросам long-poll: по объекту JSON
+    в строке (NDJSON) с полями записи журнала. Ответ склеивается
+    из строк, накопленных к приходу запроса.
+    """
+
+    version = JSON_VERSION
+
+    def __init__(self):
+        # Номер последнего сообщения, полученного клиентом по его
+        # собственному подтверждению
+        self.acked_seq: int = 0
+
+    def compress(self, chunks: list[bytes]) -> list[bytes]:
+        # Ответы HTTP API не сжимаются
+        return chunks
+
+    def encode(self, messages: Sequence[Message]) -> bytes:
+        return b''.join(map(self.encode_message, messages))
+
+    def encode_message(self, message_obj: Message) -> bytes:
+        return message_obj.record_bytes + b'\n'
+
+    def acknowledge(self, seq: int) -> None:
+        self.acked_seq = max(self.acked_seq, seq)
+
+
+class EventStreamCodec(JsonCodec):
+    """
+    Доставка сообщений HTTP API потоком Server-Sent Events: событие
+    на сообщение, id события - номер сообщения, с которого клиент
+    продолжает после переподключения (заголовок Last-Event-ID).
+    """
+
+    version = EVENT_STREAM_VERSION
+
+    def encode(self, messages: Sequence[Message]) -> bytes:
+        events = []
+        for message_obj in messages:
+            # У служебных сообщений нет номера, и они не сдвигают
+            # Last-Event-ID клиента
+            if message_obj.seq:
+                events.append(b'id: %d\n' % message_obj.seq)
+            events.append(b'data: ' + self.encode_message(message_obj))
+            events.append(b'\n')
+        return b''.join(events)
+
+
+def message_size(message_obj: Message, names: set[str]) -> int:
+    """
+    Возвращает размер сообщения в кадре вместе с именами, которых еще
+    нет в таблице имен кадра names.
+    """
+    size = (
+        MESSAGE_HEADER.size + len(message_obj.sep.encode())
+        + len(message_obj.encoded_text))
+    for name in (message_obj.author, message_obj.to_username):
+        if name not in names:
+            size += NAME_LENGTH.size + len(name.encode())
+    return size
+
+
+def fits_frame(message_obj: Message, max_frame_size: int) -> bool:
+    """
+    Проверяет, что сообщение можно передать одним кадром
+    размером до max_frame_size байт.
+    """
+    return (
+        max(len(message_obj.author.encode()),
+            len(message_obj.to_username.encode()),
+            len(message_obj.sep.encode())) <= MAX_NAME_SIZE
+        and EMPTY_PAYLOAD_SIZE + message_size(message_obj, {''})
+        <= max_frame_size
+    )
+
+
+# Кодеки собственного протокола чата (чтение из потока)
+StreamCodec = Union[LineCodec, FrameCodec]
+# Кодеки доставки подключению: протокол чата или HTTP API
+Codec = Union[LineCodec, FrameCodec, JsonCodec]
+
+
+def hello(version: int = PROTOCOL_VERSION, flags: int = 0) -> bytes:
+    """
+    Формирует приветствие, с которого начинается бинарный протокол.
+    """
+    return HELLO.pack(PROTOCOL_MAGIC, version, flags)
+
+
+async def read_hello(
+        reader: StreamReader, first_byte: bytes = b'') -> tuple[int, int]:
+    """
+    Читает приветствие собеседника и возвращает его версию и флаги.
+    """
+    data = first_byte + await reader.readexactly(
+        HELLO.size - len(first_byte))
+    magic, version, flags = HELLO.unpack(data)
+    if magic != PROTOCOL_MAGIC:
+        raise ProtocolError('Некорректное приветствие')
+    return version, flags
+
+
+def accept_flags(client_flags: int, compression: bool) -> int:
+    """
+    Возвращает флаги возможностей, которые сервер подтверждает клиенту.
+    """
+    return client_flags & FLAG_COMPRESSION if compression else 0
+
+
+def make_codec(
+        version: int,
+        max_frame_size: int = 1024 * 1024,
+        max_file_size: int = 5 * 1024 * 1024
+) -> StreamCodec:
+    """
+    Возвращает кодек для согласованной версии протокола.
+    """
+    if version == LEGACY_VERSION:
+        return LineCodec()
+    return FrameCodec(max_frame_size, max_file_size)
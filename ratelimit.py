@@ -0,0 +1,88 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Callable
+
+# Кол-во записей, просматриваемых за один шаг фоновой очистки
+SWEEP_BATCH = 1000
+
+
+class RateLimiter:
+    """
+    Ограничитель частоты сообщений по имени пользователя.
+
+    Корзина на capacity токенов, пополняемая равномерно за period_sec.
+    Состояние корзины хранится одним числом - теоретическим временем
+    прихода следующего сообщения (алгоритм GCRA, эквивалентный корзине
+    токенов), поэтому решение стоит O(1) и не создает новых объектов
+    для уже известного пользователя. Время берется из монотонных часов.
+
+    Полная корзина неотличима от отсутствующей, поэтому корзины
+    простаивающих пользователей удаляются фоновой очисткой. Записи
+    упорядочены по времени последнего обращения, и очистка идет
+    с головы словаря.
+    """
+
+    def __init__(
+            self,
+            capacity: int,
+            period_sec: float,
+            clock: Callable[[], float] = time.monotonic
+    ):
+        self.capacity = capacity
+        self.period_sec = period_sec
+        # Интервал пополнения одного токена
+        self.interval = period_sec / capacity if capacity > 0 else 0.0
+        # Насколько теоретическое время может опережать текущее
+        self.tolerance = period_sec - self.interval
+        self.clock = clock
+        self._arrivals: OrderedDict[str, float] = OrderedDict()
+        # Счетчик отклоненных сообщений
+        self.rejected: int = 0
+
+    def __len__(self) -> int:
+        return len(self._arrivals)
+
+    def allow(self, key: str) -> bool:
+        """
+        Расходует токен пользователя key.
+        Возвращает False, если токенов не осталось.
+        """
+        if self.capacity <= 0:
+            self.rejected += 1
+            return False
+        now = self.clock()
+        arrival = self._arrivals.get(key, now)
+        if arrival < now:
+            arrival = now
+        elif arrival - now > self.tolerance:
+            self.rejected += 1
+            return False
+        self._arrivals[key] = arrival + self.interval
+        self._arrivals.move_to_end(key)
+        return True
+
+    def sweep(self, limit: int = SWEEP_BATCH) -> int:
+        """
+        Удаляет не более limit корзин, успевших наполниться целиком.
+        Возвращает кол-во удаленных корзин.
+        """
+        now = self.clock()
+        removed = 0
+        while self._arrivals and removed < limit:
+            key, arrival = next(iter(self._arrivals.items()))
+            if arrival > now:
+                break
+            del self._arrivals[key]
+            removed += 1
+        return removed
+
+    async def run_sweep(self, interval: float) -> None:
+        """
+        Периодически удаляет корзины простаивающих пользователей
+        небольшими порциями, не блокируя цикл событий.
+        """
+        while True:
+            while self.sweep() == SWEEP_BATCH:
+                await asyncio.sleep(0)
+            await asyncio.sleep(interval)
@@ -0,0 +1,253 @@
+from typing import TYPE_CHECKING, Iterator
+
+from protocol import MAX_NAME_SIZE
+
+if TYPE_CHECKING:
+    from connection import BaseConnection
+
+# Общий чат - комната без имени, в нее входят все подключения
+GENERAL_ROOM = ''
+# Имена комнат начинаются с '#', чтобы не путать их с пользователями
+ROOM_PREFIX = '#'
+
+Notices = list[tuple[str, str]]
+
+
+def is_room(name: str) -> bool:
+    return name.startswith(ROOM_PREFIX)
+
+
+def fits_name_size(name: str) -> bool:
+    return len(name.encode()) <= MAX_NAME_SIZE
+
+
+def is_valid_room_name(name: str) -> bool:
+    return (
+        is_room(name) and len(name) > 1 and name.isprintable()
+        and fits_name_size(name))
+
+
+def is_valid_username(name: str) -> bool:
+    """
+    Имя пользователя не пустое, без пробелов и не похоже на имя
+    комнаты: ленты комнат и пользователей лежат в одном пространстве
+    имен, и пользователь '#room' получил бы историю комнаты. Имя
+    должно уместиться в таблицу имен кадра (MAX_NAME_SIZE байт).
+    """
+    return (
+        bool(name) and not is_room(name) and name.isprintable()
+        and ' ' not in name and fits_name_size(name))
+
+
+class Room:
+    """
+    Закрытая комната: участники, приглашенные владельцем или вошедшие
+    по ссылке-приглашению после его подтверждения.
+    """
+
+    def __init__(self, name: str, owner: str, token: str):
+        self.name = name
+        self.owner = owner
+        # Секрет ссылки-приглашения
+        self.token = token
+        self.members: set[str] = {owner}
+        # Пользователи, запросившие вход по ссылке
+        self.pending: set[str] = set()
+
+
+class RoomIndex:
+    """
+    Комнаты чата и индекс подписок.
+
+    sessions - живые подключения (устройства) пользователей к этому
+    процессу, у одного пользователя их может быть несколько;
+    subscribers - подключения, подписанные на комнату.
+    Рассылка в комнату обходит только ее подписчиков, а не всех
+    когда-либо подключавшихся пользователей. Время последнего визита
+    хранит сервер отдельно.
+
+    Изменения комнат приходят событиями от брокера в одном порядке
+    во все рабочие процессы, поэтому методы изменения детерминированы
+    и возвращают уведомления (пользователь, текст): каждый процесс
+    доставляет их своим подключениям.
+    """
+
+    def __init__(self):
+        self.rooms: dict[str, Room] = {}
+        self.memberships: dict[str, set[str]] = {}
+        self.sessions: dict[str, set['BaseConnection']] = {}
+        self.subscribers: dict[str, set['BaseConnection']] = {
+            GENERAL_ROOM: set()}
+
+    def __len__(self) -> int:
+        return len(self.rooms)
+
+    def user_rooms(self, username: str) -> set[str]:
+        """
+        Возвращает комнаты, в которых состоит пользователь.
+        """
+        return self.memberships.get(username, set())
+
+    def devices(self, username: str) -> set['BaseConnection']:
+        """
+        Возвращает подключения пользователя к этому процессу.
+        """
+        return self.sessions.get(username, set())
+
+    def members(self, room: str) -> Iterator['BaseConnection']:
+        """
+        Перебирает подключения, подписанные на комнату.
+        """
+        return iter(self.subscribers.get(room, ()))
+
+    def connect(self, connection: 'BaseConnection') -> None:
+        """
+        Регистрирует подключение и подписывает его на общий чат
+        и комнаты пользователя.
+        """
+        self.sessions.setdefault(connection.username, set()).add(connection)
+        for room in (GENERAL_ROOM, *self.user_rooms(connection.username)):
+            self.subscribers.setdefault(room, set()).add(connection)
+
+    def disconnect(self, connection: 'BaseConnection') -> None:
+        """
+        Снимает подключение со всех подписок.
+        """
+        username = connection.username
+        devices = self.sessions.get(username)
+        if devices is not None:
+            devices.discard(connection)
+            if not devices:
+                del self.sessions[username]
+        for room in (GENERAL_ROOM, *self.user_rooms(username)):
+            subscribers = self.subscribers.get(room)
+            if subscribers is not None:
+                subscribers.discard(connection)
+
+    def _add_member(self, room: Room, username: str) -> None:
+        room.members.add(username)
+        room.pending.discard(username)
+        self.memberships.setdefault(username, set()).add(room.name)
+        devices = self.devices(username)
+        if devices:
+            self.subscribers.setdefault(room.name, set()).update(devices)
+
+    def _remove_member(self, room: Room, username: str) -> None:
+        room.members.discard(username)
+        rooms = self.memberships.get(username)
+        if rooms is not None:
+            rooms.discard(room.name)
+            if not rooms:
+                del self.memberships[username]
+        subscribers = self.subscribers.get(room.name)
+        if subscribers is not None:
+            subscribers.difference_update(self.devices(username))
+
+    def create(self, username: str, name: str, token: str) -> Notices:
+        if name in self.rooms:
+            return [(username, f'Комната {name} уже существует.')]
+        room = self.rooms[name] = Room(name, username, token)
+        self._add_member(room, username)
+        return [(username, f'Комната {name} создана. Ссылка-приглашение: '
+                           f'/join {name} {token}')]
+
+    def invite(self, username: str, name: str, target: str) -> Notices:
+        room = self.rooms.get(name)
+        if room is None or room.owner != username:
+            return [(username, f'Вы не владелец комнаты {name}.')]
+        self._add_member(room, target)
+        return [
+            (username, f'{target} добавлен в комнату {name}.'),
+            (target, f'{username} пригласил вас в комнату {name}.'),
+        ]
+
+    def request(self, username: str, name: str, token: str) -> Notices:
+        room = self.rooms.get(name)
+        if room is None or room.token != token:
+            return [
+                (username, f'Ссылка-приглашение в {name} недействительна.')]
+        if username in room.members:
+            return [(username, f'Вы уже в комнате {name}.')]
+        room.pending.add(username)
+        return [
+            (username, f'Запрос на вход в {name} отправлен владельцу.'),
+            (room.owner, f'{username} просит войти в {name}: '
+                         f'/approve {name} {username}'),
+        ]
+
+    def approve(self, username: str, name: str, target: str) -> Notices:
+        room = self.rooms.get(name)
+        if room is None or room.owner != username:
+            return [(username, f'Вы не владелец комнаты {name}.')]
+        if target not in room.pending:
+            return [(username, f'{target} не запрашивал вход в {name}.')]
+        self._add_member(room, target)
+        return [
+            (username, f'{target} добавлен в комнату {name}.'),
+            (target, f'Вы вошли в комнату {name}.'),
+        ]
+
+    def leave(self, username: str, name: str) -> Notices:
+        room = self.rooms.get(name)
+        if room is None or username not in room.members:
+            return [(username, f'Вы не состоите в комнате {name}.')]
+        self._remove_member(room, username)
+        if username == room.owner:
+            # Комната без владельца закрывается
+            members = list(room.members)
+            for member in members:
+                self._remove_member(room, member)
+            del self.rooms[name]
+            self.subscribers.pop(name, None)
+            return [
+                (member, f'Комната {name} закрыта.')
+                for member in (username, *members)
+            ]
+        return [(username, f'Вы вышли из комнаты {name}.')]
+
+    def snapshot(self) -> list[dict]:
+        """
+        Возвращает состояние комнат для записи в журнал.
+        """
+        return [
+            {
+                'name': room.name, 'owner': room.owner, 'token': room.token,
+                'members': sorted(room.members),
+                'pending': sorted(room.pending),
+            }
+            for room in self.rooms.values()
+        ]
+
+    def load(self, snapshot: list[dict]) -> None:
+        """
+        Заменяет комнаты состоянием из снимка журнала.
+        """
+        for name in list(self.rooms):
+            self.subscribers.pop(name, None)
+        self.rooms.clear()
+        self.memberships.clear()
+        for data in snapshot:
+            room = self.rooms[data['name']] = Room(
+                data['name'], data['owner'], data['token'])
+            room.pending.update(data['pending'])
+            for username in data['members']:
+                self._add_member(room, username)
+
+    def apply(self, event: dict) -> Notices:
+        """
+        Применяет событие изменения комнаты от брокера.
+        """
+        action = event['action']
+        username = event['username']
+        name = event['room']
+        if action == 'create':
+            return self.create(username, name, event['token'])
+        if action == 'invite':
+            return self.invite(username, name, event['target'])
+        if action == 'join':
+            return self.request(username, name, event['token'])
+        if action == 'approve':
+            return self.approve(username, name, event['target'])
+        if action == 'leave':
+            return self.leave(username, name)
+        return []
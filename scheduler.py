@@ -0,0 +1,143 @@
+import asyncio
+import heapq
+import logging
+from typing import TYPE_CHECKING, Callable, Optional
+
+if TYPE_CHECKING:
+    from message import Message
+
+logger = logging.getLogger(__name__)
+
+# Допуск, в пределах которого срабатывание таймера считается своевременным
+CLOCK_TOLERANCE_SEC = 0.001
+
+
+class DelayedMessageScheduler:
+    """
+    Планировщик отложенных сообщений.
+
+    Сообщения хранятся в двоичной куче по времени отправки, а на ближайшее
+    из них взводится один таймер loop.call_at. Вставка стоит O(log n),
+    отмена выполняется лениво: запись остается в куче, пока не
+    дойдет до ее вершины или до очередного уплотнения.
+    """
+
+    def __init__(self, callback: Callable[['Message'], None]):
+        self._callback = callback
+        self._heap: list[tuple[float, int]] = []
+        self._pending: dict[int, 'Message'] = {}
+        self._by_author: dict[str, set[int]] = {}
+        self._next_id: int = 1
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_at: float = 0.0
+        # Счетчики отправленных и отмененных сообщений
+        self.fired: int = 0
+        self.cancelled: int = 0
+
+    @property
+    def pending(self) -> int:
+        """
+        Кол-во ожидающих отправки сообщений.
+        """
+        return len(self._pending)
+
+    def schedule(self, message: 'Message', delay: float) -> int:
+        """
+        Ставит сообщение в очередь на отправку через delay секунд
+        и возвращает его номер.
+        """
+        loop = asyncio.get_running_loop()
+        message_id = self._next_id
+        self._next_id += 1
+
+        when = loop.time() + max(delay, 0)
+        heapq.heappush(self._heap, (when, message_id))
+        self._pending[message_id] = message
+        self._by_author.setdefault(message.author, set()).add(message_id)
+
+        if self._timer is None or when < self._timer_at:
+            self._arm(loop)
+        return message_id
+
+    def cancel(self, message_id: int, author: str) -> bool:
+        """
+        Отменяет отложенное сообщение автора author по его номеру.
+        """
+        message = self._pending.get(message_id)
+        if message is None or message.author != author:
+            return False
+        self._forget(message_id, message)
+        self.cancelled += 1
+        self._compact()
+        return True
+
+    def clear(self, author: str) -> int:
+        """
+        Отменяет все отложенные сообщения автора author.
+        """
+        message_ids = list(self._by_author.get(author, ()))
+        for message_id in message_ids:
+            self._forget(message_id, self._pending[message_id])
+        self.cancelled += len(message_ids)
+        self._compact()
+        return len(message_ids)
+
+    def close(self) -> None:
+        """
+        Останавливает таймер планировщика.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _forget(self, message_id: int, message: 'Message') -> None:
+        del self._pending[message_id]
+        author_ids = self._by_author[message.author]
+        author_ids.discard(message_id)
+        if not author_ids:
+            del self._by_author[message.author]
+
+    def _compact(self) -> None:
+        """
+        Выбрасывает из кучи отмененные записи, когда их становится
+        больше, чем живых.
+        """
+        if len(self._heap) > 2 * len(self._pending) + 64:
+            self._heap = [
+                entry for entry in self._heap if entry[1] in self._pending
+            ]
+            heapq.heapify(self._heap)
+
+    def _arm(self, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Взводит таймер на время ближайшего живого сообщения.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        while self._heap and self._heap[0][1] not in self._pending:
+            heapq.heappop(self._heap)
+        if self._heap:
+            self._timer_at = self._heap[0][0]
+            self._timer = loop.call_at(self._timer_at, self._fire, loop)
+
+    def _fire(self, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Отправляет все сообщения, время которых наступило.
+        """
+        self._timer = None
+        deadline = loop.time() + CLOCK_TOLERANCE_SEC
+        while self._heap and self._heap[0][0] <= deadline:
+            _, message_id = heapq.heappop(self._heap)
+            message = self._pending.get(message_id)
+            if message is None:
+                continue
+            self._forget(message_id, message)
+            self.fired += 1
+            try:
+                self._callback(message)
+            except Exception as error:
+                logger.error(
+                    f'Ошибка при отправке отложенного сообщения: {error}')
+        self._arm(loop)
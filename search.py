@@ -0,0 +1,219 @@
+import re
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from typing import TYPE_CHECKING, Iterator, Optional
+
+if TYPE_CHECKING:
+    from message import Message
+
+# Слова короче двух символов (предлоги, союзы) не индексируются
+TOKEN_RE = re.compile(r'\w{2,}')
+# Автор индексируется отдельным словом, которое не встретится в тексте
+AUTHOR_PREFIX = '@'
+# Фильтры запроса /search
+SEARCH_FILTERS = ('from', 'since', 'until', 'before')
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Возвращает различные слова текста в нижнем регистре.
+    """
+    return list(dict.fromkeys(TOKEN_RE.findall(text.lower())))
+
+
+def author_token(author: str) -> str:
+    return AUTHOR_PREFIX + author
+
+
+class SearchQuery:
+    """
+    Разобранный запрос /search: слова (все должны встретиться
+    в сообщении) и фильтры по автору, времени и номеру сообщения.
+    """
+
+    def __init__(self):
+        self.terms: list[str] = []
+        self.author: str = ''
+        # Границы времени (timestamp) включительно
+        self.since: Optional[float] = None
+        self.until: Optional[float] = None
+        # Номер, с которого (не включая) начинается страница результатов
+        self.before: Optional[int] = None
+
+
+def parse_query(text: str) -> SearchQuery:
+    """
+    Разбирает запрос вида
+    'слова from:username since:2024-01-01T10:00 until:... before:seq'.
+    Бросает ValueError, если запрос пуст или фильтр некорректен.
+    """
+    query = SearchQuery()
+    for word in text.split():
+        key, _, value = word.partition(':')
+        if not value or key not in SEARCH_FILTERS:
+            query.terms.extend(tokenize(word))
+        elif key == 'from':
+            query.author = value
+        elif key == 'before':
+            query.before = int(value)
+        else:
+            timestamp = datetime.fromisoformat(value).timestamp()
+            setattr(query, key, timestamp)
+    if query.author:
+        query.terms.append(author_token(query.author))
+    query.terms = list(dict.fromkeys(query.terms))
+    if not query.terms:
+        raise ValueError('Пустой запрос')
+    return query
+
+
+class Postings:
+    """
+    Возрастающие номера сообщений, содержащих слово.
+
+    Номера хранятся в array без отдельных объектов int. Сообщения
+    устаревают в порядке номеров, поэтому удаление идет с головы
+    сдвигом начала, а место освобождается, когда удаленные номера
+    занимают больше половины массива.
+    """
+
+    __slots__ = ('seqs', 'head')
+
+    def __init__(self):
+        self.seqs = array('q')
+        self.head: int = 0
+
+    def __len__(self) -> int:
+        return len(self.seqs) - self.head
+
+    def remove(self, seq: int) -> None:
+        """
+        Удаляет номер seq, если он стоит в голове списка.
+        """
+        if self.head < len(self.seqs) and self.seqs[self.head] == seq:
+            self.head += 1
+            if self.head * 2 > len(self.seqs):
+                del self.seqs[:self.head]
+                self.head = 0
+
+    def __contains__(self, seq: int) -> bool:
+        index = bisect_left(self.seqs, seq, self.head)
+        return index < len(self.seqs) and self.seqs[index] == seq
+
+
+class SearchIndex:
+    """
+    Инвертированный индекс сообщений: слово -> номера сообщений.
+
+    Индекс ведется отдельно для каждой ленты (общий чат, личные
+    сообщения пользователя, комната), поэтому поиск смотрит только
+    в ленты, которые видит пользователь. Индекс обновляется при
+    добавлении и вытеснении каждого сообщения, а для фильтров
+    по времени хранит соответствие времени и номеров сообщений.
+    """
+
+    def __init__(self):
+        self.scopes: dict[str, dict[str, Postings]] = {}
+        self._times = array('d')
+        self._seqs = array('q')
+        self._head: int = 0
+
+    def add(self, message: 'Message', timestamp: float) -> None:
+        """
+        Индексирует сообщение. timestamp не убывает от сообщения
+        к сообщению.
+        """
+        scope = self.scopes.setdefault(message.to_username, {})
+        seq = message.seq
+        for token in self.tokens(message):
+            postings = scope.get(token)
+            if postings is None:
+                postings = scope[token] = Postings()
+            postings.seqs.append(seq)
+        self._times.append(timestamp)
+        self._seqs.append(seq)
+
+    def remove(self, message: 'Message') -> None:
+        """
+        Удаляет из индекса вытесненное сообщение.
+        """
+        scope = self.scopes.get(message.to_username)
+        if scope is None:
+            return
+        for token in self.tokens(message):
+            postings = scope.get(token)
+            if postings is None:
+                continue
+            postings.remove(message.seq)
+            if not postings:
+                del scope[token]
+        if not scope:
+            del self.scopes[message.to_username]
+
+    def drop_scope(self, scope: str) -> None:
+        """
+        Удаляет из индекса все сообщения ленты scope.
+        """
+        self.scopes.pop(scope, None)
+
+    def expire(self, seq: int) -> None:
+        """
+        Забывает время сообщений с номером не больше seq.
+        """
+        self._head = bisect_right(self._seqs, seq, self._head)
+        if self._head * 2 > len(self._seqs):
+            del self._times[:self._head]
+            del self._seqs[:self._head]
+            self._head = 0
+
+    def tokens(self, message: 'Message') -> list[str]:
+        tokens = tokenize(message.text)
+        tokens.append(author_token(message.author))
+        return tokens
+
+    def seq_range(
+            self, since: Optional[float],
+            until: Optional[float]) -> tuple[int, int]:
+        """
+        Переводит границы времени в границы номеров сообщений
+        [нижняя, верхняя).
+        """
+        lower, upper = 0, sys.maxsize
+        if since is not None:
+            index = bisect_left(self._times, since, self._head)
+            lower = (
+                self._seqs[index] if index < len(self._seqs) else sys.maxsize)
+        if until is not None:
+            index = bisect_right(self._times, until, self._head)
+            upper = self._seqs[index] if index < len(self._seqs) else upper
+        return lower, upper
+
+    def search(
+            self, scope: str, terms: list[str], lower: int,
+            upper: int) -> Iterator[int]:
+        """
+        Перебирает от новых к старым номера сообщений ленты scope
+        из диапазона [lower, upper), содержащих все слова terms.
+        Перебор идет по самому редкому слову, остальные проверяются
+        двоичным поиском.
+        """
+        index = self.scopes.get(scope)
+        if index is None:
+            return
+        postings = []
+        for term in terms:
+            term_postings = index.get(term)
+            if term_postings is None:
+                return
+            postings.append(term_postings)
+        rarest, *others = sorted(postings, key=len)
+        position = bisect_left(rarest.seqs, upper, rarest.head)
+        while position > rarest.head:
+            position -= 1
+            seq = rarest.seqs[position]
+            if seq < lower:
+                return
+            if all(seq in other for other in others):
+                yield seq
@@ -1,134 +1,285 @@
 import asyncio
-import json
+import heapq
 import logging
-import sys
+import os
+import secrets
+import time
 from asyncio.streams import StreamReader, StreamWriter
-from datetime import datetime, timedelta
+from collections import Counter
+from datetime import datetime
+from typing import Iterable, Optional, Union
 
+import metrics
+from bus import BrokerServer, ChatBroker, LocalBus, SocketBus
+from connection import BaseConnection, Connection
+from files import FileStore, FileTransferError, Upload
+from http_api import HttpApi
+from logs import setup_logging
+from message import (
+    Message,
+    message_object_to_record,
+    message_record_to_object,
+    message_str_to_object,
+)
+from protocol import (
+    FLAG_COMPRESSION,
+    FRAME_FILE_BEGIN,
+    FRAME_FILE_CHUNK,
+    FRAME_FILE_END,
+    PROTOCOL_MAGIC,
+    PROTOCOL_VERSION,
+    FileFrame,
+    FrameCodec,
+    Incoming,
+    LineCodec,
+    ProtocolError,
+    StreamCodec,
+    accept_flags,
+    fits_frame,
+    hello,
+    make_codec,
+    read_hello,
+)
+from rooms import (
+    GENERAL_ROOM,
+    Notices,
+    RoomIndex,
+    is_room,
+    is_valid_room_name,
+    is_valid_username,
+)
+from search import parse_query
 from settings import Settings
+from store import MessageStore
+from transport import ChatProtocol
+from wal import MessageLog
 
 settings = Settings()
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s]: %(message)s',
-    stream=sys.stdout,
-)
-
 logger = logging.getLogger(__name__)
 
-
-class Message:
-    def __init__(
-            self,
-            username: str,
-            text: str = '',
-            created_at: datetime = datetime.now(),
-            sep: str = ':',
-            to: str = '',
-            send_after: int = 0
-    ):
-        self.author = username
-        self.text = text
-        self.datetime = created_at
-        self.sep = sep
-        self.to_username = to
-        self.send_after = send_after
-
-    def __str__(self) -> str:
-        return f'{self.author}{self.sep} {self.text}'
-
-
-def message_object_to_str(message: Message) -> str:
-    """
-    Сериализует объект Message в строку
-    """
-    return (f'{message.datetime};{message.author};'
-            f'{message.text};{message.sep};{message.to_username}\n')
-
-
-def message_str_to_object(message: str) -> Message:
-    """
-    Десериализует строку message в объект Message
-    """
-    message_list = message.split(sep=';', maxsplit=4)
-    username = message_list[1]
-    text = message_list[2]
-    created_at = datetime.strptime(message_list[0], '%Y-%m-%d %H:%M:%S.%f')
-    sep = message_list[3]
-    to_username = message_list[4]
-    return Message(username=username, text=text, created_at=created_at,
-                   sep=sep, to=to_username)
+# Команды комнат и подсказки к их формату
+ROOM_COMMANDS = {
+    '/create': '/create #room',
+    '/invite': '/invite #room username',
+    '/link': '/link #room',
+    '/join': '/join #room token',
+    '/approve': '/approve #room username',
+    '/leave': '/leave #room',
+    '/room': '/room #room text',
+    '/rooms': '/rooms',
+}
+# Дополнительный аргумент события комнаты для команд, которым он нужен
+ROOM_COMMAND_ARGUMENTS = {
+    '/invite': 'target',
+    '/join': 'token',
+    '/approve': 'target',
+}
+# Кол-во самых длинных очередей клиентов в выводе /status
+STATUS_QUEUES_CNT = 5
+# Подсказка по формату запроса поиска
+SEARCH_USAGE = (
+    'Формат: /search слова [from:username] [since:2024-01-01T10:00] '
+    '[until:2024-01-01T12:00] [before:номер]')
 
 
 class Server:
-    # # Имя файла для сохранения истории общего чата
-    # BACKUP_FILE = 'messages.json'
-
     def __init__(
             self,
             host: str = settings.SERVER.HOST,
-            port: int = settings.SERVER.PORT
+            port: int = settings.SERVER.PORT,
+            bus: Optional[SocketBus] = None,
+            metrics_port: int = settings.SERVER.METRICS_PORT,
+            http_port: int = settings.SERVER.HTTP_PORT
     ):
-        self.clients: dict[str, StreamWriter | datetime] = {}
-        self.server = None
+        # Присутствие (кол-во подключенных устройств пользователей во всех
+        # процессах) и время последнего выхода из чата хранятся отдельно
+        self.online: Counter[str] = Counter()
+        self.last_seen: dict[str, datetime] = {}
+        # Комнаты, подписки и подключения к этому процессу
+        self.rooms = RoomIndex()
+        # Файлы пользователей и незавершенные загрузки по подключениям
+        # (None - загрузка отклонена, остаток файла пропускается)
+        self.files = FileStore(
+            settings.SERVER.FILES_DIR, settings.SERVER.MAX_FILE_SIZE)
+        self.files.open()
+        self.uploads: dict[BaseConnection, Optional[Upload]] = {}
+        # Команды, которые выполняются отдельными методами
+        self.commands = {
+            command: self.handle_room_command for command in ROOM_COMMANDS}
+        self.commands['/get'] = self.send_file
+        self.commands['/search'] = self.search_messages
+        # Номера последних полученных пользователями сообщений, общие
+        # для всех устройств пользователя
+        self.cursors: dict[str, int] = {}
+        self.server: Optional[asyncio.AbstractServer] = None
         self.host: str = host
         self.port: int = port
-        self.message_store: list[Message] = []
-        self.message_to_send: list[Message] = []
+        self.metrics_server: Optional[metrics.MetricsServer] = None
+        if metrics_port:
+            self.metrics_server = metrics.MetricsServer(
+                settings.SERVER.METRICS_HOST, metrics_port)
+        self.http_api: Optional[HttpApi] = None
+        if http_port:
+            self.http_api = HttpApi(self, host, http_port)
+        self.message_store = MessageStore(
+            settings.TTL_MESSAGES_SEC, settings.PUBLIC_HISTORY_SIZE)
+        self.background_tasks: set[asyncio.Task] = set()
+        self.message_log = MessageLog(
+            settings.SERVER.LOG_DIR, settings.SERVER.LOG_SEGMENT_SIZE)
 
-        self.restore_chat_history(settings.SERVER.BACKUP_FILE)
+        # В режиме нескольких процессов журнал ведет брокер
+        self.restore_chat_history(repair=bus is None)
+        if bus is None:
+            self.message_log.open(settings.TTL_MESSAGES_SEC.total_seconds())
+            broker = ChatBroker(
+                self.message_log, self.message_store.last_seq)
+            broker.rooms.load(self.rooms.snapshot())
+            self.bus: Union[LocalBus, SocketBus] = LocalBus(broker)
+        else:
+            self.bus = bus
+        self.register_metrics()
 
-    def backup_chat_history(self, backup_file: str) -> None:
+    def connections(self) -> list[BaseConnection]:
         """
-        Сохраняет историю общего чата в JSON-файл (BACKUP_FILE).
+        Возвращает подключения клиентов к этому процессу.
         """
-        messages_json = []
-        for message in self.message_store:
-            message_dict = dict(message.__dict__)
-            message_dict['datetime'] = str(message.datetime)
-            messages_json.append(message_dict)
+        return [
+            connection
+            for devices in self.rooms.sessions.values()
+            for connection in devices
+        ]
 
-        with open(backup_file, 'w') as f:
-            json.dump(messages_json, f, indent=4)
-        logger.info(
-            f'История общего чата успешно сохранена в {backup_file}.'
-        )
+    def register_metrics(self) -> None:
+        """
+        Регистрирует вычисляемые метрики состояния сервера.
+        """
+        registry = metrics.registry
+        registry.gauge(
+            'chat_clients_connected', 'Подключенных к процессу клиентов',
+            lambda: len(self.connections()))
+        registry.gauge(
+            'chat_store_messages', 'Сообщений в хранилище',
+            lambda: len(self.message_store))
+        # Очереди отдаются сводными значениями: метка по пользователю
+        # дала бы по ряду на каждого подключенного клиента
+        registry.gauge(
+            'chat_connection_queue_depth_total',
+            'Записей в очередях всех клиентов',
+            lambda: sum(c.queue_depth for c in self.connections()))
+        registry.gauge(
+            'chat_connection_queue_depth_max',
+            'Самая длинная очередь клиента',
+            lambda: max(
+                (c.queue_depth for c in self.connections()), default=0))
+        if isinstance(self.bus, LocalBus):
+            broker = self.bus.broker
+            registry.gauge(
+                'chat_delayed_pending', 'Отложенных сообщений в ожидании',
+                lambda: broker.scheduler.pending)
+            registry.gauge(
+                'chat_log_pending', 'Записей в очереди журнала',
+                lambda: broker.message_log.pending)
+            registry.gauge(
+                'chat_rate_limited', 'Сообщений отклонено лимитами',
+                lambda: {
+                    'public': broker.public_limiter.rejected,
+                    'private': broker.private_limiter.rejected,
+                    'delay': broker.delay_limiter.rejected,
+                },
+                label='kind')
 
-    def restore_chat_history(self, backup_file: str) -> None:
+    def status_lines(self) -> list[str]:
         """
-        Восстанавливает историю общего чата из JSON-файла (BACKUP_FILE).
+        Возвращает краткую сводку состояния сервера для команды /status.
         """
+        connections = self.connections()
+        depths = [connection.queue_depth for connection in connections]
+        lines = [
+            f'Пользователей в чате: {len(self.online)}, '
+            f'устройств: {sum(self.online.values())}, '
+            f'подключено к процессу: {len(connections)}, '
+            f'комнат: {len(self.rooms)}',
+            f'Сообщений в хранилище: {len(self.message_store)}',
+            f'Сообщений получено: {metrics.messages_received.value}, '
+            f'доставлено: {metrics.messages_delivered.value}, '
+            f'отброшено: {metrics.messages_dropped.value}',
+            f'Очереди клиентов: всего {sum(depths)}, '
+            f'максимум {max(depths, default=0)}',
+        ]
+        longest = heapq.nlargest(
+            STATUS_QUEUES_CNT, connections,
+            key=lambda connection: connection.queue_depth)
+        if longest and longest[0].queue_depth:
+            lines.append('Самые длинные очереди: ' + ', '.join(
+                f'{connection.username} {connection.queue_depth}'
+                for connection in longest if connection.queue_depth))
+        if isinstance(self.bus, LocalBus):
+            broker = self.bus.broker
+            lines.append(
+                f'Отложенных сообщений: {broker.scheduler.pending}')
+            if broker.message_log.error is not None:
+                lines.append(
+                    f'Журнал сообщений остановлен: '
+                    f'{broker.message_log.error}')
+        for name, histogram in (
+            ('задержка цикла событий', metrics.loop_lag_seconds),
+            ('обработка сообщения', metrics.receive_seconds),
+            ('раскладка по очередям', metrics.fanout_seconds),
+            ('ожидание сокета', metrics.drain_seconds),
+            ('запись журнала', metrics.log_fsync_seconds),
+        ):
+            lines.append(
+                f'p99 {name}: {histogram.quantile(0.99) * 1000:g} мс')
+        return lines
+
+    def restore_chat_history(self, repair: bool = True) -> None:
+        """
+        Восстанавливает историю чата из журнала сообщений (LOG_DIR).
+        """
+        ttl_sec = settings.TTL_MESSAGES_SEC.total_seconds()
         try:
-            with open(backup_file, 'r') as f:
-                messages = json.load(f)
-
-            for message in messages:
-                message_obj = Message(
-                    username=message.get('author'),
-                    text=message.get('text'),
-                    created_at=datetime.strptime(
-                        message.get('datetime'), '%Y-%m-%d %H:%M:%S.%f'
-                    ),
-                    sep=message.get('sep'),
-                    to=message.get('to_username'),
-                )
-
-                if (
-                    datetime.now() - message_obj.datetime
-                    < settings.TTL_MESSAGES_SEC
-                ):
-                    self.message_store.append(message_obj)
+            for record in self.message_log.replay(ttl_sec, repair):
+                self.restore_record(record, ttl_sec)
             logger.info(
-                f'История общего чата успешно восстановлена из {backup_file}.'
+                f'История чата восстановлена из {self.message_log.directory}'
+                f', сообщений: {len(self.message_store)}, '
+                f'комнат: {len(self.rooms)}.'
             )
-        except Exception as err:
+        except (OSError, ValueError, KeyError) as err:
             logger.error(
-                f'При чтении файла {backup_file} произошла ошибка: {err}.'
+                f'При чтении журнала {self.message_log.directory} '
+                f'произошла ошибка: {err}.'
             )
 
+    def restore_record(self, record: dict, ttl_sec: float) -> None:
+        """
+        Применяет запись журнала: сообщение, изменение комнаты или снимок
+        комнат. Записи идут в порядке журнала, поэтому сообщение
+        комнаты восстанавливается, только если комната тогда
+        существовала, и история закрытой комнаты не достается новой
+        с тем же именем.
+        """
+        record_type = record.get('type')
+        if record_type == 'room':
+            self.apply_room_change(record)
+            return
+        if record_type == 'rooms':
+            self.rooms.load(record['rooms'])
+            for name in list(self.message_store.private):
+                if is_room(name) and name not in self.rooms.rooms:
+                    self.message_store.drop(name)
+            return
+        message_obj = message_record_to_object(record)
+        if time.time() - message_obj.timestamp >= ttl_sec:
+            return
+        room = message_obj.to_username
+        if is_room(room) and room not in self.rooms.rooms:
+            return
+        self.message_store.add(message_obj)
+
     async def send_start_messages(
-            self, username: str, writer: StreamWriter) -> None:
+            self, username: str, connection: BaseConnection) -> None:
         """
         Посылает новому клиенту стартовое сообщение.
         """
@@ -143,242 +294,867 @@ class Server:
             'ǁ', '/private username text :отправка личного сообщения', sep=''))
         messages.append(Message(
             'ǁ', '/delay seconds text :отложенная отправка сообщения', sep=''))
+        messages.append(Message(
+            'ǁ', '/cancel id :отмена отложенного сообщения по номеру', sep=''))
         messages.append(Message(
             'ǁ', '/clear_unsent :стереть все неотправленые сообщения', sep=''))
+        messages.append(Message(
+            'ǁ', '/create #room :создать комнату (/invite, /link)', sep=''))
+        messages.append(Message(
+            'ǁ', '/join #room token :войти по ссылке-приглашению', sep=''))
+        messages.append(Message(
+            'ǁ', '/room #room text :написать в комнату (/rooms)', sep=''))
+        messages.append(Message(
+            'ǁ', '/get id :скачать файл (бинарный протокол)', sep=''))
+        messages.append(Message(
+            'ǁ', '/search слова [from:username] :поиск по истории', sep=''))
+        messages.append(Message(
+            'ǁ', '/status :состояние сервера и метрики', sep=''))
         messages.append(Message(
             'ǁ', '/stop :остановить сервер и сделать бэкап сообщений', sep=''))
         messages.append(Message(
             'ǁ', '==================================================', sep=''))
 
-        for message_obj in messages:
-            message_bytes = message_object_to_str(message_obj).encode()
-            writer.write(message_bytes)
-            await writer.drain()
+        await connection.send_messages(messages)
 
-    async def send_last_messages(self, writer: StreamWriter) -> None:
+    async def send_last_messages(self, connection: BaseConnection) -> None:
         """
         Посылает новому клиенту последние LAST_MESSAGES_CNT
         сообщений из общего чата.
         """
-        msg_counter = settings.LAST_MESSAGES_CNT
-        for message_obj in reversed(self.message_store):
-            if message_obj.to_username == '':
-                msg_counter -= 1
-                if msg_counter < 0:
-                    break
-                message_bytes = message_object_to_str(message_obj).encode()
-                writer.write(message_bytes)
-                await writer.drain()
+        messages = self.message_store.last_public(settings.LAST_MESSAGES_CNT)
+        await connection.send_messages(messages[::-1])
 
     async def send_unread_messages(
-            self, writer: StreamWriter, username: str,
-            exit_datetime: datetime) -> None:
+            self, connection: BaseConnection, cursor: int) -> None:
         """
         Посылает повторно подключенному клиенту непрочитанные
-        личные сообщения и сообщения из общего чата.
-        """
-        for message_obj in reversed(self.message_store):
-            if message_obj.datetime > exit_datetime:
-                if message_obj.to_username in ('', username):
-                    message_bytes = message_object_to_str(message_obj).encode()
-                    writer.write(message_bytes)
-                    await writer.drain()
-            else:
-                break
+        личные сообщения и сообщения из общего чата с номером больше
+        cursor. Сообщения уходят страницами по CATCH_UP_PAGE_SIZE,
+        следующая страница - только после отправки предыдущей.
+        """
+        username = connection.username
+        connection.sent_seq = cursor
+        connection.catching_up = True
+        try:
+            while not connection.closed:
+                messages = self.message_store.after_seq(
+                    [username, *self.rooms.user_rooms(username)],
+                    cursor, settings.CATCH_UP_PAGE_SIZE)
+                if not messages:
+                    break
+                await connection.send_messages(messages)
+                cursor = connection.sent_seq = messages[-1].seq
+                await connection.wait_flushed()
+        finally:
+            connection.catching_up = False
 
     async def send_all_except_me(
             self, message: str, author_username: str) -> None:
         """
         Отправляет сообщение всем клиентам в общем чате кроме себя.
         """
-        for username, writer in self.clients.items():
-            if (
-                username != author_username
-                and isinstance(writer, StreamWriter)
-            ):
-                message_obj = Message(author_username, message)
-                message_bytes = message_object_to_str(message_obj).encode()
-                writer.write(message_bytes)
-                await writer.drain()
+        await self.bus.publish(
+            {'type': 'broadcast', 'author': author_username, 'text': message})
+
+    async def broadcast(
+            self, messages: list[Message], exclude_username: str = '',
+            room: str = GENERAL_ROOM) -> None:
+        """
+        Раскладывает сообщения по очередям подписчиков комнаты (по
+        умолчанию общего чата), кроме exclude_username.
+        """
+        await self.fan_out(
+            self.rooms.members(room), messages, exclude_username)
+
+    async def fan_out(
+            self, connections: Iterable[BaseConnection],
+            messages: list[Message], exclude_username: str = '') -> None:
+        """
+        Раскладывает сообщения по очередям подключений. Сообщения
+        сериализуются один раз для каждой версии протокола, и все
+        устройства получают один и тот же объект bytes.
+        """
+        started = time.perf_counter()
+        payloads: dict[int, bytes] = {}
+        blocked = []
+        delivered = 0
+        seq = messages[-1].seq
+        for connection in connections:
+            if seq:
+                # Сохраненные сообщения догружающий клиент получит
+                # из хранилища по порядку
+                if connection.catching_up:
+                    continue
+                connection.sent_seq = seq
+            if connection.username == exclude_username:
+                continue
+            version = connection.codec.version
+            payload = payloads.get(version)
+            if payload is None:
+                payload = payloads[version] = connection.codec.encode(
+                    messages)
+            delivered += len(messages)
+            if not connection.send_nowait(payload):
+                blocked.append((connection, payload))
+        metrics.messages_delivered.inc(delivered)
+        metrics.fanout_seconds.observe(time.perf_counter() - started)
+
+        # Ждем освобождения очередей только для политики block
+        for connection, payload in blocked:
+            await connection.send(payload)
+
+    async def send_notice(self, connection: BaseConnection, text: str) -> None:
+        """
+        Отправляет клиенту служебное сообщение от сервера.
+        """
+        await connection.send_messages([Message('!', text, sep='')])
 
     async def send_private_message(
-            self, message: str, target_username: str, author_username: str
-    ) -> None:
+            self, connection: BaseConnection, message_obj: Message) -> None:
         """
         Отправляет личное сообщение указанному пользователю.
         """
         # Проверяем присутствует ли указанный пользователь в чате
-        if target_username in self.clients.keys():
-            writer = self.clients[target_username]
-            message = ' '.join(['[private]', message])
-            message_obj = Message(author_username, message)
+        target_username = message_obj.to_username
+        if target_username in self.online or target_username in self.last_seen:
+            await self.bus.publish({
+                'type': 'message',
+                'message': message_object_to_record(message_obj),
+            })
         else:
-            writer = self.clients[author_username]
-            message = (f'Сообщение не отправлено. Пользователя с именем '
-                       f'{target_username} нет в чате!')
-            message_obj = Message('!', message, sep='')
+            await self.send_notice(
+                connection,
+                f'Сообщение не отправлено. Пользователя с именем '
+                f'{message_obj.to_username} нет в чате!')
 
-        # Убеждаемся что пользователь есть в чате
-        if isinstance(writer, StreamWriter):
-            message_bytes = message_object_to_str(message_obj).encode()
-            writer.write(message_bytes)
-            await writer.drain()
+    async def handshake(
+            self, reader: StreamReader, writer: StreamWriter
+    ) -> tuple[StreamCodec, Message]:
+        """
+        Согласует с клиентом версию протокола и принимает стартовое
+        сообщение с именем пользователя. Клиенты старого текстового
+        протокола сразу присылают стартовое сообщение строкой.
+        Сжатие включается, если его запросил клиент и разрешает сервер.
+        Недопустимое имя пользователя отклоняется с уведомлением.
+        """
+        first_byte = await reader.readexactly(1)
+        if first_byte != PROTOCOL_MAGIC[:1]:
+            intro_bytes = first_byte + await reader.readline()
+            message_str = intro_bytes.decode().strip()
+            codec: StreamCodec = LineCodec()
+            intro = message_str_to_object(message_str)
+        else:
+            codec = await self.negotiate(reader, writer, first_byte)
+            messages = await codec.read(reader)
+            if not messages or not isinstance(messages[0], Message):
+                raise ProtocolError('Нет стартового сообщения')
+            intro = messages[0]
 
-    async def client_connected(
-            self, reader: StreamReader, writer: StreamWriter):
+        if not is_valid_username(intro.author):
+            writer.write(codec.encode([Message(
+                '!', f'Имя {intro.author!r} недопустимо.', sep='')]))
+            raise ProtocolError(f'Недопустимое имя: {intro.author!r}')
+        return codec, intro
 
-        # Фиксируем счетчик лимита сообщений и время соединения
-        msg_counter = settings.LIMIT_MESSAGES_CNT
-        connected_at = datetime.now()
+    async def negotiate(
+            self, reader: StreamReader, writer: StreamWriter,
+            first_byte: bytes) -> StreamCodec:
+        """
+        Читает приветствие бинарного протокола, отвечает на него
+        и возвращает кодек согласованной версии.
+        """
+        client_version, client_flags = await read_hello(reader, first_byte)
+        version = min(client_version, PROTOCOL_VERSION)
+        flags = accept_flags(client_flags, settings.SERVER.COMPRESSION)
+        writer.write(hello(version, flags))
+        codec = make_codec(version, settings.SERVER.MAX_FRAME_SIZE)
+        if flags & FLAG_COMPRESSION and isinstance(codec, FrameCodec):
+            codec.enable_compression(
+                settings.SERVER.COMPRESSION_THRESHOLD,
+                settings.SERVER.COMPRESSION_LEVEL)
+        return codec
 
-        # Принимаем от клиента стартовое сообщение с именем пользователя
-        intro_bytes = await reader.readline()
-        # Принятый байткод переводим в строку и десереализуем в объект Message
-        message_str = intro_bytes.decode().strip()
-        message_obj = message_str_to_object(message_str)
+    async def handle_message(
+            self, connection: BaseConnection, message_obj: Incoming) -> None:
+        """
+        Обрабатывает сообщение от клиента с учетом метрик.
+        """
+        if isinstance(message_obj, FileFrame):
+            await self.receive_file_frame(connection, message_obj)
+            return
+        started = time.perf_counter()
+        metrics.messages_received.inc()
+        # Сообщение рассылается кадрами бинарного протокола, поэтому
+        # должно уместиться в один кадр
+        if not fits_frame(message_obj, settings.SERVER.MAX_FRAME_SIZE):
+            await self.send_notice(connection, 'Сообщение слишком длинное.')
+            return
+        await self.execute_message(connection, message_obj)
+        metrics.receive_seconds.observe(time.perf_counter() - started)
 
-        # Смотрим не подключался ли пользователь ранее
-        if message_obj.author not in self.clients.keys():
-            self.clients[message_obj.author] = writer
-            await self.send_start_messages(message_obj.author, writer)
-            await self.send_last_messages(writer)
-
-            new_client_message = f'== {message_obj.author} вошел в чат =='
-            print(new_client_message)
-            await self.send_all_except_me(
-                new_client_message, message_obj.author)
+    async def execute_message(
+            self, connection: BaseConnection, message_obj: Message) -> None:
+        """
+        Выполняет команду или рассылает сообщение от клиента.
+        """
+        username = connection.username
+        # Текст хранится в UTF-8, поэтому декодируется один раз на разбор
+        text = message_obj.text
+
+        command = self.commands.get(text.split(' ', 1)[0])
+        if command is not None:
+            await command(connection, message_obj)
+
+        elif text.startswith('/status'):
+            await connection.send_messages([
+                Message('!', line, sep='') for line in self.status_lines()])
+
+        elif text.startswith('/stop'):
+            await self.bus.publish({'type': 'stop'})
+
+        elif text.startswith('/delay'):
+            await self.send_delayed_message(connection, message_obj)
+
+        elif text.startswith('/cancel'):
+            """
+            Отменить отложенное сообщение по его номеру.
+            """
+            [_, message_id] = (text.split() + [''])[:2]
+            if message_id.isdigit():
+                await self.bus.publish({
+                    'type': 'cancel', 'id': int(message_id),
+                    'author': username,
+                })
+            else:
+                await self.send_notice(
+                    connection, f'Сообщение #{message_id} не найдено.')
+
+        elif text.startswith('/clear_unsent'):
+            """
+            Стереть все неотправленные сообщения пользователя.
+            """
+            await self.bus.publish({'type': 'clear', 'author': username})
+
+        elif text.startswith('/private'):
+            await self.handle_private_command(connection, message_obj, text)
         else:
-            exit_datetime = self.clients[message_obj.author]
-            self.clients[message_obj.author] = writer
-            await self.send_unread_messages(
-                writer, message_obj.author, exit_datetime)
+            await self.send_public_message(connection, message_obj)
+
+    async def handle_private_command(
+            self, connection: BaseConnection, message_obj: Message,
+            text: str) -> None:
+        """
+        Отрпавить личное сообщение указанному пользователю
+        или вывести сообщение об ошибке.
+        """
+        # Парсим текст сообщения и записываем данные в Message
+        try:
+            [_, target_username, private_text] = text.split(maxsplit=2)
+        except ValueError:
+            await self.send_notice(
+                connection, 'Формат: /private username text')
+            return
+        message_obj.to_username = target_username
+        message_obj.text = private_text
+        await self.send_private_message(connection, message_obj)
+
+    async def send_delayed_message(
+            self, connection: BaseConnection, message_obj: Message) -> None:
+        """
+        Отправить сообщение c заданной в секундах задержкой.
+        """
+        # Парсим текст сообщения и записываем данные в Message
+        try:
+            [_, delay, text] = message_obj.text.split(maxsplit=2)
+            message_obj.send_after = int(delay)
+        except ValueError:
+            await self.send_notice(connection, 'Формат: /delay seconds text')
+            return
+        if not 0 <= message_obj.send_after <= settings.MAX_DELAY_SEC:
+            await self.send_notice(
+                connection,
+                f'Задержка должна быть от 0 до {settings.MAX_DELAY_SEC} сек.')
+            return
+        message_obj.text = text
+        await self.bus.publish({
+            'type': 'delay',
+            'message': message_object_to_record(message_obj),
+            'delay': message_obj.send_after,
+        })
+
+    async def handle_room_command(
+            self, connection: BaseConnection, message_obj: Message) -> None:
+        """
+        Выполняет команды комнат. Изменения комнат проходят через брокер,
+        чтобы все рабочие процессы применили их в одном порядке.
+        """
+        [command, *args] = message_obj.text.split(maxsplit=2)
+        username = connection.username
+        name = args[0] if args else ''
+        argument = ROOM_COMMAND_ARGUMENTS.get(command)
+        if command == '/rooms':
+            rooms = ', '.join(sorted(self.rooms.user_rooms(username)))
+            await self.send_notice(connection, f'Ваши комнаты: {rooms}')
+        elif not is_valid_room_name(name) or (
+            (argument or command == '/room') and len(args) < 2
+        ):
+            await self.send_notice(
+                connection, f'Формат: {ROOM_COMMANDS[command]}')
+        elif command == '/room':
+            await self.send_room_message(
+                connection, message_obj, name, args[1])
+        elif command == '/link':
+            room = self.rooms.rooms.get(name)
+            if room is None or room.owner != username:
+                text = f'Вы не владелец комнаты {name}.'
+            else:
+                text = f'Ссылка-приглашение: /join {name} {room.token}'
+            await self.send_notice(connection, text)
+        else:
+            event = {
+                'type': 'room', 'action': command[1:], 'room': name,
+                'username': username,
+            }
+            if command == '/create':
+                event['token'] = secrets.token_urlsafe(8)
+            elif argument:
+                event[argument] = args[1]
+            await self.bus.publish(event)
+
+    async def send_room_message(
+            self, connection: BaseConnection, message_obj: Message,
+            room: str, text: str) -> None:
+        """
+        Отправляет сообщение участникам комнаты.
+        """
+        if room not in self.rooms.user_rooms(connection.username):
+            await self.send_notice(
+                connection, f'Вы не состоите в комнате {room}.')
+            return
+        message_obj.to_username = room
+        message_obj.text = text
+        await self.bus.publish({
+            'type': 'message',
+            'message': message_object_to_record(message_obj),
+        })
+
+    async def send_public_message(
+            self, connection: BaseConnection, message_obj: Message) -> None:
+        """
+        Рассылает сообщение в общий чат. Лимит сообщений проверяет
+        брокер.
+        """
+        await self.bus.publish({
+            'type': 'message',
+            'message': message_object_to_record(message_obj),
+        })
+
+    async def receive_file_frame(
+            self, connection: BaseConnection, frame: FileFrame) -> None:
+        """
+        Принимает кадр загрузки файла. При ошибке загрузка прерывается,
+        а клиент получает уведомление.
+        """
+        try:
+            await self.receive_file_part(connection, frame)
+        except (FileTransferError, ProtocolError, OSError) as error:
+            upload = self.uploads.get(connection)
+            if upload is not None:
+                upload.abort()
+            if frame.frame_type != FRAME_FILE_END:
+                self.uploads[connection] = None
+            logger.error(f'Ошибка загрузки файла: {error}')
+            await self.send_notice(connection, f'Файл не загружен: {error}')
+
+    async def receive_file_part(
+            self, connection: BaseConnection, frame: FileFrame) -> None:
+        """
+        Начинает загрузку, дописывает часть файла на диск или завершает
+        загрузку и рассылает сообщение о файле.
+        """
+        codec = connection.codec
+        if not isinstance(codec, FrameCodec):
+            raise ProtocolError('Файлы передаются по бинарному протоколу')
+        if frame.frame_type == FRAME_FILE_BEGIN:
+            size, name, to_username = codec.decode_file_begin(frame.payload)
+            previous = self.uploads.pop(connection, None)
+            if previous is not None:
+                previous.abort()
+            self.uploads[connection] = self.files.begin(
+                name, size, to_username)
+            return
+
+        if connection not in self.uploads:
+            raise FileTransferError('загрузка не начата.')
+        upload = self.uploads[connection]
+        if upload is None:
+            # Загрузка уже отклонена, клиент об этом уведомлен
+            if frame.frame_type == FRAME_FILE_END:
+                del self.uploads[connection]
+            return
+        if frame.frame_type == FRAME_FILE_CHUNK:
+            await self.files.write(upload, frame.payload)
+        elif frame.frame_type == FRAME_FILE_END:
+            del self.uploads[connection]
+            file_id = await self.files.finish(upload, frame.payload)
+            await self.publish_file(connection, upload, file_id)
+        else:
+            raise ProtocolError(f'Неожиданный кадр: {frame.frame_type}')
+
+    async def publish_file(
+            self, connection: BaseConnection, upload: Upload,
+            file_id: str) -> None:
+        """
+        Рассылает получателям загруженного файла сообщение с командой
+        для его скачивания.
+        """
+        message_obj = Message(
+            connection.username,
+            f'[file] {upload.name}, {upload.size} байт: /get {file_id}',
+            to=upload.to_username)
+        if is_room(upload.to_username):
+            await self.send_room_message(
+                connection, message_obj, upload.to_username, message_obj.text)
+        elif upload.to_username:
+            await self.send_private_message(connection, message_obj)
+        else:
+            await self.send_public_message(connection, message_obj)
+
+    async def send_file(
+            self, connection: BaseConnection, message_obj: Message) -> None:
+        """
+        Отдает клиенту файл по идентификатору из команды /get.
+        Содержимое файла уходит в сокет через sendfile.
+        """
+        [_, file_id] = (message_obj.text.split() + [''])[:2]
+        codec = connection.codec
+        if not isinstance(codec, FrameCodec):
+            await self.send_notice(
+                connection, 'Файлы выдаются только по бинарному протоколу.')
+            return
+        path = self.files.path(file_id)
+        try:
+            if path is None:
+                raise FileNotFoundError(file_id)
+            file = open(path, 'rb')
+        except OSError:
+            await self.send_notice(connection, f'Файл {file_id} не найден.')
+            return
+        size = os.fstat(file.fileno()).st_size
+        await connection.send_file(
+            codec.encode_file_header(bytes.fromhex(file_id), size), file)
+
+    async def search_messages(
+            self, connection: BaseConnection, message_obj: Message) -> None:
+        """
+        Ищет сообщения по словам среди видимых пользователю: общий чат,
+        его личные сообщения и его комнаты. Результаты выдаются
+        страницами от новых к старым.
+        """
+        text = message_obj.text[len('/search'):]
+        try:
+            query = parse_query(text)
+        except ValueError:
+            await self.send_notice(connection, SEARCH_USAGE)
+            return
+        username = connection.username
+        found = self.message_store.search(
+            [GENERAL_ROOM, username, *self.rooms.user_rooms(username)],
+            query, settings.SEARCH_PAGE_SIZE)
+
+        messages = []
+        for found_obj in found:
+            prefix = ''
+            if is_room(found_obj.to_username):
+                prefix = f'[{found_obj.to_username}] '
+            elif found_obj.to_username:
+                prefix = '[private] '
+            # Найденные сообщения не сдвигают курсор прочитанного
+            messages.append(Message(
+                found_obj.author,
+                f'#{found_obj.seq} {found_obj.datetime:%Y-%m-%d %H:%M} '
+                f'{prefix}{found_obj.text}',
+                sep=found_obj.sep, timestamp_us=found_obj.timestamp_us))
+        notice = f'Найдено сообщений: {len(found)}.'
+        if len(found) == settings.SEARCH_PAGE_SIZE:
+            words = [
+                word for word in text.split()
+                if not word.startswith('before:')]
+            words.append(f'before:{found[-1].seq}')
+            notice += f' Следующая страница: /search {" ".join(words)}'
+        messages.append(Message('!', notice, sep=''))
+        await connection.send_messages(messages)
+
+    async def apply_event(self, event: dict) -> None:
+        """
+        Применяет событие, пришедшее от брокера: сохраняет сообщения,
+        обновляет присутствие пользователей и доставляет сообщения
+        клиентам этого процесса.
+        """
+        event_type = event['type']
+        if event_type == 'message':
+            message_obj = event['message']
+            # Из сокета брокера сообщение приходит словарем записи
+            if isinstance(message_obj, dict):
+                message_obj = message_record_to_object(message_obj)
+            await self.deliver_message(message_obj)
+        elif event_type == 'broadcast':
+            await self.broadcast(
+                [Message(event['author'], event['text'])], event['author'])
+        elif event_type == 'notice':
+            await self.notify(event['to'], event['text'])
+        elif event_type == 'room':
+            await self.apply_room_event(event)
+        elif event_type == 'join':
+            self.online[event['username']] += 1
+        elif event_type == 'leave':
+            username = event['username']
+            self.cursors[username] = max(
+                self.cursors.get(username, 0), event['cursor'])
+            self.last_seen[username] = datetime.fromtimestamp(event['at'])
+            self.online[username] -= 1
+            if self.online[username] <= 0:
+                del self.online[username]
+        elif event_type == 'stop':
+            await self.stop()
+
+    async def apply_room_event(self, event: dict) -> None:
+        """
+        Применяет изменение комнаты и уведомляет участников.
+        Лента хранится только у существующей комнаты: история
+        закрытой комнаты не достается новой с тем же именем.
+        """
+        for username, text in self.apply_room_change(event):
+            await self.notify(username, text)
+
+    def apply_room_change(self, event: dict) -> Notices:
+        """
+        Применяет изменение комнаты и удаляет ленту несуществующей
+        комнаты.
+        """
+        name = event['room']
+        if name not in self.rooms.rooms:
+            self.message_store.drop(name)
+        notices = self.rooms.apply(event)
+        if name not in self.rooms.rooms:
+            self.message_store.drop(name)
+        return notices
+
+    async def notify(self, username: str, text: str) -> None:
+        """
+        Посылает служебное сообщение на все устройства пользователя,
+        подключенные к этому процессу.
+        """
+        await self.fan_out(
+            self.rooms.devices(username), [Message('!', text, sep='')])
+
+    async def deliver_message(self, message_obj: Message) -> None:
+        """
+        Сохраняет сообщение с присвоенным брокером номером и доставляет
+        его получателям, подключенным к этому процессу.
+        """
+        self.message_store.add(message_obj)
+        if not message_obj.to_username:
+            # Эхо общего чата пишет процесс, к которому подключен автор
+            if self.rooms.devices(message_obj.author):
+                logger.info(str(message_obj), extra={
+                    'category': 'chat', 'message_id': message_obj.seq,
+                    'username': message_obj.author,
+                })
+            await self.broadcast([message_obj], message_obj.author)
+            return
+
+        if is_room(message_obj.to_username):
+            room_obj = Message(
+                message_obj.author,
+                f'[{message_obj.to_username}] {message_obj.text}',
+                timestamp_us=message_obj.timestamp_us)
+            room_obj.seq = message_obj.seq
+            await self.broadcast(
+                [room_obj], message_obj.author, message_obj.to_username)
+            return
+
+        private_obj = Message(
+            message_obj.author, f'[private] {message_obj.text}',
+            timestamp_us=message_obj.timestamp_us)
+        private_obj.seq = message_obj.seq
+        await self.fan_out(
+            self.rooms.devices(message_obj.to_username), [private_obj])
+
+    async def client_connected(
+            self, reader: StreamReader, writer: StreamWriter):
+
+        # Согласуем протокол и принимаем от клиента стартовое сообщение
+        # с именем пользователя
+        try:
+            codec, intro = await self.handshake(reader, writer)
+        except (
+            asyncio.IncompleteReadError, ProtocolError, ValueError, IndexError
+        ) as error:
+            logger.error(f'Не удалось подключить клиента: {error}')
+            writer.close()
+            return
+
+        connection = Connection(
+            writer,
+            settings.SERVER.SEND_QUEUE_SIZE,
+            settings.SERVER.SLOW_CONSUMER_POLICY,
+            codec,
+        )
+        await self.open_session(connection, intro.author, intro.seq)
 
         try:
             while True:
-                message_bytes = await reader.readline()
-                if not message_bytes:
+                messages = await codec.read(reader)
+                if messages is None:
                     break
+                for message_obj in messages:
+                    await self.handle_message(connection, message_obj)
 
-                message_str = message_bytes.decode().strip()
-                message_obj = message_str_to_object(message_str)
-
-                if message_obj.text.startswith('/stop'):
-                    await self.stop()
-
-                if message_obj.text.startswith('/delay'):
-                    """
-                    Отправить сообщение c заданной в секундах задержкой.
-                    """
-                    # Парсим текст сообщения и записываем данные в Message
-                    [_, delay, text] = message_obj.text.split(maxsplit=2)
-                    message_obj.send_after = int(delay)
-                    message_obj.text = text
-                    self.message_to_send.append(message_obj)
-
-                elif message_obj.text.startswith('/clear_unsent'):
-                    """
-                    Стереть из списка все неотправленные сообщения.
-                    """
-                    self.message_to_send.clear()
-
-                elif message_obj.text.startswith('/private'):
-                    """
-                    Отрпавить личное сообщение указанному пользователю
-                    или вывести сообщение об ошибке.
-                    """
-                    # Парсим текст сообщения и записываем данные в Message
-                    [_, username, text] = message_obj.text.split(maxsplit=2)
-                    message_obj.to_username = username
-                    message_obj.text = text
-                    self.message_store.append(message_obj)
-
-                    await self.send_private_message(
-                        text, username, message_obj.author)
-                else:
-                    # Обновляем лимит сообщений раз в час
-                    if (datetime.now() - connected_at).seconds > 3600:
-                        msg_counter = settings.LIMIT_MESSAGES_CNT
-                        connected_at = datetime.now()
-
-                    msg_counter -= 1
-                    if msg_counter < 0:
-                        # Посылаем пользователю информацию о превышении
-                        # лимита сообщений в общем чате
-                        message_obj = Message(
-                            '!', 'Вы исчерпали лимит сообщений в общем чате !',
-                            sep='')
-                        message_bytes = message_object_to_str(
-                            message_obj).encode()
-                        writer.write(message_bytes)
-                    else:
-                        self.message_store.append(message_obj)
-                        print(message_obj)
-
-                        await self.send_all_except_me(
-                            message_obj.text, message_obj.author)
-
+        except ProtocolError as error:
+            logger.error(
+                f'Клиент {connection.username} нарушил протокол: {error}',
+                extra={'connection_id': connection.id})
         except asyncio.CancelledError as error:
             logger.error(f'Во время работы возникла ошибка: {error}')
         finally:
-            # Сохраняем дату выхода пользователя из чата
-            self.clients[message_obj.author] = datetime.now()
-            # Информируем клиентов о выходе пользователя из чата
-            message_str = f'== {message_obj.author} вышел из чата =='
-            await self.send_all_except_me(message_str, message_obj.author)
+            await self.close_session(connection)
 
-            logger.info(message_str)
-            writer.close()
+    async def open_session(
+            self, connection: BaseConnection, username: str,
+            resume_seq: int = 0) -> None:
+        """
+        Регистрирует подключение пользователя и посылает ему стартовые
+        или непрочитанные сообщения. Клиент может сам указать номер
+        последнего полученного сообщения (resume_seq) в стартовом
+        сообщении, иначе используется сохраненный сервером.
 
-    async def listen(self):
-        self.server = await asyncio.start_server(
-            self.client_connected, self.host, self.port
-        )
-        logger.info(f'Запущен сервер http://{self.host}:{self.port}/')
+        У пользователя может быть несколько подключений (устройств).
+        Новое устройство, подключившееся к уже открытой сессии,
+        получает стартовые сообщения, а не повтор прочитанных.
+        """
+        connection.username = username
+
+        # Смотрим не подключался ли пользователь ранее
+        cursor = self.shared_cursor(username, resume_seq)
+        new_device = not resume_seq and bool(self.rooms.devices(username))
+        self.rooms.connect(connection)
+        await self.bus.publish({'type': 'join', 'username': username})
 
-        async with self.server:
-            await self.server.serve_forever()
+        if cursor is None or new_device:
+            connection.sent_seq = self.message_store.last_seq
+            await self.send_start_messages(username, connection)
+            await self.send_last_messages(connection)
+        if cursor is None:
+            new_client_message = f'== {username} вошел в чат =='
+            logger.info(new_client_message, extra={
+                'category': 'presence', 'connection_id': connection.id,
+                'username': username,
+            })
+            await self.send_all_except_me(new_client_message, username)
+        elif not new_device:
+            await self.send_unread_messages(connection, cursor)
 
-    async def send_with_delay(self):
+    def shared_cursor(
+            self, username: str, resume_seq: int = 0) -> Optional[int]:
+        """
+        Возвращает общий для всех устройств пользователя номер
+        последнего полученного сообщения: сообщение, прочитанное
+        на одном устройстве, не отправляется повторно на другое.
+        None - пользователь еще не подключался.
         """
-        Отправляет сообщения из списка на отправку при наступлении времени.
+        cursors = [
+            connection.cursor for connection in self.rooms.devices(username)]
+        if username in self.cursors:
+            cursors.append(self.cursors[username])
+        if resume_seq:
+            cursors.append(resume_seq)
+        return max(cursors, default=None)
+
+    async def close_session(self, connection: BaseConnection) -> None:
         """
-        while True:
-            for message_obj in self.message_to_send:
-                if (
-                    message_obj.datetime
-                    + timedelta(seconds=int(message_obj.send_after))
-                    < datetime.now()
-                ):
+        Отмечает выход пользователя из чата и закрывает подключение.
+        """
+        username = connection.username
+        # Сохраняем дату выхода пользователя из чата и номер последнего
+        # полученного им сообщения
+        exit_datetime = datetime.now()
+        self.rooms.disconnect(connection)
+        upload = self.uploads.pop(connection, None)
+        if upload is not None:
+            upload.abort()
+        self.last_seen[username] = exit_datetime
+        cursor = max(self.cursors.get(username, 0), connection.cursor)
+        self.cursors[username] = cursor
+        await self.bus.publish({
+            'type': 'leave', 'username': username,
+            'at': exit_datetime.timestamp(), 'cursor': cursor,
+        })
+        # Информируем клиентов о выходе пользователя из чата, когда
+        # закрыто его последнее устройство
+        message_str = f'== {username} вышел из чата =='
+        if self.online[username] <= 1:
+            await self.send_all_except_me(message_str, username)
+
+        logger.info(message_str, extra={
+            'category': 'presence', 'connection_id': connection.id,
+            'username': username,
+        })
+        await connection.close()
+
+    async def run_bus(self) -> None:
+        """
+        Обрабатывает события от брокера. Без связи с брокером рабочий
+        процесс не получает сообщений остальных, поэтому сервер
+        останавливается.
+        """
+        try:
+            await self.bus.run(self.apply_event)
+        except ConnectionError as error:
+            logger.error(f'{error}, сервер останавливается.')
+            await self.stop()
+
+    async def listen(self, reuse_port: bool = False):
+        server: asyncio.AbstractServer
+        if settings.SERVER.TRANSPORT == 'protocol':
+            loop = asyncio.get_running_loop()
+            server = await loop.create_server(
+                lambda: ChatProtocol(self), self.host, self.port,
+                reuse_port=reuse_port,
+            )
+        else:
+            server = await asyncio.start_server(
+                self.client_connected, self.host, self.port,
+                reuse_port=reuse_port,
+            )
+        self.server = server
+        logger.info(f'Запущен сервер http://{self.host}:{self.port}/')
 
-                    # Переносим сообщение из списка на отправку
-                    # в список отправленных и отправляем в общий чат
-                    self.message_to_send.remove(message_obj)
-                    self.message_store.append(message_obj)
-                    print(message_obj)
-                    await self.send_all_except_me(
-                        message_obj.text, message_obj.author)
-            await asyncio.sleep(1)
+        # Запускаем обработку событий от брокера
+        bus_task = asyncio.create_task(self.run_bus())
+        self.background_tasks.add(bus_task)
+        bus_task.add_done_callback(self.background_tasks.discard)
+
+        # Запускаем замер задержки цикла событий и порт метрик
+        lag_task = asyncio.create_task(
+            metrics.probe_loop_lag(settings.LOOP_LAG_INTERVAL_SEC))
+        self.background_tasks.add(lag_task)
+        lag_task.add_done_callback(self.background_tasks.discard)
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+        if self.http_api is not None:
+            await self.http_api.start()
+
+        # Запускаем фоновую очистку устаревших сообщений
+        eviction_task = asyncio.create_task(
+            self.message_store.run_eviction(settings.EVICTION_INTERVAL_SEC))
+        self.background_tasks.add(eviction_task)
+        eviction_task.add_done_callback(self.background_tasks.discard)
+
+        # Запускаем удаление файлов, переживших сообщения о них
+        files_task = asyncio.create_task(self.files.run_compaction(
+            settings.TTL_MESSAGES_SEC.total_seconds(),
+            settings.SERVER.LOG_COMPACTION_INTERVAL_SEC))
+        self.background_tasks.add(files_task)
+        files_task.add_done_callback(self.background_tasks.discard)
+
+        # Запускаем периодическое удаление устаревших сегментов журнала
+        # и лимитов неактивных пользователей
+        if isinstance(self.bus, LocalBus):
+            broker = self.bus.broker
+            for coroutine in (
+                broker.run_compaction(
+                    settings.SERVER.LOG_COMPACTION_INTERVAL_SEC),
+                broker.run_limiter_sweep(settings.LIMIT_SWEEP_INTERVAL_SEC),
+            ):
+                task = asyncio.create_task(coroutine)
+                self.background_tasks.add(task)
+                task.add_done_callback(self.background_tasks.discard)
+
+        async with server:
+            await server.serve_forever()
 
     async def stop(self):
         """
         Штатно останавливает сервер и сохраняет историю сообщений.
         """
-        self.server.close()
-        await self.server.wait_closed()
-        self.backup_chat_history(settings.SERVER.BACKUP_FILE)
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        if self.http_api is not None:
+            self.http_api.close()
+        await self.bus.close()
         logger.info('Сервер штатно остановлен.')
 
 
+async def worker_main(index: int) -> None:
+    """
+    Рабочий процесс: принимает клиентов на общем порту и обменивается
+    событиями с остальными процессами через брокер.
+    """
+    try:
+        bus = SocketBus(settings.SERVER.BROKER_SOCKET)
+        metrics_port = settings.SERVER.METRICS_PORT
+        http_port = settings.SERVER.HTTP_PORT
+        server = Server(
+            bus=bus, metrics_port=metrics_port and metrics_port + index,
+            http_port=http_port and http_port + index)
+        await bus.connect()
+        await server.listen(reuse_port=True)
+    except asyncio.CancelledError:
+        # Остановка по команде /stop или при потере связи с брокером
+        logger.info('Рабочий процесс остановлен.')
+
+
+def run_worker(index: int) -> None:
+    """
+    Точка входа рабочего процесса.
+    """
+    listener = setup_logging()
+    try:
+        asyncio.run(worker_main(index))
+    except KeyboardInterrupt:
+        logger.info(f'Рабочий процесс {index} завершил свою работу.')
+    finally:
+        listener.stop()
+
+
+async def run_broker(workers: int) -> None:
+    """
+    Запускает брокер и рабочие процессы (режим SERVER.WORKERS > 1).
+    """
+    ttl_sec = settings.TTL_MESSAGES_SEC.total_seconds()
+    message_log = MessageLog(
+        settings.SERVER.LOG_DIR, settings.SERVER.LOG_SEGMENT_SIZE)
+    broker = ChatBroker(message_log)
+    broker.restore(ttl_sec)
+    message_log.open(ttl_sec)
+
+    logger.info(f'Запускаем рабочих процессов: {workers}.')
+    await BrokerServer(broker, settings.SERVER.BROKER_SOCKET, workers).serve(
+        run_worker, settings.SERVER.LOG_COMPACTION_INTERVAL_SEC)
+    logger.info('Сервер остановлен по требованию клиента.')
+
+
 async def main() -> None:
+    if settings.SERVER.WORKERS > 1:
+        await run_broker(settings.SERVER.WORKERS)
+        return
     try:
         server = Server()
-        await asyncio.gather(server.listen(), server.send_with_delay())
+        await server.listen()
     except asyncio.CancelledError:
         logger.info('Сервер остановлен по требованию клиента.')
 
 
 if __name__ == '__main__':
+    listener = setup_logging()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
         logger.info('Сервер нештатно завершил свою работу.')
+    finally:
+        listener.stop()
@@ -1,4 +1,5 @@
 from datetime import timedelta
+from typing import Literal
 
 from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings
@@ -7,16 +8,103 @@ from pydantic_settings import BaseSettings
 class ServerSettings(BaseModel):
     HOST: str = Field(default='127.0.0.1')
     PORT: int = Field(default=8000)
-    # Имя файла для сохранения истории общего чата
-    BACKUP_FILE: str = Field(default='messages.json')
+    # Каталог журнала для сохранения истории чата
+    LOG_DIR: str = Field(default='messages')
+    # Размер сегмента журнала в байтах
+    LOG_SEGMENT_SIZE: int = Field(default=4 * 1024 * 1024)
+    # Период удаления устаревших сегментов журнала в секундах
+    LOG_COMPACTION_INTERVAL_SEC: float = Field(default=60.0)
+    # Транспорт сервера: streams - StreamReader/StreamWriter,
+    # protocol - asyncio.BufferedProtocol с разбором из общего буфера
+    TRANSPORT: Literal['streams', 'protocol'] = Field(default='streams')
+    # Кол-во рабочих процессов на общем порту (SO_REUSEPORT);
+    # при значении больше 1 процессы связываются через локальный брокер
+    WORKERS: int = Field(default=1)
+    # Адрес и порт для сбора метрик в формате Prometheus (0 - отключено);
+    # рабочие процессы занимают порты METRICS_PORT + номер процесса
+    METRICS_HOST: str = Field(default='127.0.0.1')
+    METRICS_PORT: int = Field(default=8001)
+    # Порт HTTP API (0 - отключено); рабочие процессы занимают порты
+    # HTTP_PORT + номер процесса, так как сессии HTTP живут в процессе
+    HTTP_PORT: int = Field(default=8080)
+    # Ограничения размера заголовков и тела HTTP-запроса в байтах
+    HTTP_MAX_HEADER_SIZE: int = Field(default=8 * 1024)
+    HTTP_MAX_BODY_SIZE: int = Field(default=64 * 1024)
+    # Время ожидания следующего запроса в постоянном соединении, сек.
+    HTTP_KEEP_ALIVE_SEC: float = Field(default=15.0)
+    # Максимальное время ожидания сообщений запросом long-poll, сек.
+    HTTP_POLL_TIMEOUT_SEC: float = Field(default=30.0)
+    # Сессия HTTP закрывается, если клиент не обращался к ней
+    # столько секунд
+    HTTP_SESSION_TIMEOUT_SEC: float = Field(default=60.0)
+    # Каталог файлов, загруженных пользователями
+    FILES_DIR: str = Field(default='files')
+    # Максимальный размер загружаемого файла в байтах
+    MAX_FILE_SIZE: int = Field(default=5 * 1024 * 1024)
+    # Unix domain socket брокера для связи рабочих процессов
+    BROKER_SOCKET: str = Field(default='chat-broker.sock')
+    # Максимальный размер кадра бинарного протокола в байтах
+    MAX_FRAME_SIZE: int = Field(default=1024 * 1024)
+    # Сжатие кадров для клиентов, запросивших его в приветствии,
+    # и минимальный размер сжимаемой пачки кадров в байтах
+    COMPRESSION: bool = Field(default=True)
+    COMPRESSION_THRESHOLD: int = Field(default=512)
+    # Уровень сжатия zlib (1 - быстрее, 9 - плотнее)
+    COMPRESSION_LEVEL: int = Field(default=6)
+    # Размер очереди исходящих сообщений одного клиента
+    SEND_QUEUE_SIZE: int = Field(default=1024)
+    # Поведение при переполнении очереди медленного клиента:
+    # drop_oldest - выбросить самое старое сообщение из очереди,
+    # disconnect - отключить клиента,
+    # block - ждать освобождения места в очереди
+    SLOW_CONSUMER_POLICY: Literal['drop_oldest', 'disconnect', 'block'] = (
+        Field(default='drop_oldest')
+    )
+
+
+class LogSettings(BaseModel):
+    LEVEL: str = Field(default='INFO')
+    # Формат вывода: text - строки для человека, json - по записи
+    # JSON в строке с идентификаторами подключения и сообщения
+    FORMAT: Literal['text', 'json'] = Field(default='text')
+    # Размер очереди записей, ожидающих вывода отдельным потоком
+    QUEUE_SIZE: int = Field(default=10_000)
+    # Поведение при переполнении очереди: drop_new - отбросить новую
+    # запись, drop_oldest - отбросить самую старую
+    OVERFLOW_POLICY: Literal['drop_new', 'drop_oldest'] = Field(
+        default='drop_new')
+    # Доля выводимых записей по категориям (chat - эхо сообщений
+    # общего чата, presence - входы и выходы пользователей)
+    SAMPLING: dict[str, float] = Field(default={'chat': 1.0})
 
 
 class Settings(BaseSettings):
     # Параметры сервера
     SERVER: ServerSettings = ServerSettings()
+    # Параметры лога
+    LOG: LogSettings = LogSettings()
     # Кол-во последних выводимых сообщений (при подключении в общий чат)
     LAST_MESSAGES_CNT: int = Field(default=3)
+    # Кол-во сообщений в одной странице догрузки непрочитанных сообщений
+    CATCH_UP_PAGE_SIZE: int = Field(default=256)
+    # Кол-во сообщений в одной странице результатов поиска /search
+    SEARCH_PAGE_SIZE: int = Field(default=20)
     # Лимит отправляемых одним пользоватеелм сообщений в час (в общий чат)
     LIMIT_MESSAGES_CNT: int = Field(default=5)
+    # Лимиты личных и отложенных сообщений одного пользователя в час
+    LIMIT_PRIVATE_CNT: int = Field(default=20)
+    LIMIT_DELAY_CNT: int = Field(default=10)
+    # Максимальная задержка отложенного сообщения в секундах
+    MAX_DELAY_SEC: int = Field(default=24 * 3600)
+    # Период, за который лимиты восстанавливаются полностью, в секундах
+    LIMIT_PERIOD_SEC: float = Field(default=3600.0)
+    # Период фоновой очистки лимитов неактивных пользователей в секундах
+    LIMIT_SWEEP_INTERVAL_SEC: float = Field(default=60.0)
     # Время жизни сообщения в секундах
     TTL_MESSAGES_SEC: timedelta = Field(default=timedelta(seconds=3600))
+    # Максимальное кол-во хранимых в памяти сообщений общего чата
+    PUBLIC_HISTORY_SIZE: int = Field(default=100_000)
+    # Период фоновой очистки устаревших сообщений в секундах
+    EVICTION_INTERVAL_SEC: float = Field(default=1.0)
+    # Период замера задержки цикла событий в секундах
+    LOOP_LAG_INTERVAL_SEC: float = Field(default=0.5)
@@ -0,0 +1,253 @@
+import asyncio
+import heapq
+import time
+from bisect import bisect_left, bisect_right
+from collections import deque
+from datetime import timedelta
+from itertools import islice
+from typing import TYPE_CHECKING, Iterable, Iterator, Optional
+
+from search import SearchIndex, SearchQuery
+
+if TYPE_CHECKING:
+    from message import Message
+
+# Кол-во сообщений, вытесняемых за один шаг фоновой очистки
+EVICTION_BATCH = 1000
+
+
+class Timeline:
+    """
+    Лента сообщений, упорядоченная по порядковому номеру (seq).
+
+    Сообщения лежат в списке со сдвигаемым началом, поэтому вытеснение
+    с головы стоит O(1), а поиск по seq - O(log n).
+    При заданном maxlen лента работает как кольцевой буфер.
+    """
+
+    def __init__(self, maxlen: Optional[int] = None):
+        self.maxlen = maxlen
+        self._messages: list['Message'] = []
+        self._seqs: list[int] = []
+        self._head: int = 0
+
+    def __len__(self) -> int:
+        return len(self._messages) - self._head
+
+    def __iter__(self) -> Iterator['Message']:
+        return iter(self._messages[self._head:])
+
+    def append(self, message: 'Message') -> Optional['Message']:
+        """
+        Добавляет сообщение в конец ленты и возвращает сообщение,
+        вытесненное из-за переполнения (если такое есть).
+        """
+        self._messages.append(message)
+        self._seqs.append(message.seq)
+        if self.maxlen is not None and len(self) > self.maxlen:
+            evicted = self._messages[self._head]
+            self._head += 1
+            self._shrink()
+            return evicted
+        return None
+
+    def evict_upto(self, seq: int) -> list['Message']:
+        """
+        Вытесняет из головы ленты сообщения с номером не больше seq
+        и возвращает их.
+        """
+        index = bisect_right(self._seqs, seq, lo=self._head)
+        evicted = self._messages[self._head:index]
+        self._head = index
+        self._shrink()
+        return evicted
+
+    def last(self, count: int) -> list['Message']:
+        """
+        Возвращает последние count сообщений.
+        """
+        return self._messages[max(self._head, len(self._messages) - count):]
+
+    def after_seq(self, seq: int, limit: int) -> list['Message']:
+        """
+        Возвращает не более limit сообщений с номером больше seq.
+        """
+        index = bisect_right(self._seqs, seq, lo=self._head)
+        return self._messages[index:index + limit]
+
+    def resolve(self, seqs: Iterable[int]) -> Iterator['Message']:
+        """
+        Перебирает сообщения ленты по их номерам.
+        """
+        for seq in seqs:
+            yield self._messages[bisect_left(self._seqs, seq, lo=self._head)]
+
+    def _shrink(self) -> None:
+        """
+        Физически удаляет вытесненные сообщения, когда они занимают
+        больше половины ленты.
+        """
+        if self._head > 1024 and self._head * 2 > len(self._messages):
+            del self._messages[:self._head]
+            del self._seqs[:self._head]
+            self._head = 0
+
+
+class MessageStore:
+    """
+    Хранилище сообщений чата в памяти.
+
+    Сообщения общего чата лежат в кольцевом буфере, личные - в отдельных
+    лентах получателей (получателем может быть и комната). Каждое
+    сообщение получает возрастающий номер seq.
+    Устаревшие (старше ttl) сообщения вытесняются в фоне по очереди
+    в порядке поступления. Все хранимые сообщения проиндексированы
+    для поиска.
+    """
+
+    def __init__(self, ttl: timedelta, public_maxlen: Optional[int] = None):
+        self.ttl_sec: float = ttl.total_seconds()
+        self.public = Timeline(public_maxlen)
+        self.private: dict[str, Timeline] = {}
+        self.last_seq: int = 0
+        self._last_timestamp: float = 0.0
+        self._expiry: deque[tuple[float, int, str]] = deque()
+        self._count: int = 0
+        self.index = SearchIndex()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator['Message']:
+        """
+        Перебирает все сообщения в порядке поступления.
+        """
+        timelines = [self.public, *self.private.values()]
+        return heapq.merge(*timelines, key=lambda message: message.seq)
+
+    def add(self, message: 'Message') -> int:
+        """
+        Сохраняет сообщение и возвращает его номер.
+        """
+        # Восстановленные из журнала сообщения сохраняют свой номер
+        if message.seq > self.last_seq:
+            self.last_seq = message.seq
+        else:
+            self.last_seq += 1
+            message.seq = self.last_seq
+
+        # Время в очереди вытеснения не убывает
+        timestamp = max(message.timestamp, self._last_timestamp)
+        self._last_timestamp = timestamp
+
+        if message.to_username:
+            timeline = self.private.get(message.to_username)
+            if timeline is None:
+                timeline = self.private[message.to_username] = Timeline()
+        else:
+            timeline = self.public
+
+        self.index.add(message, timestamp)
+        self._count += 1
+        evicted = timeline.append(message)
+        if evicted is not None:
+            self._count -= 1
+            self.index.remove(evicted)
+        self._expiry.append((timestamp, message.seq, message.to_username))
+        return message.seq
+
+    def drop(self, recipient: str) -> int:
+        """
+        Удаляет ленту получателя recipient (например, закрытой комнаты)
+        вместе с ее индексом. Возвращает кол-во удаленных сообщений.
+        """
+        timeline = self.private.pop(recipient, None)
+        if timeline is None:
+            return 0
+        self._count -= len(timeline)
+        self.index.drop_scope(recipient)
+        return len(timeline)
+
+    def last_public(self, count: int) -> list['Message']:
+        """
+        Возвращает последние count сообщений общего чата.
+        """
+        return self.public.last(count)
+
+    def after_seq(
+            self, recipients: Iterable[str], seq: int,
+            limit: int) -> list['Message']:
+        """
+        Возвращает страницу из не более limit сообщений общего чата
+        и лент получателей recipients (пользователя и его комнат)
+        с номером больше seq в порядке возрастания номеров.
+        """
+        pages = [self.public.after_seq(seq, limit)]
+        for recipient in recipients:
+            timeline = self.private.get(recipient)
+            if timeline is not None:
+                pages.append(timeline.after_seq(seq, limit))
+        if len(pages) == 1:
+            return pages[0]
+        return list(islice(heapq.merge(
+            *pages, key=lambda message: message.seq), limit))
+
+    def search(
+            self, scopes: Iterable[str], query: SearchQuery,
+            limit: int) -> list['Message']:
+        """
+        Возвращает страницу из не более limit сообщений лент scopes
+        (видимых пользователю), подходящих под запрос, от новых
+        к старым.
+        """
+        lower, upper = self.index.seq_range(query.since, query.until)
+        if query.before is not None:
+            upper = min(upper, query.before)
+        found = []
+        for scope in scopes:
+            timeline = self.private.get(scope) if scope else self.public
+            if timeline is not None:
+                found.append(timeline.resolve(self.index.search(
+                    scope, query.terms, lower, upper)))
+        return list(islice(heapq.merge(
+            *found, key=lambda message: message.seq, reverse=True), limit))
+
+    def evict_expired(
+            self, now: Optional[float] = None,
+            limit: Optional[int] = None) -> int:
+        """
+        Вытесняет не более limit сообщений старше ttl.
+        Возвращает кол-во просмотренных записей очереди вытеснения.
+        """
+        deadline = (time.time() if now is None else now) - self.ttl_sec
+        processed = 0
+        while self._expiry and self._expiry[0][0] < deadline:
+            if limit is not None and processed >= limit:
+                break
+            _, seq, to_username = self._expiry.popleft()
+            processed += 1
+            self.index.expire(seq)
+            if not to_username:
+                self._evict(self.public, seq)
+                continue
+            timeline = self.private.get(to_username)
+            if timeline is not None:
+                self._evict(timeline, seq)
+                if not timeline:
+                    del self.private[to_username]
+        return processed
+
+    def _evict(self, timeline: Timeline, seq: int) -> None:
+        for message in timeline.evict_upto(seq):
+            self._count -= 1
+            self.index.remove(message)
+
+    async def run_eviction(self, interval: float) -> None:
+        """
+        Периодически вытесняет устаревшие сообщения небольшими порциями,
+        не блокируя цикл событий.
+        """
+        while True:
+            while self.evict_expired(limit=EVICTION_BATCH) == EVICTION_BATCH:
+                await asyncio.sleep(0)
+            await asyncio.sleep(interval)
@@ -0,0 +1,160 @@
+import asyncio
+import json
+
+import pytest
+
+from bus import (
+    EVENT_HEADER, BrokerServer, ChatBroker, SocketBus, dispatch, encode_event,
+)
+import wal
+from wal import MessageLog
+
+
+def test_failed_event_does_not_stop_dispatch():
+    handled = []
+
+    async def handler(event: dict) -> None:
+        if event['type'] == 'bad':
+            raise ValueError(event)
+        handled.append(event['type'])
+
+    async def run():
+        for event_type in ('message', 'bad', 'notice'):
+            await dispatch(handler, {'type': event_type})
+
+    asyncio.run(run())
+    assert handled == ['message', 'notice']
+
+
+class FakeWriter:
+    def __init__(self):
+        self.events = []
+
+    def write(self, data: bytes) -> None:
+        self.events.append(json.loads(data[EVENT_HEADER.size:]))
+
+    def is_closing(self) -> bool:
+        return False
+
+    def close(self) -> None:
+        pass
+
+
+def test_broker_survives_failed_event(tmp_path):
+    message_log = MessageLog(str(tmp_path), 1 << 20)
+    message_log.open(3600)
+    broker_server = BrokerServer(ChatBroker(message_log), '', workers=1)
+    writer = FakeWriter()
+
+    async def run():
+        reader = asyncio.StreamReader()
+        # У события delay нет сообщения: брокер пропускает его
+        reader.feed_data(
+            encode_event({'type': 'delay'})
+            + encode_event({'type': 'clear', 'author': 'alice'}))
+        reader.feed_eof()
+        await broker_server.worker_connected(reader, writer)
+
+    asyncio.run(run())
+    message_log.close()
+    assert [event['type'] for event in writer.events] == ['ready', 'notice']
+
+
+def test_socket_bus_raises_on_lost_broker():
+    async def handler(event: dict) -> None:
+        pass
+
+    async def run():
+        bus = SocketBus('')
+        bus.reader = asyncio.StreamReader()
+        bus.reader.feed_eof()
+        await bus.run(handler)
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(run())
+
+
+def make_record(text: str) -> dict:
+    return {
+        'seq': 0, 'author': 'alice', 'text': text, 'datetime': 1.0,
+        'sep': ':', 'to_username': '',
+    }
+
+
+def test_message_is_sent_after_commit(tmp_path):
+    message_log = MessageLog(str(tmp_path), 1 << 20)
+    message_log.open(3600)
+    broker = ChatBroker(message_log)
+    events = []
+
+    def sink(event: dict) -> None:
+        # К моменту рассылки сообщение уже на диске
+        if event['type'] == 'message':
+            assert message_log.written >= event['message'].seq
+        events.append(event)
+
+    broker.sink = sink
+
+    async def run():
+        broker.publish_message(make_record('first'))
+        broker.notify('bob', 'after first')
+        # Уведомление не обгоняет сообщение, ждущее записи
+        assert events == []
+        while len(events) < 2:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    message_log.close()
+    assert [event['type'] for event in events] == ['message', 'notice']
+    assert [record['text'] for record in message_log.replay(3600)] == [
+        'first']
+
+
+def test_failed_commit_is_not_sent(tmp_path, monkeypatch):
+    def fsync(fd: int) -> None:
+        raise OSError(28, 'No space left on device')
+
+    monkeypatch.setattr(wal.os, 'fsync', fsync)
+    message_log = MessageLog(str(tmp_path), 1 << 20)
+    message_log.open(3600)
+    broker = ChatBroker(message_log)
+    events = []
+    broker.sink = events.append
+
+    async def run():
+        broker.publish_message(make_record('lost'))
+        while not events:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    message_log.close()
+    [event] = events
+    assert event['type'] == 'notice' and event['to'] == 'alice'
+
+
+def test_rooms_survive_log_compaction(tmp_path):
+    message_log = MessageLog(str(tmp_path / 'log'), 1 << 20)
+    message_log.open(3600)
+    broker = ChatBroker(message_log)
+
+    async def run():
+        broker.handle({
+            'type': 'room', 'action': 'create', 'username': 'alice',
+            'room': '#dev', 'token': 'secret',
+        })
+        broker.save_rooms()
+
+    asyncio.run(run())
+    message_log.close()
+    records = list(message_log.replay(3600))
+    assert [record['type'] for record in records] == ['room', 'rooms']
+
+    # Сегмент с созданием комнаты удален, остался только снимок
+    compacted = MessageLog(str(tmp_path / 'compacted'), 1 << 20)
+    compacted.open(3600)
+    compacted.append(records[-1])
+    compacted.close()
+    restored = ChatBroker(compacted)
+    restored.restore(3600)
+    assert restored.rooms.snapshot() == broker.rooms.snapshot()
+    assert restored.rooms.user_rooms('alice') == {'#dev'}
@@ -0,0 +1,121 @@
+import asyncio
+import hashlib
+import os
+import time
+
+import pytest
+
+from connection import Connection
+from files import PART_SUFFIX, FileStore, FileTransferError
+
+
+def make_store(tmp_path, max_size: int = 1024) -> FileStore:
+    store = FileStore(str(tmp_path / 'files'), max_size)
+    store.open()
+    return store
+
+
+def upload(store: FileStore, data: bytes, parts: int = 3) -> str:
+    async def run() -> str:
+        transfer = store.begin('dir/report.txt', len(data), 'bob')
+        step = len(data) // parts + 1
+        for offset in range(0, len(data), step):
+            await store.write(transfer, data[offset:offset + step])
+        return await store.finish(transfer, hashlib.sha256(data).digest())
+
+    return asyncio.run(run())
+
+
+def test_file_is_stored_by_content(tmp_path):
+    store = make_store(tmp_path)
+    data = b'hello file' * 10
+    file_id = upload(store, data)
+    assert file_id == hashlib.sha256(data).hexdigest()
+    path = store.path(file_id)
+    assert path is not None
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+    # Повторная загрузка не создает копию
+    assert upload(store, data, parts=1) == file_id
+    assert os.listdir(store.directory) == [file_id]
+
+
+def test_corrupted_upload_is_removed(tmp_path):
+    store = make_store(tmp_path)
+
+    async def run() -> None:
+        transfer = store.begin('report.txt', 4)
+        await store.write(transfer, b'data')
+        await store.finish(transfer, hashlib.sha256(b'other').digest())
+
+    with pytest.raises(FileTransferError):
+        asyncio.run(run())
+    assert os.listdir(store.directory) == []
+
+
+def test_upload_size_is_enforced(tmp_path):
+    store = make_store(tmp_path, max_size=8)
+    with pytest.raises(FileTransferError):
+        store.begin('big.bin', 9)
+
+    async def run() -> None:
+        transfer = store.begin('small.bin', 4)
+        await store.write(transfer, b'too much')
+
+    with pytest.raises(FileTransferError):
+        asyncio.run(run())
+    assert os.listdir(store.directory) == []
+
+
+def test_path_rejects_foreign_names(tmp_path):
+    store = make_store(tmp_path)
+    assert store.path('../' + 'a' * 61) is None
+    assert store.path('A' * 64) is None
+    assert store.path('a' * 64) is None
+
+
+def test_compact_removes_expired_files(tmp_path):
+    store = make_store(tmp_path)
+    old_id = upload(store, b'old')
+    new_id = upload(store, b'new')
+    part = os.path.join(store.directory, 'stale' + PART_SUFFIX)
+    open(part, 'wb').close()
+    past = time.time() - 120
+    for path in (store.path(old_id), part):
+        os.utime(path, (past, past))
+
+    assert store.compact(60) == 2
+    assert os.listdir(store.directory) == [new_id]
+
+
+def test_file_is_sent_in_order_with_messages(tmp_path):
+    content = os.urandom(256 * 1024)
+    path = tmp_path / 'payload.bin'
+    path.write_bytes(content)
+
+    async def run() -> tuple[bytes, bool]:
+        opened = []
+
+        async def handle(reader, writer) -> None:
+            connection = Connection(writer, 16)
+            file = open(path, 'rb')
+            opened.append(file)
+            await connection.send(b'before|')
+            await connection.send_file(b'header|', file)
+            await connection.send(b'|after')
+            await connection.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        data = await reader.read(-1)
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return data, opened[0].closed
+
+    data, closed = asyncio.run(run())
+    assert data == b'before|header|' + content + b'|after'
+    # Файл закрывается после отправки
+    assert closed
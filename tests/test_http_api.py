@@ -0,0 +1,124 @@
+import asyncio
+import re
+from typing import Callable, Optional
+
+from http_api import HttpApi, HttpConnection
+from message import Message
+from protocol import EventStreamCodec, JsonCodec
+
+SESSION = 'token'
+
+
+class FakeWriter:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data: bytes) -> None:
+        self.data += data
+
+    def writelines(self, chunks: list[bytes]) -> None:
+        for chunk in chunks:
+            self.data += chunk
+
+    async def drain(self) -> None:
+        pass
+
+
+def serve(
+        data: bytes, codec_factory: Callable = JsonCodec,
+        prepare: Optional[Callable[[HttpConnection], None]] = None,
+        limit: int = 8 * 1024) -> tuple[bytes, HttpConnection]:
+    """
+    Выполняет запросы из data на одном соединении и возвращает ответы
+    и сессию SESSION.
+    """
+    async def run():
+        api = HttpApi(None, '127.0.0.1', 0)
+        connection = HttpConnection(
+            SESSION, 16, 'drop_oldest', codec_factory())
+        api.sessions[SESSION] = connection
+        if prepare is not None:
+            prepare(connection)
+        reader = asyncio.StreamReader(limit=limit)
+        reader.feed_data(data)
+        reader.feed_eof()
+        writer = FakeWriter()
+        while await api.handle_request(reader, writer):
+            pass
+        return bytes(writer.data), connection
+
+    return asyncio.run(run())
+
+
+def get(path: str, headers: str = '') -> bytes:
+    return f'GET {path} HTTP/1.1\r\nHost: chat\r\n{headers}\r\n'.encode()
+
+
+def statuses(data: bytes) -> list[int]:
+    return [int(code) for code in re.findall(rb'HTTP/1\.1 (\d{3}) ', data)]
+
+
+def test_poll_rejects_bad_timeout():
+    requests = b''.join(
+        get(f'/messages?session={SESSION}&timeout={timeout}')
+        for timeout in ('nan', 'inf', '-1', 'x', '0'))
+    data, _ = serve(requests)
+    assert statuses(data) == [400, 400, 400, 400, 200]
+
+
+def poll(headers: str = '') -> bytes:
+    return get(f'/messages?session={SESSION}', headers)
+
+
+def test_header_over_limit():
+    padding = 'X-Padding: ' + 'a' * 256 + '\r\n'
+    data, _ = serve(get('/status', padding), limit=64)
+    assert statuses(data) == [431]
+    assert b'Connection: close' in data
+
+
+def test_chunked_body_is_not_implemented():
+    request = (
+        b'POST /send HTTP/1.1\r\nHost: chat\r\n'
+        b'Transfer-Encoding: chunked\r\n\r\n'
+        b'4\r\ntext\r\n0\r\n\r\n')
+    data, _ = serve(request + poll())
+    # Тело не разобрать, поэтому соединение закрывается
+    assert statuses(data) == [501]
+
+
+def test_keep_alive():
+    data, _ = serve(poll() + poll())
+    assert statuses(data) == [200, 200]
+
+    data, _ = serve(poll('Connection: close\r\n') + poll())
+    assert statuses(data) == [200]
+    assert b'Connection: close' in data
+
+    request = f'GET /messages?session={SESSION} HTTP/1.0\r\n\r\n'.encode()
+    data, _ = serve(request + request)
+    # HTTP/1.0 держит соединение только по Connection: keep-alive
+    assert statuses(data) == [200]
+
+
+def test_events_resume_from_last_event_id():
+    message_obj = Message('alice', 'Привет')
+    message_obj.seq = 8
+
+    def prepare(connection):
+        connection.send_nowait(connection.codec.encode([message_obj]))
+        asyncio.get_running_loop().call_later(0.05, connection.abort)
+
+    data, connection = serve(
+        get(f'/events?session={SESSION}', 'Last-Event-ID: 7\r\n') + poll(),
+        codec_factory=EventStreamCodec, prepare=prepare)
+    assert statuses(data) == [200]
+    assert b'Content-Type: text/event-stream' in data
+    assert connection.codec.acked_seq == 7
+    event = b'id: 8\ndata: ' + message_obj.record_bytes + b'\n\n'
+    assert event in data
+
+
+def test_events_need_sse_session():
+    data, _ = serve(get(f'/events?session={SESSION}'))
+    assert statuses(data) == [409]
@@ -0,0 +1,99 @@
+import io
+import json
+import logging
+import threading
+
+import pytest
+
+import logs
+import metrics
+from logs import (DROP_NEW, DROP_OLDEST, BoundedQueueHandler,
+                  BoundedQueueListener)
+
+
+class GatedHandler(logging.Handler):
+    """
+    Собирает тексты записей; первая запись ждет открытия gate,
+    чтобы очередь успела заполниться.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.messages: list[str] = []
+        self.entered = threading.Event()
+        self.gate = threading.Event()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.entered.set()
+        self.gate.wait(5)
+        self.messages.append(record.getMessage())
+
+
+def make_record(text: str) -> logging.LogRecord:
+    return logging.LogRecord(
+        'chat', logging.INFO, __file__, 0, text, None, None)
+
+
+@pytest.fixture
+def root_logger():
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    yield root
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+@pytest.mark.parametrize('policy, kept', [
+    (DROP_NEW, ['0', '1']),
+    (DROP_OLDEST, ['3', '4']),
+])
+def test_overflow_is_counted(policy, kept):
+    handler = BoundedQueueHandler(2, policy)
+    dropped = metrics.log_messages_dropped.value
+    for number in range(5):
+        handler.enqueue(make_record(str(number)))
+
+    assert handler.dropped == 3
+    assert metrics.log_messages_dropped.value == dropped + 3
+    queued = []
+    while not handler.records.empty():
+        queued.append(handler.records.get_nowait().getMessage())
+    assert queued == kept
+
+
+def test_stop_flushes_full_queue():
+    handler = BoundedQueueHandler(2)
+    output = GatedHandler()
+    listener = BoundedQueueListener(handler.records, output)
+    listener.start()
+    handler.enqueue(make_record('0'))
+    assert output.entered.wait(5)
+    # Вывод занят первой записью: две помещаются в очередь,
+    # четвертая отбрасывается
+    for number in range(1, 4):
+        handler.enqueue(make_record(str(number)))
+    assert handler.records.full()
+
+    # Признак остановки ждет места в очереди, а не падает с queue.Full
+    threading.Timer(0.05, output.gate.set).start()
+    listener.stop()
+    assert output.messages == ['0', '1', '2']
+    assert handler.dropped == 1
+
+
+def test_setup_logging_writes_json(monkeypatch, root_logger):
+    monkeypatch.setattr(logs.settings.LOG, 'FORMAT', 'json')
+    monkeypatch.setattr(logs.settings.LOG, 'SAMPLING', {})
+    stream = io.StringIO()
+    listener = logs.setup_logging(stream)
+    logging.getLogger('chat').info(
+        'Привет', extra={'username': 'alice', 'message_id': 7})
+    listener.stop()
+
+    record = json.loads(stream.getvalue())
+    assert record['message'] == 'Привет'
+    assert record['username'] == 'alice'
+    assert record['message_id'] == 7
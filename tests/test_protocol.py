@@ -0,0 +1,210 @@
+import asyncio
+from typing import Optional
+
+import pytest
+
+from message import Message
+from protocol import (
+    FRAME_COMPRESSED, FRAME_FILE_CHUNK, FRAME_HEADER, MAX_BATCH_MESSAGES,
+    MAX_NAME_SIZE, FileFrame, FrameCodec, Incoming, LineCodec, ProtocolError,
+    fits_frame, hello, read_hello,
+)
+
+
+def make_message(
+        seq: int, text: str = 'привет', to: str = '') -> Message:
+    message = Message(
+        'alice', text, to=to, timestamp_us=1_700_000_000_123_456 + seq)
+    message.seq = seq
+    return message
+
+
+def read_all(codec, data: bytes) -> list[Incoming]:
+    """
+    Читает кодеком все сообщения из потока байт data.
+    """
+    async def run() -> list[Incoming]:
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        items: list[Incoming] = []
+        while True:
+            batch: Optional[list] = await codec.read(reader)
+            if batch is None:
+                return items
+            items.extend(batch)
+
+    return asyncio.run(run())
+
+
+def assert_same(decoded: Message, message: Message) -> None:
+    assert decoded.seq == message.seq
+    assert decoded.author == message.author
+    assert decoded.text == message.text
+    assert decoded.sep == message.sep
+    assert decoded.to_username == message.to_username
+    assert decoded.timestamp_us == message.timestamp_us
+
+
+def test_frame_round_trip():
+    messages = [
+        make_message(1),
+        make_message(2, 'личное', to='bob'),
+        make_message(3, 'строка\nс переводом'),
+    ]
+    codec = FrameCodec()
+    decoded = read_all(FrameCodec(), codec.encode(messages))
+    assert len(decoded) == len(messages)
+    for decoded_obj, message in zip(decoded, messages):
+        assert isinstance(decoded_obj, Message)
+        assert_same(decoded_obj, message)
+
+
+def test_large_batch_is_split_into_frames():
+    messages = [make_message(seq) for seq in range(MAX_BATCH_MESSAGES + 10)]
+    data = FrameCodec().encode(messages)
+    frame_type, length = FRAME_HEADER.unpack_from(data)
+    assert len(FrameCodec().decode_payload(
+        data[FRAME_HEADER.size:FRAME_HEADER.size + length])) == (
+        MAX_BATCH_MESSAGES)
+    assert len(read_all(FrameCodec(), data)) == len(messages)
+
+
+def test_frames_are_split_by_size():
+    messages = [make_message(seq, 'x' * 300) for seq in range(1, 11)]
+    data = FrameCodec(max_frame_size=1024).encode(messages)
+    offset = 0
+    frames = 0
+    while offset < len(data):
+        frame_type, length = FRAME_HEADER.unpack_from(data, offset)
+        assert length <= 1024
+        offset += FRAME_HEADER.size + length
+        frames += 1
+    assert frames == 4
+    decoded = read_all(FrameCodec(max_frame_size=1024), data)
+    assert [item.seq for item in decoded if isinstance(item, Message)] == [
+        message.seq for message in messages]
+
+
+def test_fits_frame():
+    assert fits_frame(make_message(1, 'x' * 900), 1024)
+    assert not fits_frame(make_message(1, 'x' * 1024), 1024)
+    assert not fits_frame(make_message(1, to='b' * (MAX_NAME_SIZE + 1)), 1024)
+    long_sep = Message('alice', 'x', sep=':' * (MAX_NAME_SIZE + 1))
+    assert not fits_frame(long_sep, 1024)
+
+
+def test_ack_is_consumed_by_reader():
+    codec = FrameCodec()
+    data = codec.encode_ack(42) + codec.encode([make_message(43)])
+    reader_codec = FrameCodec()
+    decoded = read_all(reader_codec, data)
+    assert [item.seq for item in decoded if isinstance(item, Message)] == [
+        43]
+    assert reader_codec.acked_seq == 42
+
+
+def test_file_frames_pass_through():
+    codec = FrameCodec()
+    data = (
+        codec.encode_file_begin(5, 'файл.txt', 'bob')
+        + codec.encode_file_chunk(b'hello'))
+    begin, chunk = read_all(FrameCodec(), data)
+    assert isinstance(begin, FileFrame) and isinstance(chunk, FileFrame)
+    assert codec.decode_file_begin(begin.payload) == (5, 'файл.txt', 'bob')
+    assert chunk.frame_type == FRAME_FILE_CHUNK
+    assert chunk.payload == b'hello'
+
+
+def test_oversized_frame_is_rejected():
+    data = FrameCodec(max_frame_size=1024).encode([make_message(1, 'x' * 2000)])
+    with pytest.raises(ProtocolError):
+        read_all(FrameCodec(max_frame_size=1024), data)
+
+
+def test_truncated_payload_is_rejected():
+    payload = FrameCodec().encode_payload([make_message(1)])
+    with pytest.raises(ProtocolError):
+        FrameCodec().decode_payload(payload[:-3])
+
+
+def test_line_codec_round_trip():
+    message = make_message(0, 'текст с пробелами')
+    decoded = read_all(LineCodec(), LineCodec().encode([message]))
+    assert len(decoded) == 1
+    assert decoded[0].author == 'alice'
+    assert decoded[0].text == message.text
+
+
+def test_hello_round_trip():
+    async def run() -> tuple[int, int]:
+        reader = asyncio.StreamReader()
+        reader.feed_data(hello(1, 1))
+        return await read_hello(reader)
+
+    assert asyncio.run(run()) == (1, 1)
+
+
+def compressing_pair(threshold: int = 0) -> tuple[FrameCodec, FrameCodec]:
+    sender = FrameCodec()
+    sender.enable_compression(threshold, 6)
+    receiver = FrameCodec()
+    receiver.enable_decompression()
+    return sender, receiver
+
+
+def test_compressed_batches_share_context():
+    sender, receiver = compressing_pair()
+    batches = [
+        [make_message(seq * 10 + index) for index in range(5)]
+        for seq in range(3)
+    ]
+    data = [
+        b''.join(sender.compress([sender.encode(batch)])) for batch in batches
+    ]
+    for chunk in data:
+        assert FRAME_HEADER.unpack_from(chunk)[0] == FRAME_COMPRESSED
+    # Повторы из прошлых пачек сжимаются ссылками назад
+    assert len(data[1]) < len(data[0])
+    decoded = read_all(receiver, b''.join(data))
+    expected = [message for batch in batches for message in batch]
+    assert len(decoded) == len(expected)
+    for decoded_obj, message in zip(decoded, expected):
+        assert isinstance(decoded_obj, Message)
+        assert_same(decoded_obj, message)
+
+
+def test_small_batches_are_not_compressed():
+    sender, receiver = compressing_pair(threshold=10_000)
+    small = sender.encode([make_message(1)])
+    assert sender.compress([small]) == [small]
+    large = sender.encode([make_message(seq) for seq in range(200)])
+    data = small + b''.join(sender.compress([large])) + small
+    assert len(read_all(receiver, data)) == 202
+
+
+def test_large_batch_is_split_into_compressed_frames():
+    sender = FrameCodec(max_frame_size=4096)
+    sender.enable_compression(0, 1)
+    receiver = FrameCodec(max_frame_size=4096)
+    receiver.enable_decompression()
+    chunks = [
+        sender.encode([make_message(seq, f'{seq:x}' * 100)])
+        for seq in range(100)
+    ]
+    frames = sender.compress(chunks)
+    assert len(frames) > 2
+    assert len(read_all(receiver, b''.join(frames))) == 100
+
+
+def test_compressed_frame_without_negotiation_is_rejected():
+    sender, _ = compressing_pair()
+    data = b''.join(sender.compress([sender.encode([make_message(1)])]))
+    with pytest.raises(ProtocolError):
+        read_all(FrameCodec(), data)
+
+
+def test_corrupted_compressed_frame_is_rejected():
+    _, receiver = compressing_pair()
+    with pytest.raises(ProtocolError):
+        receiver.decompress(b'not a deflate stream')
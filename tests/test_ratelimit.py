@@ -0,0 +1,94 @@
+import asyncio
+
+from ratelimit import RateLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_burst_up_to_capacity():
+    clock = FakeClock()
+    limiter = RateLimiter(5, 3600.0, clock)
+    assert all(limiter.allow('alice') for _ in range(5))
+    assert not limiter.allow('alice')
+    assert limiter.rejected == 1
+
+
+def test_users_are_independent():
+    limiter = RateLimiter(1, 60.0, FakeClock())
+    assert limiter.allow('alice')
+    assert not limiter.allow('alice')
+    assert limiter.allow('bob')
+
+
+def test_tokens_refill_evenly():
+    clock = FakeClock()
+    limiter = RateLimiter(4, 60.0, clock)
+    for _ in range(4):
+        assert limiter.allow('alice')
+    assert not limiter.allow('alice')
+    clock.now += 14.9
+    assert not limiter.allow('alice')
+    clock.now += 0.1
+    assert limiter.allow('alice')
+    assert not limiter.allow('alice')
+
+
+def test_full_refill_after_period():
+    clock = FakeClock()
+    limiter = RateLimiter(3, 30.0, clock)
+    for _ in range(3):
+        limiter.allow('alice')
+    clock.now += 30.0
+    assert all(limiter.allow('alice') for _ in range(3))
+    assert not limiter.allow('alice')
+
+
+def test_zero_capacity_rejects_everything():
+    limiter = RateLimiter(0, 60.0, FakeClock())
+    assert not limiter.allow('alice')
+    assert limiter.rejected == 1
+
+
+def test_sweep_removes_only_full_buckets():
+    clock = FakeClock()
+    limiter = RateLimiter(2, 60.0, clock)
+    limiter.allow('alice')
+    clock.now += 10.0
+    limiter.allow('bob')
+    limiter.allow('bob')
+    clock.now += 25.0
+    assert limiter.sweep() == 1
+    assert len(limiter) == 1
+    clock.now += 60.0
+    assert limiter.sweep() == 1
+    assert len(limiter) == 0
+
+
+def test_sweep_respects_limit():
+    clock = FakeClock()
+    limiter = RateLimiter(1, 1.0, clock)
+    for index in range(10):
+        limiter.allow(f'user{index}')
+    clock.now += 5.0
+    assert limiter.sweep(limit=4) == 4
+    assert len(limiter) == 6
+
+
+def test_run_sweep_cleans_in_background():
+    async def run():
+        clock = FakeClock()
+        limiter = RateLimiter(1, 1.0, clock)
+        limiter.allow('alice')
+        clock.now += 5.0
+        task = asyncio.create_task(limiter.run_sweep(0.01))
+        await asyncio.sleep(0.02)
+        task.cancel()
+        return len(limiter)
+
+    assert asyncio.run(run()) == 0
@@ -0,0 +1,140 @@
+import asyncio
+import time
+
+import server as server_module
+from protocol import MAX_NAME_SIZE
+from rooms import GENERAL_ROOM, RoomIndex, is_valid_room_name, is_valid_username
+from wal import MessageLog
+
+
+class FakeConnection:
+    def __init__(self, username: str):
+        self.username = username
+
+
+def room_event(action: str, username: str, room: str = '#dev', **extra):
+    return {
+        'type': 'room', 'action': action, 'username': username, 'room': room,
+        **extra,
+    }
+
+
+def make_index(*usernames):
+    rooms = RoomIndex()
+    connections = {}
+    for username in usernames:
+        connections[username] = FakeConnection(username)
+        rooms.connect(connections[username])
+    return rooms, connections
+
+
+def test_username_rules():
+    assert is_valid_username('alice')
+    assert not is_valid_username('')
+    assert not is_valid_username('#room')
+    assert not is_valid_username('a b')
+
+
+def test_name_fits_frame_name_table():
+    assert is_valid_username('a' * MAX_NAME_SIZE)
+    assert not is_valid_username('a' * (MAX_NAME_SIZE + 1))
+    # Ограничение в байтах UTF-8, а не в символах
+    assert not is_valid_username('я' * (MAX_NAME_SIZE // 2 + 1))
+    assert not is_valid_room_name('#' + 'a' * MAX_NAME_SIZE)
+
+
+def test_join_by_link_and_leave():
+    rooms, connections = make_index('alice', 'bob')
+    rooms.apply(room_event('create', 'alice', token='secret'))
+    rooms.apply(room_event('join', 'bob', token='wrong'))
+    assert 'bob' not in rooms.rooms['#dev'].pending
+    rooms.apply(room_event('join', 'bob', token='secret'))
+    assert rooms.user_rooms('bob') == set()
+    rooms.apply(room_event('approve', 'alice', target='bob'))
+    assert rooms.user_rooms('bob') == {'#dev'}
+    assert set(rooms.members('#dev')) == set(connections.values())
+
+    rooms.apply(room_event('leave', 'bob'))
+    assert rooms.user_rooms('bob') == set()
+    assert set(rooms.members('#dev')) == {connections['alice']}
+
+
+def test_only_members_receive_room_messages():
+    rooms, connections = make_index('alice', 'bob', 'carol')
+    rooms.apply(room_event('create', 'alice', token='secret'))
+    rooms.apply(room_event('invite', 'alice', target='bob'))
+    # Приглашать может только владелец
+    rooms.apply(room_event('invite', 'bob', target='carol'))
+    assert set(rooms.members('#dev')) == {
+        connections['alice'], connections['bob']}
+    assert set(rooms.members(GENERAL_ROOM)) == set(connections.values())
+
+    # Второе устройство участника подписывается на комнату
+    tablet = FakeConnection('bob')
+    rooms.connect(tablet)
+    assert tablet in set(rooms.members('#dev'))
+    rooms.disconnect(connections['bob'])
+    assert connections['bob'] not in set(rooms.members('#dev'))
+
+
+def test_owner_leaving_closes_room():
+    rooms, connections = make_index('alice', 'bob')
+    rooms.apply(room_event('create', 'alice', token='secret'))
+    rooms.apply(room_event('invite', 'alice', target='bob'))
+    notices = rooms.apply(room_event('leave', 'alice'))
+    assert '#dev' not in rooms.rooms
+    assert {username for username, _ in notices} == {'alice', 'bob'}
+    assert list(rooms.members('#dev')) == []
+
+
+def test_snapshot_round_trip():
+    rooms, _ = make_index()
+    rooms.apply(room_event('create', 'alice', token='secret'))
+    rooms.apply(room_event('invite', 'alice', target='bob'))
+    rooms.apply(room_event('join', 'carol', token='secret'))
+
+    restored, connections = make_index('bob')
+    restored.load(rooms.snapshot())
+    assert restored.snapshot() == rooms.snapshot()
+    assert restored.user_rooms('bob') == {'#dev'}
+    assert set(restored.members('#dev')) == {connections['bob']}
+
+
+def message_record(seq: int, text: str, to: str) -> dict:
+    return {
+        'seq': seq, 'author': 'alice', 'text': text, 'datetime': time.time(),
+        'sep': ':', 'to_username': to,
+    }
+
+
+def test_room_history_is_restored(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(server_module.settings.SERVER, 'LOG_DIR', 'log')
+    message_log = MessageLog('log', 1 << 20)
+    message_log.open(3600)
+    for record in (
+        room_event('create', 'alice', token='secret'),
+        room_event('invite', 'alice', target='bob'),
+        message_record(1, 'hello devs', '#dev'),
+        room_event('create', 'alice', '#old', token='secret'),
+        message_record(2, 'old room', '#old'),
+        room_event('leave', 'alice', '#old'),
+        # Новая комната с тем же именем не получает старую историю
+        room_event('create', 'bob', '#old', token='other'),
+        message_record(3, 'hello all', ''),
+    ):
+        message_log.append(record)
+    message_log.close()
+
+    async def run():
+        chat_server = server_module.Server(
+            port=0, metrics_port=0, http_port=0)
+        await chat_server.bus.close()
+        return chat_server
+
+    chat_server = asyncio.run(run())
+    assert sorted(chat_server.rooms.rooms) == ['#dev', '#old']
+    assert chat_server.rooms.user_rooms('bob') == {'#dev', '#old'}
+    assert [message.text for message in chat_server.message_store] == [
+        'hello devs', 'hello all']
+    assert sorted(chat_server.bus.broker.rooms.rooms) == ['#dev', '#old']
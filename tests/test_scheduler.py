@@ -0,0 +1,104 @@
+import asyncio
+
+from message import Message
+from scheduler import DelayedMessageScheduler
+
+
+async def collect(schedule, wait: float) -> list[str]:
+    """
+    Запускает планировщик, ставит сообщения функцией schedule и
+    возвращает тексты отправленных за wait секунд сообщений.
+    """
+    fired: list[str] = []
+    scheduler = DelayedMessageScheduler(
+        lambda message: fired.append(message.text))
+    schedule(scheduler)
+    await asyncio.sleep(wait)
+    scheduler.close()
+    return fired
+
+
+def test_fires_in_order_of_send_time():
+    def schedule(scheduler):
+        scheduler.schedule(Message('alice', 'third'), 0.03)
+        scheduler.schedule(Message('alice', 'first'), 0.01)
+        scheduler.schedule(Message('bob', 'second'), 0.02)
+
+    assert asyncio.run(collect(schedule, 0.1)) == ['first', 'second', 'third']
+
+
+def test_zero_delay_fires_on_next_iteration():
+    def schedule(scheduler):
+        scheduler.schedule(Message('alice', 'now'), 0)
+
+    assert asyncio.run(collect(schedule, 0.01)) == ['now']
+
+
+def test_cancel_only_own_message():
+    def schedule(scheduler):
+        message_id = scheduler.schedule(Message('alice', 'cancelled'), 0.01)
+        assert not scheduler.cancel(message_id, 'bob')
+        assert scheduler.cancel(message_id, 'alice')
+        assert not scheduler.cancel(message_id, 'alice')
+        scheduler.schedule(Message('alice', 'kept'), 0.02)
+
+    assert asyncio.run(collect(schedule, 0.05)) == ['kept']
+
+
+def test_cancel_earliest_rearms_timer():
+    def schedule(scheduler):
+        first = scheduler.schedule(Message('alice', 'first'), 0.01)
+        scheduler.schedule(Message('alice', 'second'), 0.02)
+        scheduler.cancel(first, 'alice')
+
+    assert asyncio.run(collect(schedule, 0.05)) == ['second']
+
+
+def test_clear_removes_all_author_messages():
+    async def run():
+        scheduler = DelayedMessageScheduler(lambda message: None)
+        for index in range(3):
+            scheduler.schedule(Message('alice', str(index)), 10)
+        scheduler.schedule(Message('bob', 'bob'), 10)
+        assert scheduler.clear('alice') == 3
+        assert scheduler.pending == 1
+        assert scheduler.cancelled == 3
+        scheduler.close()
+
+    asyncio.run(run())
+
+
+def test_heap_compacts_after_mass_cancel():
+    async def run():
+        scheduler = DelayedMessageScheduler(lambda message: None)
+        message_ids = [
+            scheduler.schedule(Message('alice', str(index)), 10)
+            for index in range(200)
+        ]
+        for message_id in message_ids[:190]:
+            scheduler.cancel(message_id, 'alice')
+        assert scheduler.pending == 10
+        assert len(scheduler._heap) <= 2 * scheduler.pending + 64
+        scheduler.close()
+
+    asyncio.run(run())
+
+
+def test_callback_error_does_not_stop_scheduler():
+    fired: list[str] = []
+
+    def callback(message):
+        if message.text == 'bad':
+            raise RuntimeError('boom')
+        fired.append(message.text)
+
+    async def run():
+        scheduler = DelayedMessageScheduler(callback)
+        scheduler.schedule(Message('alice', 'bad'), 0.01)
+        scheduler.schedule(Message('alice', 'good'), 0.01)
+        await asyncio.sleep(0.05)
+        assert scheduler.fired == 2
+        scheduler.close()
+
+    asyncio.run(run())
+    assert fired == ['good']
@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from message import Message
+from search import Postings, SearchIndex, parse_query, tokenize
+from store import MessageStore
+
+
+def make_message(
+        seq: int, text: str, author: str = 'alice', to: str = '') -> Message:
+    message = Message(author, text, to=to)
+    message.seq = seq
+    return message
+
+
+def test_tokenize_lowercases_and_deduplicates():
+    assert tokenize('Привет, мир! привет я') == ['привет', 'мир']
+
+
+def test_parse_query_filters():
+    query = parse_query(
+        'Отчет from:bob since:2024-01-01T10:00 before:42 until:2024-01-02')
+    assert query.terms == ['отчет', '@bob']
+    assert query.author == 'bob'
+    assert query.before == 42
+    assert query.since == datetime(2024, 1, 1, 10).timestamp()
+    assert query.until == datetime(2024, 1, 2).timestamp()
+
+
+@pytest.mark.parametrize('text', ['', 'a', 'since:not-a-date', 'before:x'])
+def test_parse_query_rejects_invalid(text):
+    with pytest.raises(ValueError):
+        parse_query(text)
+
+
+def test_postings_remove_from_head_and_compact():
+    postings = Postings()
+    postings.seqs.extend(range(1, 11))
+    postings.remove(5)
+    assert len(postings) == 10
+    for seq in range(1, 7):
+        postings.remove(seq)
+    assert len(postings) == 4
+    assert postings.head == 0
+    assert 7 in postings and 3 not in postings
+
+
+def test_index_matches_all_terms_newest_first():
+    index = SearchIndex()
+    for seq, text in enumerate(
+            ['release plan', 'plan only', 'release plan final'], start=1):
+        index.add(make_message(seq, text), float(seq))
+    assert list(index.search('', ['release', 'plan'], 0, 100)) == [3, 1]
+    assert list(index.search('', ['missing'], 0, 100)) == []
+    assert list(index.search('', ['plan'], 2, 3)) == [2]
+
+
+def test_index_is_scoped_by_recipient():
+    index = SearchIndex()
+    index.add(make_message(1, 'secret', to='#room'), 1.0)
+    index.add(make_message(2, 'secret', to='bob'), 2.0)
+    assert list(index.search('#room', ['secret'], 0, 100)) == [1]
+    assert list(index.search('', ['secret'], 0, 100)) == []
+
+
+def test_index_remove_and_seq_range():
+    index = SearchIndex()
+    messages = [make_message(seq, 'hello') for seq in range(1, 5)]
+    for message in messages:
+        index.add(message, float(message.seq * 10))
+    assert index.seq_range(15.0, 30.0) == (2, 4)
+    index.remove(messages[0])
+    index.expire(1)
+    assert list(index.search('', ['hello'], 0, 100)) == [4, 3, 2]
+    for message in messages[1:]:
+        index.remove(message)
+    assert index.scopes == {}
+
+
+def test_store_search_pages_and_visibility():
+    store = MessageStore(timedelta(hours=1))
+    for index in range(5):
+        store.add(Message('alice', f'report {index}'))
+    store.add(Message('bob', 'report private', to='carol'))
+    store.add(Message('bob', 'report room', to='#team'))
+
+    found = store.search(['', '#team'], parse_query('report'), 3)
+    assert [message.text for message in found] == [
+        'report room', 'report 4', 'report 3']
+    query = parse_query(f'report before:{found[-1].seq}')
+    assert [message.text for message in store.search([''], query, 10)] == [
+        'report 2', 'report 1', 'report 0']
+    query = parse_query('report from:bob')
+    assert [message.text for message in store.search(
+        ['', 'carol'], query, 10)] == ['report private']
+
+
+def test_store_search_forgets_evicted_messages():
+    store = MessageStore(timedelta(hours=1), public_maxlen=2)
+    for index in range(4):
+        store.add(Message('alice', f'note {index}'))
+    found = store.search([''], parse_query('note'), 10)
+    assert [message.text for message in found] == ['note 3', 'note 2']
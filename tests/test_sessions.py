@@ -0,0 +1,178 @@
+import asyncio
+import json
+
+import pytest
+
+import bus
+import server as server_module
+from http_api import HttpConnection
+from message import Message
+from protocol import JsonCodec
+
+
+@pytest.fixture(autouse=True)
+def chat_settings(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(server_module.settings.SERVER, 'LOG_DIR', 'log')
+    monkeypatch.setattr(bus.settings, 'LIMIT_MESSAGES_CNT', 100)
+
+
+def device(token: str) -> HttpConnection:
+    return HttpConnection(token, 1024, 'drop_oldest', JsonCodec())
+
+
+async def start_server() -> tuple[server_module.Server, asyncio.Task]:
+    chat_server = server_module.Server(port=0, metrics_port=0, http_port=0)
+    return chat_server, asyncio.create_task(chat_server.run_bus())
+
+
+async def stop_server(chat_server, bus_task) -> None:
+    bus_task.cancel()
+    await chat_server.bus.close()
+
+
+async def say(chat_server, connection, *texts: str) -> None:
+    """
+    Отправляет сообщения и ждет, пока брокер их разошлет.
+    """
+    for text in texts:
+        await chat_server.handle_message(
+            connection, Message(connection.username, text))
+    while chat_server.message_store.last_seq < chat_server.bus.broker.last_seq:
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.01)
+
+
+async def received(connection: HttpConnection) -> list[dict]:
+    """
+    Забирает сообщения чата (с номером), доставленные подключению.
+    """
+    chunks = await connection.receive(0)
+    records = [
+        json.loads(line) for chunk in chunks
+        for line in chunk.splitlines()]
+    return [record for record in records if record['seq']]
+
+
+async def reconnect(
+        chat_server, connection: HttpConnection, username: str,
+        resume_seq: int = 0) -> list[dict]:
+    """
+    Открывает сессию и забирает догружаемые страницы, пока догрузка
+    не закончится.
+    """
+    opening = asyncio.create_task(
+        chat_server.open_session(connection, username, resume_seq))
+    records = []
+    while not opening.done() or connection.queue_depth:
+        records += await received(connection)
+        await asyncio.sleep(0.01)
+    await opening
+    return records
+
+
+def texts(records: list[dict]) -> list[str]:
+    return [record['text'] for record in records]
+
+
+def test_devices_share_one_cursor():
+    async def run():
+        chat_server, bus_task = await start_server()
+        bob = device('bob')
+        phone, laptop = device('phone'), device('laptop')
+        await chat_server.open_session(bob, 'bob')
+        await chat_server.open_session(phone, 'alice')
+        await chat_server.open_session(laptop, 'alice')
+        await say(chat_server, bob, 'one', 'two')
+        records = await received(phone)
+        assert texts(records) == ['one', 'two']
+        assert texts(await received(laptop)) == ['one', 'two']
+
+        # Прочитанное на телефоне не приходит повторно на ноутбук
+        phone.codec.acknowledge(records[-1]['seq'])
+        laptop.sent_seq = records[0]['seq']
+        assert chat_server.shared_cursor('alice') == records[-1]['seq']
+
+        await chat_server.close_session(phone)
+        await chat_server.close_session(laptop)
+        assert chat_server.cursors['alice'] == records[-1]['seq']
+        await stop_server(chat_server, bus_task)
+
+    asyncio.run(run())
+
+
+def test_resume_after_ack():
+    async def run():
+        chat_server, bus_task = await start_server()
+        bob, alice = device('bob'), device('alice')
+        await chat_server.open_session(bob, 'bob')
+        await chat_server.open_session(alice, 'alice')
+        await say(chat_server, bob, 'one', 'two')
+        records = await received(alice)
+        alice.codec.acknowledge(records[0]['seq'])
+        await chat_server.close_session(alice)
+
+        await say(chat_server, bob, 'three', '/private alice psst')
+        # Сообщение 'two' не подтверждено и приходит повторно
+        records = await reconnect(chat_server, device('again'), 'alice')
+        assert texts(records) == ['two', 'three', 'psst']
+        assert records[-1]['to_username'] == 'alice'
+        await stop_server(chat_server, bus_task)
+
+    asyncio.run(run())
+
+
+def test_client_resume_seq_overrides_server_cursor():
+    async def run():
+        chat_server, bus_task = await start_server()
+        bob, alice = device('bob'), device('alice')
+        await chat_server.open_session(bob, 'bob')
+        await chat_server.open_session(alice, 'alice')
+        await say(chat_server, bob, 'one', 'two', 'three')
+        records = await received(alice)
+        await chat_server.close_session(alice)
+
+        # Клиент сообщает, что получил только два сообщения
+        again = device('again')
+        assert texts(await reconnect(
+            chat_server, again, 'alice', records[1]['seq'])) == []
+        assert chat_server.shared_cursor('alice') == records[-1]['seq']
+        await stop_server(chat_server, bus_task)
+
+    asyncio.run(run())
+
+
+def test_live_messages_wait_for_catch_up(monkeypatch):
+    monkeypatch.setattr(server_module.settings, 'CATCH_UP_PAGE_SIZE', 2)
+
+    async def run():
+        chat_server, bus_task = await start_server()
+        bob, alice = device('bob'), device('alice')
+        await chat_server.open_session(bob, 'bob')
+        await chat_server.open_session(alice, 'alice')
+        await chat_server.close_session(alice)
+        await say(chat_server, bob, *(f'unread {n}' for n in range(5)))
+
+        again = device('again')
+        opening = asyncio.create_task(
+            chat_server.open_session(again, 'alice'))
+        await asyncio.sleep(0.01)
+        # Первая страница ждет, пока клиент ее заберет; новые сообщения
+        # в это время не обгоняют догрузку
+        assert again.catching_up
+        await say(chat_server, bob, 'live')
+        records = []
+        while not opening.done() or again.queue_depth:
+            records += await received(again)
+            await asyncio.sleep(0.01)
+        assert not again.catching_up
+        await say(chat_server, bob, 'after')
+        records += await received(again)
+
+        assert texts(records) == [
+            *(f'unread {n}' for n in range(5)), 'live', 'after']
+        seqs = [record['seq'] for record in records]
+        assert seqs == sorted(set(seqs))
+        await stop_server(chat_server, bus_task)
+
+    asyncio.run(run())
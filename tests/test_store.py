@@ -0,0 +1,108 @@
+from datetime import timedelta
+
+from message import Message
+from store import MessageStore, Timeline
+
+
+def make_message(seq: int, to: str = '', timestamp: float = 1000.0) -> Message:
+    message = Message(
+        'alice', f'message {seq}', to=to,
+        timestamp_us=round(timestamp * 1_000_000))
+    message.seq = seq
+    return message
+
+
+def test_timeline_ring_buffer_evicts_oldest():
+    timeline = Timeline(maxlen=3)
+    evicted = [timeline.append(make_message(seq)) for seq in range(1, 6)]
+    assert [message.seq if message else None for message in evicted] == [
+        None, None, None, 1, 2]
+    assert [message.seq for message in timeline] == [3, 4, 5]
+
+
+def test_timeline_after_seq_and_last():
+    timeline = Timeline()
+    for seq in (2, 4, 6, 8):
+        timeline.append(make_message(seq))
+    assert [message.seq for message in timeline.after_seq(4, 10)] == [6, 8]
+    assert [message.seq for message in timeline.after_seq(3, 1)] == [4]
+    assert [message.seq for message in timeline.last(2)] == [6, 8]
+
+
+def test_timeline_evict_upto_and_shrink():
+    timeline = Timeline()
+    for seq in range(1, 3001):
+        timeline.append(make_message(seq))
+    evicted = timeline.evict_upto(2000)
+    assert len(evicted) == 2000
+    assert len(timeline) == 1000
+    assert [message.seq for message in timeline.resolve([2001, 3000])] == [
+        2001, 3000]
+    assert timeline.after_seq(0, 1)[0].seq == 2001
+
+
+def test_store_assigns_increasing_seq():
+    store = MessageStore(timedelta(hours=1))
+    seqs = [store.add(Message('alice', str(index))) for index in range(3)]
+    assert seqs == [1, 2, 3]
+    assert store.last_seq == 3
+    assert len(store) == 3
+
+
+def test_store_keeps_restored_seq():
+    store = MessageStore(timedelta(hours=1))
+    store.add(make_message(10))
+    assert store.add(Message('alice', 'next')) == 11
+
+
+def test_store_after_seq_merges_public_and_private():
+    store = MessageStore(timedelta(hours=1))
+    store.add(make_message(1))
+    store.add(make_message(2, to='bob'))
+    store.add(make_message(3, to='carol'))
+    store.add(make_message(4))
+    store.add(make_message(5, to='#room'))
+    messages = store.after_seq(['bob', '#room'], 1, 10)
+    assert [message.seq for message in messages] == [2, 4, 5]
+    assert [message.seq for message in store.after_seq(['bob'], 0, 2)] == [
+        1, 2]
+
+
+def test_store_public_maxlen():
+    store = MessageStore(timedelta(hours=1), public_maxlen=2)
+    for seq in range(1, 5):
+        store.add(make_message(seq))
+    assert [message.seq for message in store.last_public(10)] == [3, 4]
+    assert len(store) == 2
+
+
+def test_store_evicts_expired_messages():
+    store = MessageStore(timedelta(seconds=10))
+    store.add(make_message(1, timestamp=100.0))
+    store.add(make_message(2, to='bob', timestamp=101.0))
+    store.add(make_message(3, timestamp=120.0))
+    assert store.evict_expired(now=115.0) == 2
+    assert [message.seq for message in store] == [3]
+    assert 'bob' not in store.private
+    assert store.evict_expired(now=115.0) == 0
+
+
+def test_store_eviction_respects_limit():
+    store = MessageStore(timedelta(seconds=10))
+    for seq in range(1, 6):
+        store.add(make_message(seq, timestamp=100.0))
+    assert store.evict_expired(now=200.0, limit=2) == 2
+    assert len(store) == 3
+    assert store.evict_expired(now=200.0) == 3
+    assert len(store) == 0
+
+
+def test_store_drop_removes_timeline_and_index():
+    store = MessageStore(timedelta(hours=1))
+    store.add(Message('alice', 'topsecret plans', to='#room'))
+    store.add(Message('alice', 'topsecret public'))
+    assert store.drop('#room') == 1
+    assert len(store) == 1
+    assert '#room' not in store.private
+    assert '#room' not in store.index.scopes
+    assert store.drop('#room') == 0
@@ -0,0 +1,91 @@
+import os
+
+import pytest
+
+from wal import RECORD_HEADER, MessageLog, MessageLogError
+
+TTL_SEC = 3600.0
+
+
+def write_records(directory: str, count: int, start: int = 0) -> MessageLog:
+    message_log = MessageLog(directory, segment_size=1024 * 1024)
+    message_log.open(TTL_SEC)
+    for seq in range(start, start + count):
+        message_log.append({'seq': seq, 'text': f'message {seq}'})
+    message_log.close()
+    return message_log
+
+
+def test_replay_returns_appended_records(tmp_path):
+    message_log = write_records(str(tmp_path), 10)
+    records = list(message_log.replay(TTL_SEC))
+    assert [record['seq'] for record in records] == list(range(10))
+    assert message_log.written == 10
+
+
+def test_segments_rotate(tmp_path):
+    message_log = MessageLog(str(tmp_path), segment_size=64)
+    message_log.open(TTL_SEC)
+    for seq in range(20):
+        message_log.append({'seq': seq})
+        message_log.flush()
+    message_log.close()
+    assert len(message_log.segments()) > 1
+    assert [record['seq'] for record in message_log.replay(TTL_SEC)] == (
+        list(range(20)))
+
+
+def test_replay_truncates_torn_tail(tmp_path):
+    count = 10
+    message_log = write_records(str(tmp_path), count)
+    [path] = message_log.segments()
+    size = os.path.getsize(path)
+    # Последняя запись оборвана на середине, как при сбое питания
+    last_record = RECORD_HEADER.size + len(b'{"seq":9,"text":"message 9"}')
+    good_offset = size - last_record
+    with open(path, 'r+b') as f:
+        f.truncate(good_offset + last_record // 2)
+
+    records = list(message_log.replay(TTL_SEC))
+    assert [record['seq'] for record in records] == list(range(count - 1))
+    assert os.path.getsize(path) == good_offset
+
+    write_records(str(tmp_path), 2, start=count - 1)
+    records = list(message_log.replay(TTL_SEC))
+    assert [record['seq'] for record in records] == list(range(count + 1))
+
+
+def test_replay_without_repair_keeps_file(tmp_path):
+    message_log = write_records(str(tmp_path), 3)
+    [path] = message_log.segments()
+    with open(path, 'ab') as f:
+        f.write(b'\x10\x00')
+    size = os.path.getsize(path)
+    assert len(list(message_log.replay(TTL_SEC, repair=False))) == 3
+    assert os.path.getsize(path) == size
+
+
+def test_replay_stops_at_corrupted_checksum(tmp_path):
+    message_log = write_records(str(tmp_path), 3)
+    [path] = message_log.segments()
+    with open(path, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b'#')
+    assert [record['seq'] for record in message_log.replay(TTL_SEC)] == [
+        0, 1]
+
+
+def test_write_error_fails_log(tmp_path, monkeypatch):
+    message_log = MessageLog(str(tmp_path), segment_size=1024 * 1024)
+    message_log.open(TTL_SEC)
+
+    def fail_fsync(fd: int) -> None:
+        raise OSError(28, 'No space left on device')
+
+    monkeypatch.setattr(os, 'fsync', fail_fsync)
+    message_log.append({'seq': 1})
+    with pytest.raises(MessageLogError):
+        message_log.flush()
+    with pytest.raises(MessageLogError):
+        message_log.append({'seq': 2})
+    message_log.close()
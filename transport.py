@@ -0,0 +1,382 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Optional
+
+import metrics
+from connection import BaseConnection, Outgoing, OutgoingFile, discard
+from message import Message, message_str_to_object
+from protocol import (
+    FILE_FRAMES,
+    FLAG_COMPRESSION,
+    FRAME_ACK,
+    FRAME_HEADER,
+    FRAME_MESSAGES,
+    HELLO,
+    PROTOCOL_MAGIC,
+    PROTOCOL_VERSION,
+    Codec,
+    FileFrame,
+    FrameCodec,
+    Incoming,
+    LineCodec,
+    ProtocolError,
+    StreamCodec,
+    accept_flags,
+    hello,
+    make_codec,
+)
+from rooms import is_valid_username
+from settings import Settings
+
+if TYPE_CHECKING:
+    from server import Server
+
+settings = Settings()
+
+logger = logging.getLogger(__name__)
+
+# Начальный размер приемного буфера соединения
+RECEIVE_BUFFER_SIZE = 64 * 1024
+# Кол-во необработанных входящих сообщений, после которого
+# чтение из сокета приостанавливается
+INBOX_HIGH_WATER = 1024
+
+
+class ProtocolConnection(BaseConnection):
+    """
+    Подключение поверх asyncio.Transport без очереди и задачи-писателя.
+
+    Отправляемые данные копятся в списке и сбрасываются в транспорт одним
+    writelines на итерацию цикла событий, без drain. Пока транспорт просит
+    приостановить запись (pause_writing), список не сбрасывается, а его
+    переполнение обрабатывается по политике медленного клиента.
+    Файлы отправляются через loop.sendfile, а данные, поставленные
+    после файла, ждут окончания его отправки.
+    """
+
+    def __init__(
+            self,
+            transport: asyncio.Transport,
+            queue_size: int,
+            policy: str,
+            codec: Codec
+    ):
+        super().__init__(queue_size, policy, codec)
+        self.transport = transport
+        self.paused: bool = False
+        self._paused_at: float = 0.0
+        self._backlog: deque[Outgoing] = deque()
+        self._flush_scheduled: bool = False
+        self._file_task: Optional[asyncio.Task] = None
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._backlog)
+
+    def _pop_oldest(self) -> Optional[Outgoing]:
+        return self._backlog.popleft()
+
+    def _append(self, data: Outgoing) -> None:
+        self._backlog.append(data)
+        if not self.paused and not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    async def send(self, data: Outgoing) -> None:
+        while not self.send_nowait(data):
+            self._writable.clear()
+            await self._writable.wait()
+
+    def _flush(self) -> None:
+        """
+        Сбрасывает накопленные данные в транспорт.
+        """
+        self._flush_scheduled = False
+        if (
+            self.paused or self.closed or self._file_task is not None
+            or not self._backlog
+        ):
+            return
+        chunks: list[bytes] = []
+        while self._backlog:
+            chunk = self._backlog[0]
+            if not isinstance(chunk, bytes):
+                break
+            chunks.append(chunk)
+            self._backlog.popleft()
+        self.transport.writelines(self.codec.compress(chunks))
+        if self._backlog:
+            outgoing = self._backlog.popleft()
+            assert isinstance(outgoing, OutgoingFile)
+            self._file_task = asyncio.create_task(self._send_file(outgoing))
+        self._writable.set()
+
+    async def _send_file(self, outgoing: OutgoingFile) -> None:
+        """
+        Отправляет файл через sendfile и продолжает сброс накопленных
+        за это время данных.
+        """
+        try:
+            with outgoing.file:
+                self.transport.write(outgoing.header)
+                await asyncio.get_running_loop().sendfile(
+                    self.transport, outgoing.file)
+        except (ConnectionError, OSError, RuntimeError) as error:
+            logger.error(f'Ошибка отправки файла клиенту: {error}')
+            self.abort()
+        finally:
+            self._file_task = None
+            self._flush()
+
+    def pause_writing(self) -> None:
+        self.paused = True
+        self._paused_at = time.perf_counter()
+
+    def resume_writing(self) -> None:
+        self.paused = False
+        # Аналог ожидания drain() у потокового подключения
+        metrics.drain_seconds.observe(time.perf_counter() - self._paused_at)
+        self._flush()
+        self._writable.set()
+
+    async def wait_flushed(self) -> None:
+        while (
+            self._backlog or self.paused or self._file_task is not None
+        ) and not self.closed:
+            self._writable.clear()
+            await self._writable.wait()
+
+    def abort(self) -> None:
+        self.closed = True
+        while self._backlog:
+            discard(self._backlog.popleft())
+        self._writable.set()
+        self.transport.abort()
+
+    async def close(self) -> None:
+        if self.closed:
+            return
+        # Транспорт сам допишет свой буфер перед закрытием
+        self.paused = False
+        self._flush()
+        self.closed = True
+        # Данные за отправляемым файлом транспорт уже не получит
+        while self._backlog:
+            discard(self._backlog.popleft())
+        self._writable.set()
+        self.transport.close()
+
+
+class ChatProtocol(asyncio.BufferedProtocol):
+    """
+    Обработчик подключения на asyncio.BufferedProtocol.
+
+    Данные читаются прямо в заранее выделенный буфер, кадры и строки
+    разбираются из него через memoryview без промежуточных копий.
+    Разобранные сообщения обрабатывает одна задача на подключение
+    с той же логикой команд, что и у потокового обработчика.
+    """
+
+    def __init__(self, server: 'Server'):
+        self.server = server
+        self.max_frame_size = settings.SERVER.MAX_FRAME_SIZE
+        # Транспорт назначается в connection_made, до прихода данных
+        self.transport: asyncio.Transport
+        self.connection: Optional[ProtocolConnection] = None
+        self.codec: Optional[StreamCodec] = None
+        self._buffer = bytearray(RECEIVE_BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        self._start: int = 0
+        self._end: int = 0
+        self._inbox: deque[Incoming] = deque()
+        self._wakeup = asyncio.Event()
+        self._eof: bool = False
+        self._reading_paused: bool = False
+        self._task: Optional[asyncio.Task] = None
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        assert isinstance(transport, asyncio.Transport)
+        self.transport = transport
+        self._task = asyncio.create_task(self._run())
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self._end == len(self._buffer):
+            self._make_room()
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self._end += nbytes
+        try:
+            self._parse()
+        except (ProtocolError, ValueError, IndexError) as error:
+            logger.error(f'Клиент нарушил протокол: {error}')
+            self._eof = True
+            self.transport.abort()
+        if self._inbox:
+            self._wakeup.set()
+            if len(self._inbox) >= INBOX_HIGH_WATER:
+                self._reading_paused = True
+                self.transport.pause_reading()
+
+    def eof_received(self) -> bool:
+        self._eof = True
+        self._wakeup.set()
+        return False
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self._eof = True
+        self._wakeup.set()
+        if self.connection is not None:
+            self.connection.closed = True
+
+    def pause_writing(self) -> None:
+        if self.connection is not None:
+            self.connection.pause_writing()
+
+    def resume_writing(self) -> None:
+        if self.connection is not None:
+            self.connection.resume_writing()
+
+    def _make_room(self) -> None:
+        """
+        Сдвигает непрочитанные данные в начало буфера, а если буфер занят
+        одним недочитанным кадром - увеличивает его.
+        """
+        pending = self._end - self._start
+        if self._start == 0:
+            if len(self._buffer) >= self.max_frame_size + FRAME_HEADER.size:
+                raise ProtocolError('Слишком большой кадр')
+            buffer = bytearray(len(self._buffer) * 2)
+            buffer[:pending] = self._view[:pending]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+        else:
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+        self._start = 0
+        self._end = pending
+
+    def _parse(self) -> None:
+        """
+        Разбирает все полностью полученные кадры или строки.
+        """
+        if self.codec is None and not self._parse_hello():
+            return
+        if isinstance(self.codec, FrameCodec):
+            self._parse_frames(self.codec)
+        else:
+            self._parse_lines()
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def _parse_hello(self) -> bool:
+        """
+        Определяет протокол клиента по первым байтам подключения.
+        """
+        if self._end - self._start < 1:
+            return False
+        if self._buffer[self._start] != PROTOCOL_MAGIC[0]:
+            self.codec = LineCodec()
+            return True
+        if self._end - self._start < HELLO.size:
+            return False
+        magic, version, client_flags = HELLO.unpack_from(
+            self._buffer, self._start)
+        if magic != PROTOCOL_MAGIC:
+            raise ProtocolError('Некорректное приветствие')
+        self._start += HELLO.size
+        version = min(version, PROTOCOL_VERSION)
+        flags = accept_flags(client_flags, settings.SERVER.COMPRESSION)
+        self.transport.write(hello(version, flags))
+        codec = make_codec(version, self.max_frame_size)
+        if flags & FLAG_COMPRESSION and isinstance(codec, FrameCodec):
+            codec.enable_compression(
+                settings.SERVER.COMPRESSION_THRESHOLD,
+                settings.SERVER.COMPRESSION_LEVEL)
+        self.codec = codec
+        return True
+
+    def _parse_frames(self, codec: FrameCodec) -> None:
+        header_size = FRAME_HEADER.size
+        while self._end - self._start >= header_size:
+            frame_type, length = FRAME_HEADER.unpack_from(
+                self._buffer, self._start)
+            if length > self.max_frame_size:
+                raise ProtocolError(f'Слишком большой кадр: {length} байт')
+            frame_end = self._start + header_size + length
+            if frame_end > self._end:
+                return
+            payload = self._view[self._start + header_size:frame_end]
+            if frame_type == FRAME_MESSAGES:
+                self._inbox.extend(codec.decode_payload(payload))
+            elif frame_type == FRAME_ACK:
+                codec.decode_ack(payload)
+            elif frame_type in FILE_FRAMES:
+                # Буфер переиспользуется, поэтому часть файла копируется
+                self._inbox.append(FileFrame(frame_type, bytes(payload)))
+            else:
+                raise ProtocolError(f'Неизвестный тип кадра: {frame_type}')
+            self._start = frame_end
+
+    def _parse_lines(self) -> None:
+        while True:
+            line_end = self._buffer.find(b'\n', self._start, self._end)
+            if line_end < 0:
+                return
+            message_str = str(
+                self._view[self._start:line_end], 'utf-8').strip()
+            self._start = line_end + 1
+            if message_str:
+                self._inbox.append(message_str_to_object(message_str))
+
+    async def _next_message(self) -> Optional[Incoming]:
+        """
+        Ждет очередное разобранное сообщение.
+        Возвращает None, когда клиент отключился.
+        """
+        while not self._inbox:
+            if self._eof:
+                return None
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        if self._reading_paused and len(self._inbox) <= INBOX_HIGH_WATER // 2:
+            self._reading_paused = False
+            self.transport.resume_reading()
+        return self._inbox.popleft()
+
+    async def _run(self) -> None:
+        """
+        Обрабатывает сообщения подключения по очереди.
+        """
+        intro = await self._next_message()
+        if not isinstance(intro, Message) or self.codec is None:
+            self.transport.close()
+            return
+        if not is_valid_username(intro.author):
+            logger.error(f'Недопустимое имя: {intro.author!r}')
+            self.transport.write(self.codec.encode([Message(
+                '!', f'Имя {intro.author!r} недопустимо.', sep='')]))
+            self.transport.close()
+            return
+
+        self.connection = ProtocolConnection(
+            self.transport,
+            settings.SERVER.SEND_QUEUE_SIZE,
+            settings.SERVER.SLOW_CONSUMER_POLICY,
+            self.codec,
+        )
+        await self.server.open_session(
+            self.connection, intro.author, intro.seq)
+        try:
+            while True:
+                message_obj = await self._next_message()
+                if message_obj is None:
+                    break
+                await self.server.handle_message(self.connection, message_obj)
+        except asyncio.CancelledError as error:
+            logger.error(f'Во время работы возникла ошибка: {error}')
+        finally:
+            await self.server.close_session(self.connection)
@@ -0,0 +1,295 @@
+import json
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from typing import BinaryIO, Callable, Iterator, Optional, Union
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Заголовок записи: длина полезной нагрузки и ее контрольная сумма crc32
+RECORD_HEADER = struct.Struct('<II')
+SEGMENT_SUFFIX = '.log'
+
+# Служебные команды для потока записи
+_COMPACT = 'compact'
+_STOP = 'stop'
+# Период, с которым flush проверяет, жив ли поток записи
+_FLUSH_CHECK_SEC = 1.0
+
+# Обработчик записи на диск: получает ошибку записи или None
+CommitCallback = Callable[[Optional[OSError]], None]
+# Элемент очереди потока записи
+_Item = Union[bytes, str, threading.Event, CommitCallback]
+
+
+class MessageLogError(OSError):
+    """
+    Журнал не может принимать записи: поток записи остановлен ошибкой
+    ввода-вывода.
+    """
+
+
+class MessageLog:
+    """
+    Журнал сообщений только на дозапись (write-ahead log).
+
+    Журнал разбит на сегменты, каждый сегмент - последовательность записей
+    вида <длина><crc32><json>. Запись ведет отдельный поток: он забирает
+    из очереди все накопившиеся записи и сбрасывает их на диск одним
+    fsync (group commit), поэтому цикл событий не ждет диска.
+    Кто ждет записи на диск, передает в append обработчик on_commit.
+    """
+
+    def __init__(self, directory: str, segment_size: int):
+        self.directory = directory
+        self.segment_size = segment_size
+        self._queue: queue.Queue[_Item] = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._ttl_sec: float = 0.0
+        # Счетчики записанных записей и вызовов fsync
+        self.written: int = 0
+        self.fsyncs: int = 0
+        # Ошибка, остановившая поток записи
+        self.error: Optional[OSError] = None
+
+    @property
+    def pending(self) -> int:
+        """
+        Кол-во записей и команд, ожидающих потока записи.
+        """
+        return self._queue.qsize()
+
+    def segments(self) -> list[str]:
+        """
+        Возвращает пути к сегментам журнала в порядке их создания.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        return [
+            os.path.join(self.directory, name)
+            for name in sorted(os.listdir(self.directory))
+            if name.endswith(SEGMENT_SUFFIX)
+        ]
+
+    def replay(
+            self, ttl_sec: float, repair: bool = True) -> Iterator[dict]:
+        """
+        Последовательно читает записи журнала, пропуская сегменты,
+        целиком состоящие из сообщений старше ttl_sec.
+        Оборванная при сбое запись в конце сегмента отрезается (repair),
+        либо чтение на ней просто останавливается.
+        """
+        deadline = time.time() - ttl_sec
+        for path in self.segments():
+            # Все записи сегмента не новее времени его изменения
+            if os.path.getmtime(path) < deadline:
+                continue
+            yield from self._read_segment(path, repair)
+
+    def _read_segment(self, path: str, repair: bool) -> Iterator[dict]:
+        with open(path, 'rb') as f:
+            offset = 0
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if not header:
+                    return
+                payload = b''
+                if len(header) == RECORD_HEADER.size:
+                    length, checksum = RECORD_HEADER.unpack(header)
+                    payload = f.read(length)
+                    if (
+                        len(payload) == length
+                        and zlib.crc32(payload) == checksum
+                    ):
+                        offset += RECORD_HEADER.size + length
+                        yield json.loads(payload)
+                        continue
+                break
+
+        if not repair:
+            return
+        logger.warning(
+            f'Журнал {path} поврежден, обрезаем его до {offset} байт.')
+        with open(path, 'r+b') as f:
+            f.truncate(offset)
+
+    def open(self, ttl_sec: float) -> None:
+        """
+        Запускает поток записи журнала.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self._ttl_sec = ttl_sec
+        self._thread = threading.Thread(
+            target=self._write_loop, name='message-log', daemon=True)
+        self._thread.start()
+
+    def check(self) -> None:
+        """
+        Бросает MessageLogError, если поток записи остановлен ошибкой.
+        """
+        if self.error is not None:
+            raise MessageLogError(
+                f'Журнал {self.directory} недоступен: {self.error}')
+
+    def append(
+            self, record: Union[dict, bytes],
+            on_commit: Optional[CommitCallback] = None) -> None:
+        """
+        Ставит запись в очередь на запись в журнал. Запись - словарь
+        или уже закодированный JSON (Message.record_bytes).
+        on_commit вызывается в потоке записи после fsync записи
+        (или с ошибкой, если записать ее не удалось).
+        Бросает MessageLogError, если журнал недоступен.
+        """
+        self.check()
+        if isinstance(record, bytes):
+            payload = record
+        else:
+            payload = json.dumps(
+                record, ensure_ascii=False, separators=(',', ':')).encode()
+        self._queue.put(
+            RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+        # Обработчик идет в очереди следом за записью и попадает в ту же
+        # или более позднюю пачку
+        if on_commit is not None:
+            self._queue.put(on_commit)
+
+    def compact(self) -> None:
+        """
+        Просит поток записи удалить устаревшие сегменты.
+        """
+        self._queue.put(_COMPACT)
+
+    def flush(self) -> None:
+        """
+        Блокирует вызывающий поток до записи на диск всех
+        поставленных в очередь записей.
+        Бросает MessageLogError, если журнал недоступен.
+        """
+        thread = self._thread
+        if thread is None:
+            return
+        self.check()
+        event = threading.Event()
+        self._queue.put(event)
+        # Поток записи мог остановиться, не дойдя до события
+        while not event.wait(_FLUSH_CHECK_SEC):
+            if not thread.is_alive():
+                break
+        self.check()
+
+    def close(self) -> None:
+        """
+        Дописывает очередь и останавливает поток записи.
+        """
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def _new_segment(self) -> str:
+        segments = self.segments()
+        index = 1
+        if segments:
+            name = os.path.basename(segments[-1])
+            index = int(name[:-len(SEGMENT_SUFFIX)]) + 1
+        return os.path.join(self.directory, f'{index:08d}{SEGMENT_SUFFIX}')
+
+    def _next_batch(self) -> list[_Item]:
+        """
+        Ждет первую запись и забирает все накопившиеся следом за ней.
+        """
+        batch = [self._queue.get()]
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def _write_batch(
+            self, f: BinaryIO, path: str, batch: list[_Item]) -> bool:
+        """
+        Пишет пачку записей одним fsync.
+        Возвращает False, если получена команда остановки.
+        """
+        running = True
+        events = []
+        callbacks = []
+        records = [item for item in batch if isinstance(item, bytes)]
+        for item in batch:
+            if isinstance(item, threading.Event):
+                events.append(item)
+            elif callable(item):
+                callbacks.append(item)
+            elif item == _COMPACT:
+                self._compact(path)
+            elif item == _STOP:
+                running = False
+
+        try:
+            if records:
+                started = time.perf_counter()
+                f.writelines(records)
+                f.flush()
+                os.fsync(f.fileno())
+                metrics.log_fsync_seconds.observe(
+                    time.perf_counter() - started)
+                metrics.log_records.inc(len(records))
+                self.written += len(records)
+                self.fsyncs += 1
+        except OSError as error:
+            self.error = error
+            raise
+        finally:
+            # Ждущие flush узнают об ошибке из self.error
+            for event in events:
+                event.set()
+            for callback in callbacks:
+                callback(self.error)
+        return running
+
+    def _write_loop(self) -> None:
+        """
+        Основной цикл потока записи.
+        """
+        segments = self.segments()
+        path = segments[-1] if segments else self._new_segment()
+        f = open(path, 'ab')
+        try:
+            while self._write_batch(f, path, self._next_batch()):
+                if f.tell() >= self.segment_size:
+                    f.close()
+                    path = self._new_segment()
+                    f = open(path, 'ab')
+        except OSError as error:
+            # Дальнейшие записи отклоняются, а не копятся в очереди
+            self.error = error
+            metrics.log_write_errors.inc()
+            logger.error(f'Ошибка записи журнала сообщений: {error}')
+        finally:
+            f.close()
+            # Не оставляем ждать тех, кто вызвал flush или append
+            while not self._queue.empty():
+                item = self._queue.get_nowait()
+                if isinstance(item, threading.Event):
+                    item.set()
+                elif callable(item):
+                    item(self.error or MessageLogError(
+                        f'Журнал {self.directory} закрыт'))
+
+    def _compact(self, active_path: str) -> None:
+        """
+        Удаляет закрытые сегменты, все сообщения которых старше ttl.
+        """
+        deadline = time.time() - self._ttl_sec
+        for path in self.segments():
+            if path != active_path and os.path.getmtime(path) < deadline:
+                os.remove(path)
+                logger.info(f'Удален устаревший сегмент журнала {path}.')